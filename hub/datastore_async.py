@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Datastore API calls that run asynchronously through an AsyncAPIProxy."""
+
+from google.appengine.api import datastore
+from google.appengine.api import datastore_types
+from google.appengine.datastore import datastore_pb
+from google.appengine.ext import db
+from google.appengine.runtime import apiproxy_errors
+
+
+def get(keys, async_proxy, callback, deadline=None):
+  """Retrieves a set of entities by key.
+
+  Args:
+    keys: List of db.Key instances to retrieve.
+    async_proxy: Instance of AsyncAPIProxy to use for executing the call.
+    callback: Callable that takes (model_list, exception). model_list has a
+      db.Model instance for each key in the same order they were supplied,
+      or None for each key that does not exist. Exactly one of the two
+      arguments is None.
+    deadline: How long to allow the call to wait, in seconds. None uses the
+      API's default deadline.
+  """
+  request = datastore_pb.GetRequest()
+  response = datastore_pb.GetResponse()
+  for key in keys:
+    request.add_key().CopyFrom(key._ToPb())
+
+  def completion_callback(response, exception):
+    if exception:
+      callback(None, HandleException(exception))
+      return
+    model_list = []
+    for group in response.entity_list():
+      if group.has_entity():
+        model_list.append(db.model_from_protobuf(group.entity()))
+      else:
+        model_list.append(None)
+    callback(model_list, None)
+
+  async_proxy.start_call('datastore_v3', 'Get', request, response,
+                         completion_callback, deadline=deadline)
+
+
+def run_query(query, limit, async_proxy, callback, deadline=None):
+  """Runs a query and retrieves its first batch of results.
+
+  Args:
+    query: datastore.Query instance to run.
+    limit: Maximum number of results to retrieve.
+    async_proxy: Instance of AsyncAPIProxy to use for executing the call.
+    callback: Callable that takes (result_list, exception). result_list has
+      db.Key instances for a keys-only query, or db.Model instances
+      otherwise. Exactly one of the two arguments is None.
+    deadline: How long to allow the call to wait, in seconds. None uses the
+      API's default deadline.
+  """
+  request = query._ToPb(limit=limit)
+  response = datastore_pb.QueryResult()
+
+  def completion_callback(response, exception):
+    if exception:
+      callback(None, HandleException(exception))
+      return
+    if query.IsKeysOnly():
+      result_list = [datastore_types.Key._FromPb(e.key())
+                     for e in response.result_list()]
+    else:
+      result_list = [db.model_from_protobuf(e)
+                     for e in response.result_list()]
+    callback(result_list, None)
+
+  async_proxy.start_call('datastore_v3', 'RunQuery', request, response,
+                         completion_callback, deadline=deadline)
+
+
+def HandleException(exception):
+  """Returns the exception to give a callback for a failed API call."""
+  if isinstance(exception, apiproxy_errors.ApplicationError):
+    return datastore._ToDatastoreError(exception)
+  return exception
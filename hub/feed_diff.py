@@ -21,6 +21,8 @@ __author__ = 'bslatkin@gmail.com (Brett Slatkin)'
 
 import cStringIO
 import logging
+import re
+import xml.parsers.expat
 import xml.sax
 import xml.sax.handler
 import xml.sax.saxutils
@@ -30,10 +32,67 @@ import xml.sax.saxutils
 DEBUG = False
 
 
+# Maps document encodings where the byte offsets reported by expat can be used
+# to slice entries directly out of the original document to the codec used to
+# decode those slices.
+ZERO_COPY_ENCODINGS = {
+  'utf-8': 'utf-8',
+  'utf8': 'utf-8',
+  'us-ascii': 'utf-8',
+  'ascii': 'utf-8',
+  'iso-8859-1': 'latin-1',
+  'latin-1': 'latin-1',
+}
+
+# Byte-order marks of encodings that are never handled by the zero-copy engine.
+UNSUPPORTED_BOMS = ('\xfe\xff', '\xff\xfe')
+
+UTF8_BOM = '\xef\xbb\xbf'
+
+XML_DECLARATION_RE = re.compile(r'\s*<\?xml\s([^>]*)\?>')
+
+ENCODING_RE = re.compile(r'encoding\s*=\s*["\']([^"\']*)["\']')
+
+CLOSE_TAG_RE = re.compile(r'</([^\s>]+)\s*>')
+
+# Start tags of the entries of each format, with or without a prefix.
+ENTRY_START_RES = {
+  'atom': re.compile(r'<((?:[^\s/>:]+:)?entry)(?=[\s/>])', re.I),
+  'rss': re.compile(r'<((?:[^\s/>:]+:)?item)(?=[\s/>])', re.I),
+}
+
+CHANNEL_CLOSE_RE = re.compile(r'</(?:[^\s>:]+:)?channel\s*>', re.I)
+
+# How many bytes to hand to expat at a time when parsing incrementally. This
+# bounds how far past an early-exit point the parser may read.
+PARSE_CHUNK_SIZE = 16 * 1024
+
+# How many closing tags to step over from the end of a document while looking
+# for the last entry before giving up on finding the envelope's tail.
+MAX_TAIL_TAGS = 100
+
+# How many bytes at the start of a document sniff_format() looks at.
+SNIFF_BYTES = 8 * 1024
+
+ROOT_ELEMENT_RE = re.compile(r'<([A-Za-z_][^\s/>]*)')
+
+URL_RE = re.compile(r'https?://[^\s"\'<>]+')
+
+QUERY_SEPARATOR_RE = re.compile(r'&amp;|&')
+
+
 class Error(Exception):
   """Exception for errors in this module."""
 
 
+class UnsupportedDocumentError(Error):
+  """The zero-copy engine cannot handle a document; the SAX path must."""
+
+
+class StopParsing(Exception):
+  """Raised by an expat handler to abandon parsing a document early."""
+
+
 class TrivialEntityResolver(xml.sax.handler.EntityResolver):
   """Pass-through entity resolver."""
 
@@ -206,6 +265,522 @@ class RssFeedHandler(FeedContentHandler):
       self.emit(self.pop())
 
 
+class ZeroCopyFeedHandler(object):
+  """Expat handler that records the byte ranges of entries in a document.
+
+  Nothing is re-serialized: entries and the header/footer are sliced out of the
+  original document using the byte positions expat reports for each tag. The
+  rules for finding entries and their IDs mirror AtomFeedHandler and
+  RssFeedHandler exactly, so both engines produce the same entry IDs.
+  """
+
+  def __init__(self, data, format, encoding='utf-8',
+               entries_callback=None, batch_size=None, tail=None):
+    """Initializer.
+
+    Args:
+      data: Byte string containing the XML document.
+      format: String naming the format of the data; 'rss' or 'atom'.
+      encoding: Codec for decoding slices of the document; must be one of
+        the values in ZERO_COPY_ENCODINGS.
+      entries_callback, batch_size: See incremental_filter().
+      tail: Tuple (last_entry_end, root_close, root_name) found by
+        find_envelope_tail(). Parsing can only stop early when supplied.
+    """
+    self.data = data
+    self.format = format
+    self.encoding = encoding
+    self.entries_callback = entries_callback
+    self.batch_size = batch_size
+    self.tail = tail
+    self.parser = xml.parsers.expat.ParserCreate()
+    self.parser.buffer_text = True
+    self.parser.StartElementHandler = self.startElement
+    self.parser.EndElementHandler = self.endElement
+    self.parser.CharacterDataHandler = self.characters
+    self.parser.StartDoctypeDeclHandler = self.startDoctype
+
+    self.enclosing_tag = ''
+    self.root_name = None
+    self.root_start = None
+    self.root_end = None
+    self.entry_ranges = []
+    self.entries_map = {}
+    self.stopped = False
+
+    # Internal state
+    self.stack_level = 0
+    self.pending_entries = []
+    self.entry_start = None
+    self.capture = None
+    self.capture_field = None
+    self.last_fields = {}
+
+  def parse(self):
+    """Parses the document.
+
+    Returns:
+      Tuple (header_footer, entries_map) with the same meaning as filter().
+
+    Raises:
+      xml.parsers.expat.ExpatError on parse errors. UnsupportedDocumentError
+      if the document must be handled by the SAX path instead. Error if the
+      document is not the expected format.
+    """
+    if self.entries_callback is None:
+      self.parser.Parse(self.data, True)
+    else:
+      try:
+        for position in xrange(0, len(self.data), PARSE_CHUNK_SIZE):
+          self.parser.Parse(
+              self.data[position:position+PARSE_CHUNK_SIZE], False)
+        self.parser.Parse('', True)
+      except StopParsing:
+        self.stopped = True
+        self.root_end = self.tail[1]
+    if self.root_start is None or self.root_end is None:
+      raise UnsupportedDocumentError('Could not find the root element')
+    return self.get_header_footer(), self.entries_map
+
+  def parse_entry(self, enclosing_tag):
+    """Parses a document fragment containing a single entry.
+
+    Args:
+      enclosing_tag: Name of the root element of the full document.
+
+    Returns:
+      Tuple (entry_id, content) for the entry.
+    """
+    self.enclosing_tag = enclosing_tag.lower()
+    if self.format == 'atom' or 'rdf' in self.enclosing_tag:
+      self.stack_level = 1
+    else:
+      self.stack_level = 2
+    self.parser.Parse(self.data, True)
+    if len(self.entries_map) != 1:
+      raise UnsupportedDocumentError('Fragment is not a single entry')
+    return self.entries_map.items()[0]
+
+  def flush_entries(self, end=None):
+    """Hands pending entries to the callback.
+
+    Args:
+      end: Byte offset just past the last entry parsed so far, or None if the
+        whole document has already been parsed.
+
+    Raises:
+      StopParsing if the callback asked to stop and the rest of the document
+      can safely be skipped.
+    """
+    if not self.pending_entries:
+      return
+    batch, self.pending_entries = self.pending_entries, []
+    stop = self.entries_callback(batch)
+    if (stop and end is not None and self.tail is not None and
+        self.tail[2] == self.root_name.encode(self.encoding) and
+        self.tail[0] >= end):
+      raise StopParsing()
+
+  def get_header_footer(self):
+    """Returns everything inside the root element except the entries."""
+    parts = []
+    position = self.root_start
+    for start, end in self.entry_ranges:
+      parts.append(self.data[position:start])
+      position = end
+    if self.stopped:
+      # Drop the entries that were never parsed but keep everything around
+      # them, the same as when the whole document is parsed.
+      skipped = find_entry_ranges(self.data, position, self.root_end,
+                                  self.format, self.enclosing_tag)
+      if skipped is None:
+        raise UnsupportedDocumentError('Could not find the skipped entries')
+      for start, end in skipped:
+        parts.append(self.data[position:start])
+        position = end
+    parts.append(self.data[position:self.root_end])
+    body = ''.join(parts).decode(self.encoding)
+    return strip_whitespace(self.root_name, [body, '</', self.root_name, '>'])
+
+  def is_entry(self, depth, tag):
+    """Returns True if the element is an <entry> or <item>."""
+    if self.format == 'atom':
+      return depth == 2 and (tag == 'entry' or tag.endswith(':entry'))
+    else:
+      return (tag == 'item' or tag.endswith(':item')) and (
+          depth == 3 or (depth == 2 and 'rdf' in self.enclosing_tag))
+
+  def get_id_field(self, depth, tag):
+    """Returns the name of the ID field this element holds, if any."""
+    if self.format == 'atom':
+      if depth == 3 and (tag == 'id' or tag.endswith(':id')):
+        return 'id'
+    elif depth == 4 or (depth == 3 and 'rdf' in self.enclosing_tag):
+      for field in ('guid', 'link', 'title', 'description'):
+        if tag == field or tag.endswith(':' + field):
+          return field
+    return None
+
+  def get_entry_id(self):
+    """Returns the ID of the entry that just closed."""
+    if self.format == 'atom':
+      return self.last_fields.get('id', '')
+    entry_id = (self.last_fields.get('guid') or
+                self.last_fields.get('link') or
+                self.last_fields.get('title') or
+                self.last_fields.get('description') or '')
+    self.last_fields = {}
+    return entry_id
+
+  def check_root(self, tag):
+    """Raises an Error if the root element does not match the format."""
+    if self.format == 'atom':
+      if tag != 'feed' and not tag.endswith(':feed'):
+        raise Error('Enclosing tag is not <feed></feed>. Found: %r' % tag)
+    elif (tag != 'rss' and not tag.endswith(':rss')
+          and tag != 'rdf' and not tag.endswith(':rdf')):
+      raise Error('Enclosing tag is not <rss></rss> or <rdf></rdf>. '
+                  'Found: %r' % tag)
+
+  def tag_end(self, name, index):
+    """Returns the byte offset just past the end of an element.
+
+    Args:
+      name: The element's qualified name.
+      index: Byte offset expat reported for the element's end event. This is
+        the start of the closing tag, or the end of a self-closing tag.
+    """
+    close = '</' + name.encode(self.encoding)
+    if self.data.startswith(close, index):
+      end = self.data.find('>', index + len(close))
+      if end == -1:
+        raise UnsupportedDocumentError('Unterminated closing tag %r' % name)
+      return end + 1
+    return index
+
+  # Expat methods
+  def startDoctype(self, *args):
+    # Entities declared by the DTD would no longer resolve once entries are
+    # moved into a new document.
+    raise UnsupportedDocumentError('Document has a DOCTYPE declaration')
+
+  def startElement(self, name, attrs):
+    if self.capture is not None:
+      raise UnsupportedDocumentError('Markup inside of entry ID %r' % name)
+    self.stack_level += 1
+    depth, tag = self.stack_level, name.lower()
+    if DEBUG: logging.debug('Start stack level %r', (depth, name))
+    if depth == 1:
+      self.enclosing_tag = tag
+      self.check_root(tag)
+      self.root_name = name
+      self.root_start = self.parser.CurrentByteIndex
+    elif self.is_entry(depth, tag):
+      self.entry_start = self.parser.CurrentByteIndex
+    else:
+      self.capture_field = self.get_id_field(depth, tag)
+      if self.capture_field is not None:
+        self.capture = []
+
+  def endElement(self, name):
+    depth, tag = self.stack_level, name.lower()
+    if DEBUG: logging.debug('End stack level %r', (depth, name))
+    index = self.parser.CurrentByteIndex
+    if depth == 1:
+      if self.entries_callback is not None:
+        self.flush_entries()
+      self.root_end = index
+    elif self.entry_start is not None and self.is_entry(depth, tag):
+      end = self.tag_end(name, index)
+      self.entry_ranges.append((self.entry_start, end))
+      entry_id = self.get_entry_id()
+      content = self.data[self.entry_start:end].decode(self.encoding)
+      self.entries_map[entry_id] = content
+      self.entry_start = None
+      if self.entries_callback is not None:
+        self.pending_entries.append((entry_id, content))
+        if len(self.pending_entries) >= self.batch_size:
+          self.flush_entries(end)
+    elif self.capture is not None:
+      # Escape the same way the SAX path does so the IDs of both engines match.
+      self.last_fields[self.capture_field] = xml.sax.saxutils.escape(
+          ''.join(self.capture)).strip()
+      self.capture = None
+    self.stack_level -= 1
+
+  def characters(self, content):
+    if self.capture is not None:
+      self.capture.append(content)
+
+
+class CanonicalizationRules(object):
+  """Rules for masking the volatile parts of an entry before it is hashed.
+
+  Some publishers rewrite timestamps, tracking parameters, or ad blocks each
+  time a feed is rendered. Hashing the canonical form of an entry instead of
+  its raw content keeps those entries from looking changed on every pull. The
+  rules work on the entry's serialized XML with regular expressions, so no
+  additional parsing is done. Ignored elements are matched up with their
+  closing tags by nesting depth; tags inside comments or CDATA sections are
+  not told apart from real ones.
+  """
+
+  def __init__(self, ignore_elements=(), ignore_attributes=(),
+               strip_query_params=(), strip_query_strings=False,
+               normalize_whitespace=False):
+    """Initializer.
+
+    Args:
+      ignore_elements: Local names of elements to remove along with their
+        content, such as 'updated'.
+      ignore_attributes: Local names of attributes to remove from all elements.
+      strip_query_params: Names of query parameters to remove from URLs. A
+        name ending in '*' matches all parameters with that prefix, such as
+        'utm_*'.
+      strip_query_strings: True to remove the whole query string from URLs.
+      normalize_whitespace: True to collapse all runs of whitespace.
+    """
+    # Patterns for the opening, closing, and empty tags of ignored elements.
+    self.element_patterns = []
+    for name in ignore_elements:
+      self.element_patterns.append(re.compile(
+          r'<(/?)((?:[^\s<>/:]+:)?%s)(?=[\s/>])[^>]*?(/?)>' %
+          re.escape(name)))
+    self.patterns = []
+    for name in ignore_attributes:
+      self.patterns.append(re.compile(
+          r'\s(?:[^\s<>=:]+:)?%s\s*=\s*(?:"[^"]*"|\'[^\']*\')' %
+          re.escape(name)))
+    self.strip_query_params = tuple(strip_query_params)
+    self.strip_query_strings = strip_query_strings
+    self.normalize_whitespace = normalize_whitespace
+
+  def canonicalize(self, content):
+    """Returns the canonical form of an entry's content."""
+    for pattern in self.element_patterns:
+      content = self.remove_elements(pattern, content)
+    for pattern in self.patterns:
+      content = pattern.sub('', content)
+    if self.strip_query_strings or self.strip_query_params:
+      content = URL_RE.sub(self.canonicalize_url, content)
+    if self.normalize_whitespace:
+      content = ' '.join(content.split())
+    return content
+
+  @staticmethod
+  def remove_elements(pattern, content):
+    """Removes the elements whose tags match a pattern, with their content.
+
+    Args:
+      pattern: One of the element_patterns.
+      content: The entry's content.
+
+    Returns:
+      The content without the elements. Unclosed elements are left alone.
+    """
+    pieces = []
+    position = 0
+    start = None
+    depth = 0
+    for match in pattern.finditer(content):
+      closing, name, empty = match.groups()
+      if start is None:
+        if closing:
+          continue
+        if empty:
+          pieces.append(content[position:match.start()])
+          position = match.end()
+          continue
+        start = match.start()
+        open_name = name
+        depth = 1
+      elif name == open_name and not empty:
+        if closing:
+          depth -= 1
+        else:
+          depth += 1
+        if depth == 0:
+          pieces.append(content[position:start])
+          position = match.end()
+          start = None
+    pieces.append(content[position:])
+    return ''.join(pieces)
+
+  def canonicalize_url(self, match):
+    """Returns the canonical form of a URL found by URL_RE."""
+    base, separator, query = match.group(0).partition('?')
+    query, hash_separator, fragment = query.partition('#')
+    if not separator or self.strip_query_strings:
+      query = ''
+    else:
+      params = [p for p in QUERY_SEPARATOR_RE.split(query)
+                if p and not self.is_stripped(p.split('=', 1)[0])]
+      query = '&amp;'.join(params)
+    if query:
+      base += '?' + query
+    return base + hash_separator + fragment
+
+  def is_stripped(self, name):
+    """Returns True if the query parameter with the given name is removed."""
+    for param in self.strip_query_params:
+      if param.endswith('*'):
+        if name.startswith(param[:-1]):
+          return True
+      elif name == param:
+        return True
+    return False
+
+
+def get_zero_copy_encoding(data):
+  """Determines the codec to use for slicing a document by byte offset.
+
+  Args:
+    data: The feed document.
+
+  Returns:
+    The codec name from ZERO_COPY_ENCODINGS to decode slices of the document.
+
+  Raises:
+    UnsupportedDocumentError if the document can't be sliced by byte offset.
+  """
+  if not isinstance(data, str):
+    raise UnsupportedDocumentError('Document is not a byte string')
+  if data.startswith(UNSUPPORTED_BOMS):
+    raise UnsupportedDocumentError('Document is UTF-16 encoded')
+  if data.startswith(UTF8_BOM):
+    data = data[len(UTF8_BOM):]
+  declaration = XML_DECLARATION_RE.match(data)
+  if declaration:
+    encoding = ENCODING_RE.search(declaration.group(1))
+    if encoding:
+      try:
+        return ZERO_COPY_ENCODINGS[encoding.group(1).lower()]
+      except KeyError:
+        raise UnsupportedDocumentError(
+            'Unsupported encoding %r' % encoding.group(1))
+  return 'utf-8'
+
+
+def find_envelope_tail(data, format):
+  """Finds the last entry and the root's closing tag by scanning backwards.
+
+  Args:
+    data: The feed document as a byte string.
+    format: String naming the format of the data. Should be 'rss' or 'atom'.
+
+  Returns:
+    Tuple (entry_start, entry_end, root_close, root_name) of byte offsets for
+    the last <entry> or <item> in the document and the closing tag of the
+    root element, or None if they could not be found.
+  """
+  if format == 'atom':
+    entry_tag = 'entry'
+  else:
+    entry_tag = 'item'
+
+  end = len(data)
+  root_close, root_name = None, None
+  for i in xrange(MAX_TAIL_TAGS):
+    close = data.rfind('</', 0, end)
+    if close == -1:
+      return None
+    end = close
+    match = CLOSE_TAG_RE.match(data, close)
+    if not match:
+      continue
+    name = match.group(1)
+    if root_close is None:
+      root_close, root_name = close, name
+    elif name.lower().split(':')[-1] == entry_tag:
+      # Find the start tag that goes with this closing tag.
+      start = close
+      while True:
+        start = data.rfind('<' + name, 0, start)
+        if start == -1:
+          return None
+        if data[start + 1 + len(name):start + 2 + len(name)] in (
+            ' ', '\t', '\r', '\n', '>'):
+          return start, match.end(), root_close, root_name
+  return None
+
+
+def find_entry_ranges(data, start, end, format, enclosing_tag):
+  """Finds the entries in part of a document by scanning for their tags.
+
+  Used for the part of a document that was skipped after parsing stopped
+  early, so only the tags of the entries themselves are looked at.
+
+  Args:
+    data: The feed document as a byte string.
+    start, end: Byte offsets of the part of the document to scan, which must
+      not start inside of an entry.
+    format: String naming the format of the data. Should be 'rss' or 'atom'.
+    enclosing_tag: Lowercase name of the document's root element.
+
+  Returns:
+    List of (entry_start, entry_end) byte offsets of each <entry> or <item>
+    found, or None if an entry's closing tag could not be found.
+  """
+  if format == 'rss' and 'rdf' not in enclosing_tag:
+    # Items after the channel are not entries.
+    match = CHANNEL_CLOSE_RE.search(data, start, end)
+    if match:
+      end = match.start()
+
+  ranges = []
+  entry_start_re = ENTRY_START_RES[format]
+  while True:
+    match = entry_start_re.search(data, start, end)
+    if not match:
+      return ranges
+    name = match.group(1)
+    tag_end = data.find('>', match.end(), end)
+    if tag_end == -1:
+      return None
+    if data[tag_end - 1] == '/':
+      start = tag_end + 1
+    else:
+      close = data.find('</' + name, tag_end, end)
+      while close != -1:
+        close_match = CLOSE_TAG_RE.match(data, close)
+        if close_match and close_match.group(1) == name:
+          break
+        close = data.find('</' + name, close + 1, end)
+      if close == -1:
+        return None
+      start = close_match.end()
+    ranges.append((match.start(), start))
+
+
+def get_last_entry(data, format):
+  """Parses only the last entry in a document.
+
+  Args:
+    data: The feed document as a byte string.
+    format: String naming the format of the data. Should be 'rss' or 'atom'.
+
+  Returns:
+    Tuple (entry_id, content) for the last entry, or None if it could not be
+    found or parsed on its own.
+  """
+  try:
+    encoding = get_zero_copy_encoding(data)
+  except UnsupportedDocumentError:
+    return None
+  tail = find_envelope_tail(data, format)
+  if tail is None:
+    return None
+  entry_start, entry_end, root_close, root_name = tail
+  handler = ZeroCopyFeedHandler(
+      data[entry_start:entry_end], format, encoding=encoding)
+  try:
+    return handler.parse_entry(root_name.decode(encoding))
+  except (UnsupportedDocumentError, xml.parsers.expat.ExpatError), e:
+    logging.debug('Could not parse last entry. %s: %s',
+                  e.__class__.__name__, e)
+    return None
+
+
 def filter(data, format):
   """Filter a feed through the parser.
 
@@ -255,4 +830,203 @@ def filter(data, format):
   return handler.header_footer, handler.entries_map
 
 
-__all__ = ['filter', 'DEBUG', 'Error']
+def filter_entry(content, format):
+  """Rebuilds a single entry the way filter() serializes it.
+
+  filter() rebuilds each entry from SAX events, so its entries differ from the
+  slices zero_copy_filter() returns (attribute order, CDATA sections, empty
+  elements). This lets content hashes saved from filter() output be matched
+  against entries parsed by the zero-copy engine.
+
+  Args:
+    content: Unicode string containing a single <entry> or <item> element.
+    format: String naming the format of the data. Should be 'rss' or 'atom'.
+
+  Returns:
+    The entry's XML data as filter() would have returned it, or None if the
+    entry could not be parsed on its own.
+  """
+  if format == 'atom':
+    wrapped = u'<feed>\n%s\n</feed>' % content
+  elif format == 'rss':
+    wrapped = u'<rss><channel>\n%s\n</channel>\n</rss>' % content
+  else:
+    raise Error('Invalid feed format "%s"' % format)
+
+  try:
+    entries_map = filter(wrapped.encode('utf-8'), format)[1]
+  except (xml.sax.SAXException, Error), e:
+    logging.debug('Could not rebuild entry. %s: %s',
+                  e.__class__.__name__, e)
+    return None
+  if len(entries_map) != 1:
+    return None
+  return entries_map.values()[0]
+
+
+def sniff_format(data):
+  """Guesses the format of a document from its prolog and root element.
+
+  Only the first SNIFF_BYTES of the document are examined. Root elements are
+  matched with the same rules the parsers use to accept a document.
+
+  Args:
+    data: The document as a byte string.
+
+  Returns:
+    'atom' or 'rss' if the root element is one that format's parser accepts,
+    'arbitrary' if the document is not XML or has some other root element, or
+    None if the format could not be determined.
+  """
+  prefix = data[:SNIFF_BYTES]
+  if prefix.startswith(UNSUPPORTED_BOMS):
+    return None
+  if prefix.startswith(UTF8_BOM):
+    prefix = prefix[len(UTF8_BOM):]
+
+  position = 0
+  while True:
+    position = len(prefix) - len(prefix[position:].lstrip())
+    if position == len(prefix):
+      if len(data) > SNIFF_BYTES:
+        return None
+      return 'arbitrary'
+    if prefix[position] != '<':
+      return 'arbitrary'
+
+    if prefix.startswith('<?', position):
+      end = prefix.find('?>', position)
+      if end == -1:
+        return None
+      position = end + 2
+    elif prefix.startswith('<!--', position):
+      end = prefix.find('-->', position)
+      if end == -1:
+        return None
+      position = end + 3
+    elif prefix.startswith('<!', position):
+      if prefix[position+2:position+14].lower() == 'doctype html':
+        return 'arbitrary'
+      # Skip an internal DTD subset, if any, then the end of the declaration.
+      end = prefix.find('>', position)
+      subset = prefix.find('[', position)
+      if subset != -1 and (end == -1 or subset < end):
+        end = prefix.find(']', subset)
+        if end != -1:
+          end = prefix.find('>', end)
+      if end == -1:
+        return None
+      position = end + 1
+    else:
+      match = ROOT_ELEMENT_RE.match(prefix, position)
+      if not match:
+        return 'arbitrary'
+      tag = match.group(1).lower()
+      if tag == 'feed' or tag.endswith(':feed'):
+        return 'atom'
+      elif (tag == 'rss' or tag.endswith(':rss') or
+            tag == 'rdf' or tag.endswith(':rdf')):
+        return 'rss'
+      return 'arbitrary'
+
+
+def zero_copy_filter(data, format):
+  """Filter a feed by slicing entries out of the original document.
+
+  Has the same contract as filter(), but each entry and the header/footer are
+  copied directly out of the document's bytes instead of being rebuilt from
+  SAX events. Documents the zero-copy engine can't handle (multi-byte encodings
+  other than UTF-8, DOCTYPEs, markup inside entry IDs, parse errors) are passed
+  to filter() instead.
+
+  Args:
+    data: String containing the data of the XML feed to parse.
+    format: String naming the format of the data. Should be 'rss' or 'atom'.
+
+  Returns:
+    Tuple (header_footer, entries_map); see filter().
+
+  Raises:
+    xml.sax.SAXException on parse errors. feed_diff.Error if the diff could not
+    be derived due to bad content or missing required fields.
+  """
+  if format not in ('atom', 'rss'):
+    raise Error('Invalid feed format "%s"' % format)
+
+  try:
+    encoding = get_zero_copy_encoding(data)
+    header_footer, entries_map = ZeroCopyFeedHandler(
+        data, format, encoding=encoding).parse()
+  except (UnsupportedDocumentError, xml.parsers.expat.ExpatError), e:
+    logging.debug('Falling back to SAX feed parsing. %s: %s',
+                  e.__class__.__name__, e)
+    return filter(data, format)
+
+  for entry_id, content in entries_map.iteritems():
+    if format == 'atom' and not entry_id:
+      raise Error('<entry> element missing <id>: %s' % content)
+    elif format == 'rss' and not entry_id:
+      raise Error('<item> element missing <guid> or <link>: %s' % content)
+
+  return header_footer, entries_map
+
+
+def incremental_filter(data, format, entries_callback, batch_size=10):
+  """Filter a feed, handing entries to a callback while parsing.
+
+  Entries are passed to the callback in document order, in batches. When the
+  callback returns True parsing stops; the header/footer is still the same as
+  for a full parse. The root element's closing tag is found with a quick
+  backwards scan and the skipped entries are found by scanning for their tags
+  instead of parsing them.
+
+  Documents the zero-copy engine can't handle are parsed with filter() and all
+  of their entries are handed to the callback at once; in this case the
+  callback may see entries it was already given and parsing never stops early.
+
+  Args:
+    data: String containing the data of the XML feed to parse.
+    format: String naming the format of the data. Should be 'rss' or 'atom'.
+    entries_callback: Called with a list of (entry_id, content) tuples for
+      each batch of entries. Returns True if parsing should stop.
+    batch_size: How many entries to hand to the callback at a time.
+
+  Returns:
+    Tuple (header_footer, entries_map) where entries_map only contains the
+    entries that were parsed; see filter().
+
+  Raises:
+    xml.sax.SAXException on parse errors. feed_diff.Error if the diff could not
+    be derived due to bad content or missing required fields.
+  """
+  if format not in ('atom', 'rss'):
+    raise Error('Invalid feed format "%s"' % format)
+
+  try:
+    encoding = get_zero_copy_encoding(data)
+    tail = find_envelope_tail(data, format)
+    if tail is not None:
+      tail = tail[1:]
+    handler = ZeroCopyFeedHandler(
+        data, format, encoding=encoding, entries_callback=entries_callback,
+        batch_size=batch_size, tail=tail)
+    header_footer, entries_map = handler.parse()
+  except (UnsupportedDocumentError, xml.parsers.expat.ExpatError), e:
+    logging.debug('Falling back to SAX feed parsing. %s: %s',
+                  e.__class__.__name__, e)
+    header_footer, entries_map = filter(data, format)
+    entries_callback(entries_map.items())
+    return header_footer, entries_map
+
+  for entry_id, content in entries_map.iteritems():
+    if format == 'atom' and not entry_id:
+      raise Error('<entry> element missing <id>: %s' % content)
+    elif format == 'rss' and not entry_id:
+      raise Error('<item> element missing <guid> or <link>: %s' % content)
+
+  return header_footer, entries_map
+
+
+__all__ = ['filter', 'zero_copy_filter', 'incremental_filter',
+           'filter_entry', 'get_last_entry', 'sniff_format',
+           'CanonicalizationRules', 'DEBUG', 'Error']
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Benchmarks for the feed parsing and diffing paths.
+
+Runs each parser path over a corpus of synthetic Atom, RSS, and RDF feeds of
+varying entry counts, entry sizes, namespace density, and CDATA/entity usage,
+plus the documents in feed_diff_testdata. For each document and path this
+reports entries per second, bytes per second, and the peak memory growth.
+
+The find_feed_updates paths need the App Engine SDK on the PATH and run
+against the stub Datastore from testutil.setup_for_testing(); they are skipped
+if the SDK can't be found.
+
+Usage:
+  ./feed_diff_benchmark.py [--repeat=N] [--paths=filter,...] [--corpus=atom]
+"""
+
+import cPickle
+import optparse
+import os
+import resource
+import sys
+import time
+import xml.sax
+
+import testutil
+import feed_diff
+
+
+# Words used to build entry bodies.
+FILLER = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+          'eiusmod tempor incididunt ut labore et dolore magna aliqua ')
+
+# Escaped markup and entities sprinkled into bodies when entities are used.
+ENTITY_FILLER = ' &amp; &lt;b&gt;bold&lt;/b&gt; &#233;t&#233; &quot;q&quot; '
+
+# (name, format, entries, entry_size, namespaces, cdata, entities)
+SYNTHETIC_FEEDS = [
+  ('atom-small', 'atom', 10, 500, 0, False, False),
+  ('atom-medium', 'atom', 100, 2000, 0, False, False),
+  ('atom-large', 'atom', 500, 4000, 0, False, False),
+  ('atom-huge-entries', 'atom', 20, 100000, 0, False, False),
+  ('atom-namespaces', 'atom', 100, 2000, 10, False, False),
+  ('atom-cdata', 'atom', 100, 2000, 0, True, False),
+  ('atom-entities', 'atom', 100, 2000, 0, False, True),
+  ('rss-small', 'rss', 10, 500, 0, False, False),
+  ('rss-medium', 'rss', 100, 2000, 0, False, False),
+  ('rss-large', 'rss', 500, 4000, 0, False, False),
+  ('rss-namespaces', 'rss', 100, 2000, 10, False, False),
+  ('rss-cdata', 'rss', 100, 2000, 0, True, False),
+  ('rss-entities', 'rss', 100, 2000, 0, False, True),
+  ('rdf-medium', 'rdf', 100, 2000, 0, False, False),
+  ('rdf-namespaces', 'rdf', 100, 2000, 10, False, True),
+]
+
+TESTDATA_DIR = os.path.join(os.path.dirname(__file__), 'feed_diff_testdata')
+
+################################################################################
+# Corpus
+
+def make_body(size, cdata, entities):
+  """Makes the body of an entry.
+
+  Args:
+    size: Approximate size of the body in bytes.
+    cdata: True to wrap the body, including unescaped markup, in a CDATA
+      section.
+    entities: True to include escaped markup and character references.
+
+  Returns:
+    String containing the body.
+  """
+  filler = FILLER
+  if entities:
+    filler += ENTITY_FILLER
+  body = (filler * (size / len(filler) + 1))[:size]
+  if cdata:
+    body = '<![CDATA[<p>%s</p>]]>' % body.replace(']]>', '')
+  return body
+
+
+def make_extras(index, namespaces):
+  """Makes the namespaced elements of an entry."""
+  return ''.join('<ns%d:extra ns%d:index="%d">value %d</ns%d:extra>' %
+                 (n, n, index, n, n) for n in xrange(namespaces))
+
+
+def make_namespace_declarations(namespaces):
+  """Makes the declarations for the namespaces used by make_extras()."""
+  return ''.join(' xmlns:ns%d="http://example.com/ns/%d"' % (n, n)
+                 for n in xrange(namespaces))
+
+
+def make_feed(format, entries, entry_size, namespaces, cdata, entities):
+  """Makes a synthetic feed document.
+
+  Args:
+    format: 'atom', 'rss', or 'rdf' (RSS 1.0).
+    entries: Number of entries in the feed.
+    entry_size: Approximate size of each entry's body in bytes.
+    namespaces: Number of extra namespaces declared on the root element, each
+      of which is used by an element in every entry.
+    cdata: True to put entry bodies in CDATA sections.
+    entities: True to use escaped markup and character references in bodies.
+
+  Returns:
+    The feed document as a UTF-8 encoded string.
+  """
+  body = make_body(entry_size, cdata, entities)
+  declarations = make_namespace_declarations(namespaces)
+  parts = ['<?xml version="1.0" encoding="utf-8"?>\n']
+  if format == 'atom':
+    parts.append('<feed xmlns="http://www.w3.org/2005/Atom"%s>\n'
+                 '<title>Benchmark feed</title>\n'
+                 '<id>tag:example.com,2010:feed</id>\n'
+                 '<updated>2010-01-01T00:00:00Z</updated>\n' % declarations)
+    for index in xrange(entries):
+      parts.append(
+          '<entry>\n<id>tag:example.com,2010:entry-%d</id>\n'
+          '<title>Entry %d</title>\n<updated>2010-01-01T00:00:00Z</updated>\n'
+          '<link href="http://example.com/entry-%d"/>\n%s\n'
+          '<content type="html">%s</content>\n</entry>\n' %
+          (index, index, index, make_extras(index, namespaces), body))
+    parts.append('</feed>\n')
+  elif format == 'rss':
+    parts.append('<rss version="2.0"%s>\n<channel>\n'
+                 '<title>Benchmark feed</title>\n'
+                 '<link>http://example.com/</link>\n' % declarations)
+    for index in xrange(entries):
+      parts.append(
+          '<item>\n<guid>http://example.com/entry-%d</guid>\n'
+          '<title>Entry %d</title>\n<link>http://example.com/entry-%d</link>\n'
+          '%s\n<description>%s</description>\n</item>\n' %
+          (index, index, index, make_extras(index, namespaces), body))
+    parts.append('</channel>\n</rss>\n')
+  elif format == 'rdf':
+    parts.append('<rdf:RDF '
+                 'xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" '
+                 'xmlns="http://purl.org/rss/1.0/"%s>\n'
+                 '<channel rdf:about="http://example.com/">\n'
+                 '<title>Benchmark feed</title>\n'
+                 '<link>http://example.com/</link>\n</channel>\n' %
+                 declarations)
+    for index in xrange(entries):
+      parts.append(
+          '<item rdf:about="http://example.com/entry-%d">\n'
+          '<title>Entry %d</title>\n<link>http://example.com/entry-%d</link>\n'
+          '%s\n<description>%s</description>\n</item>\n' %
+          (index, index, index, make_extras(index, namespaces), body))
+    parts.append('</rdf:RDF>\n')
+  else:
+    raise ValueError('Unknown format %r' % format)
+  return ''.join(parts)
+
+
+def get_corpus(pattern=None):
+  """Returns the documents to benchmark.
+
+  Args:
+    pattern: If supplied, only documents whose name contains this string are
+      returned.
+
+  Returns:
+    List of (name, format, data, entries) tuples, where format is 'atom' or
+    'rss' and entries is the number of entries in the document.
+  """
+  corpus = []
+  for (name, format, entries, entry_size,
+       namespaces, cdata, entities) in SYNTHETIC_FEEDS:
+    data = make_feed(format, entries, entry_size, namespaces, cdata, entities)
+    if format == 'rdf':
+      format = 'rss'
+    corpus.append((name, format, data))
+
+  for path in sorted(os.listdir(TESTDATA_DIR)):
+    data = open(os.path.join(TESTDATA_DIR, path)).read()
+    format = feed_diff.sniff_format(data)
+    if format in ('atom', 'rss'):
+      corpus.append(('testdata/' + path, format, data))
+
+  if pattern:
+    corpus = [c for c in corpus if pattern in c[0]]
+
+  results = []
+  for name, format, data in corpus:
+    try:
+      entries = len(feed_diff.filter(data, format)[1])
+    except (xml.sax.SAXException, feed_diff.Error):
+      entries = 0
+    results.append((name, format, data, entries))
+  return results
+
+################################################################################
+# Parser paths
+
+TOPIC = 'http://example.com/benchmark'
+
+# The main module once load_main() has set it up; None if it's unavailable.
+MAIN = [None]
+
+# Digest of seen entries made by make_seen_entries().
+SEEN_ENTRIES = [None]
+
+
+def load_main():
+  """Imports the main module and sets up the stub Datastore for it.
+
+  Returns:
+    True if the App Engine SDK could be found, False otherwise.
+  """
+  testutil.fix_path()
+  try:
+    import main
+  except ImportError:
+    return False
+  testutil.setup_for_testing()
+  MAIN[0] = main
+  return True
+
+
+def run_filter(data, format):
+  """Parses a document with the SAX-based filter."""
+  feed_diff.filter(data, format)
+
+
+def run_zero_copy_filter(data, format):
+  """Parses a document with the zero-copy filter."""
+  feed_diff.zero_copy_filter(data, format)
+
+
+def run_incremental_filter(data, format):
+  """Parses a document with the incremental filter, never stopping early."""
+  feed_diff.incremental_filter(data, format, lambda batch: False)
+
+
+def run_find_feed_updates(data, format):
+  """Diffs a document for a topic that has seen none of its entries."""
+  MAIN[0].find_feed_updates(
+      TOPIC, format, data, seen_entries=MAIN[0].SeenEntries())
+
+
+def run_find_feed_updates_seen(data, format):
+  """Diffs a document for a topic that has seen all of its entries.
+
+  This is the steady state for most topics.
+  """
+  MAIN[0].find_feed_updates(
+      TOPIC, format, data, seen_entries=SEEN_ENTRIES[0])
+
+
+def make_seen_entries(data, format):
+  """Marks all entries of a document as seen for run_find_feed_updates_seen."""
+  seen_entries = MAIN[0].SeenEntries()
+  entry_list = MAIN[0].find_feed_updates(
+      TOPIC, format, data, seen_entries=seen_entries)[1]
+  for entry in entry_list:
+    seen_entries.add(entry.id_hash, entry.entry_content_hash)
+  SEEN_ENTRIES[0] = seen_entries
+
+
+# (name, function, needs App Engine, setup function or None)
+PARSER_PATHS = [
+  ('filter', run_filter, False, None),
+  ('zero_copy_filter', run_zero_copy_filter, False, None),
+  ('incremental_filter', run_incremental_filter, False, None),
+  ('find_feed_updates', run_find_feed_updates, True, None),
+  ('find_feed_updates_seen', run_find_feed_updates_seen, True,
+   make_seen_entries),
+]
+
+################################################################################
+# Measurement
+
+def get_max_rss():
+  """Returns the peak resident set size of this process in kilobytes."""
+  max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    max_rss /= 1024
+  return max_rss
+
+
+def describe_error(error):
+  """Returns the first line of an error's message, with its class name."""
+  message = (str(error).splitlines() or [''])[0]
+  return '%s: %s' % (error.__class__.__name__, message)
+
+
+def measure(function, setup, data, format, repeat):
+  """Measures a parser path on a document.
+
+  Args:
+    function: Function that parses the document.
+    setup: Function to call with the same arguments before timing starts, or
+      None.
+    data: The document.
+    format: 'atom' or 'rss'.
+    repeat: Number of times to run the function; the fastest run is kept.
+
+  Returns:
+    Tuple (seconds, peak_kb) with the time of the fastest run and the growth
+    of the process's peak memory, or (None, error message) if the document
+    could not be parsed.
+  """
+  try:
+    if setup is not None:
+      setup(data, format)
+    start_rss = get_max_rss()
+    best = None
+    for unused in xrange(repeat):
+      start = time.time()
+      function(data, format)
+      elapsed = time.time() - start
+      if best is None or elapsed < best:
+        best = elapsed
+    return best, get_max_rss() - start_rss
+  except (xml.sax.SAXException, feed_diff.Error), e:
+    return None, describe_error(e)
+
+
+def measure_in_child(function, setup, data, format, repeat):
+  """Runs measure() in a forked process so peak memory is per-measurement.
+
+  A process's peak resident set size never goes down, so each measurement is
+  made in a child that starts out at the parent's size; the growth of the
+  child's peak is what the measurement used.
+  """
+  if not hasattr(os, 'fork'):
+    return measure(function, setup, data, format, repeat)
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    try:
+      result = measure(function, setup, data, format, repeat)
+    except Exception, e:
+      result = (None, describe_error(e))
+    os.write(write_fd, cPickle.dumps(result))
+    os._exit(0)
+
+  os.close(write_fd)
+  pieces = []
+  while True:
+    piece = os.read(read_fd, 65536)
+    if not piece:
+      break
+    pieces.append(piece)
+  os.close(read_fd)
+  os.waitpid(pid, 0)
+  return cPickle.loads(''.join(pieces))
+
+
+def run_benchmarks(argv):
+  """Runs the benchmarks and prints a table of the results."""
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('--repeat', type='int', default=5,
+                    help='Runs per measurement; the fastest is reported.')
+  parser.add_option('--paths', default='',
+                    help='Comma-separated parser paths to run; all by default: '
+                         + ', '.join(p[0] for p in PARSER_PATHS))
+  parser.add_option('--corpus', default='',
+                    help='Only run documents whose name contains this string.')
+  parser.add_option('--no_fork', action='store_true', default=False,
+                    help='Measure in this process; peak memory is then only '
+                         'meaningful for the first measurement.')
+  options, args = parser.parse_args(argv[1:])
+
+  paths = PARSER_PATHS
+  if options.paths:
+    names = options.paths.split(',')
+    paths = [p for p in PARSER_PATHS if p[0] in names]
+  if [p for p in paths if p[2]] and not load_main():
+    print >>sys.stderr, ('App Engine SDK not found on the PATH; skipping the '
+                         'find_feed_updates paths')
+    paths = [p for p in paths if not p[2]]
+
+  if options.no_fork:
+    run = measure
+  else:
+    run = measure_in_child
+
+  print '%-36s %-22s %8s %7s %10s %10s %9s' % (
+      'document', 'path', 'bytes', 'entries', 'entries/s', 'KB/s',
+      'peak KB')
+  for name, format, data, entries in get_corpus(options.corpus):
+    for path_name, function, unused, setup in paths:
+      seconds, peak_kb = run(function, setup, data, format, options.repeat)
+      if seconds is None:
+        print '%-36s %-22s %8d  %s' % (name, path_name, len(data), peak_kb)
+        continue
+      seconds = max(seconds, 1e-6)
+      print '%-36s %-22s %8d %7d %10.0f %10.0f %9d' % (
+          name, path_name, len(data), entries, entries / seconds,
+          len(data) / seconds / 1024, peak_kb)
+
+
+if __name__ == '__main__':
+  run_benchmarks(sys.argv)
@@ -19,9 +19,11 @@ __author__ = 'bslatkin@gmail.com (Brett Slatkin)'
 
 """Tests for the feed_diff module."""
 
+import hashlib
 import logging
 import os
 import unittest
+import xml.sax
 
 import feed_diff
 
@@ -325,6 +327,326 @@ class FilterTest(TestBase):
       self.assertFalse('IOError' in str(e))
 
 
+class ZeroCopyFilterTest(TestBase):
+
+  def filter_both(self, path, format):
+    """Runs a test data file through both engines and returns the results."""
+    data = open(os.path.join(self.testdata, path)).read()
+    return (feed_diff.filter(data, format),
+            feed_diff.zero_copy_filter(data, format))
+
+  def testMatchesSaxEntryIds(self):
+    """Tests that both engines find the same entry IDs and envelope."""
+    for path, format in (('parsing.xml', 'atom'),
+                         ('atom_namespace.xml', 'atom'),
+                         ('cdata_test.xml', 'atom'),
+                         ('entity_escaping.xml', 'atom'),
+                         ('rss2sample.xml', 'rss'),
+                         ('rss2_only_title.xml', 'rss'),
+                         ('sampleRss091.xml', 'rss'),
+                         ('sampleRss092.xml', 'rss'),
+                         ('rss_rdf.xml', 'rss'),
+                         ('rdf_10_weirdness.xml', 'rss')):
+      (sax_header_footer, sax_entries), (header_footer, entries) = (
+          self.filter_both(path, format))
+      self.assertEquals(sorted(sax_entries.keys()), sorted(entries.keys()),
+                        'Entry IDs differ for %s' % path)
+      self.assertEquals(sax_header_footer[-20:], header_footer[-20:])
+
+  def testFilterEntryMatchesSax(self):
+    """Tests that rebuilt zero-copy entries hash the same as SAX entries."""
+    checked = 0
+    for path in sorted(os.listdir(self.testdata)):
+      for format in ('atom', 'rss'):
+        try:
+          (sax_header_footer, sax_entries), (header_footer, entries) = (
+              self.filter_both(path, format))
+        except (xml.sax.SAXException, feed_diff.Error):
+          continue
+        for entry_id, content in sax_entries.iteritems():
+          rebuilt = feed_diff.filter_entry(entries[entry_id], format)
+          self.assertEquals(
+              hashlib.sha1(content.encode('utf-8')).hexdigest(),
+              hashlib.sha1(rebuilt.encode('utf-8')).hexdigest(),
+              'Entry %r differs for %s' % (entry_id, path))
+          checked += 1
+    self.assertTrue(checked > 50)
+
+  def testFilterEntryErrors(self):
+    """Tests rebuilding entries that can't be parsed on their own."""
+    self.assertEquals(None,
+                      feed_diff.filter_entry(u'<entry><id>1</id>', 'atom'))
+    self.assertEquals(None, feed_diff.filter_entry(u'<item/>', 'rss'))
+    self.assertRaises(feed_diff.Error, feed_diff.filter_entry, u'<x/>', 'x')
+
+  def testOriginalBytesPreserved(self):
+    """Tests that entries are the exact bytes from the original document."""
+    data = open(os.path.join(self.testdata, 'cdata_test.xml')).read()
+    header_footer, entries = feed_diff.zero_copy_filter(data, 'atom')
+    entry_data = entries['tag:blog.livedoor.jp,2010:coupon_123.1635380']
+    self.assertTrue(entry_data.encode('utf-8') in data)
+    self.assertTrue('<![CDATA[' in entry_data)
+    self.assertTrue(header_footer.startswith('<feed version="0.3"'))
+
+  def testEnvelopeWhitespace(self):
+    """Tests that the envelope is trimmed the same way as the SAX path."""
+    header_footer, entries = feed_diff.zero_copy_filter(
+        open(os.path.join(self.testdata, 'rss2sample.xml')).read(), 'rss')
+    self.assertTrue(header_footer.endswith('>\n</channel>\n</rss>'))
+    self.assertTrue('<mycoolelement wooh="fun"/>' in header_footer)
+
+  def testSelfClosingElements(self):
+    """Tests entries that contain and are followed by self-closing elements."""
+    data = ('<feed><entry><id>1</id><link href="a"/></entry>'
+            '<link href="b"/></feed>')
+    header_footer, entries = feed_diff.zero_copy_filter(data, 'atom')
+    self.assertEquals({u'1': u'<entry><id>1</id><link href="a"/></entry>'},
+                      entries)
+    self.assertEquals(u'<feed><link href="b"/>\n</feed>', header_footer)
+
+  def testLatin1(self):
+    """Tests that single-byte encodings are decoded with the right codec."""
+    data = ('<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+            '<feed><entry><id>caf\xe9</id></entry></feed>')
+    header_footer, entries = feed_diff.zero_copy_filter(data, 'atom')
+    self.assertEquals({u'caf\xe9': u'<entry><id>caf\xe9</id></entry>'},
+                      entries)
+
+  def testFallbackUnsupportedEncoding(self):
+    """Tests that UTF-16 documents fall back to the SAX path."""
+    data = u'<feed><entry><id>1</id></entry></feed>'.encode('utf-16')
+    self.assertEquals(feed_diff.filter(data, 'atom'),
+                      feed_diff.zero_copy_filter(data, 'atom'))
+
+  def testFallbackMarkupInId(self):
+    """Tests that entry IDs containing markup fall back to the SAX path."""
+    data = '<feed><entry><id>a<b>c</b></id></entry></feed>'
+    self.assertEquals(feed_diff.filter(data, 'atom'),
+                      feed_diff.zero_copy_filter(data, 'atom'))
+
+  def testFallbackErrors(self):
+    """Tests that the SAX path's errors are raised for bad documents."""
+    data = open(os.path.join(self.testdata, 'bad_feed.xml')).read()
+    self.assertRaises(xml.sax.SAXException,
+                      feed_diff.zero_copy_filter, data, 'atom')
+    data = open(os.path.join(self.testdata, 'missing_entry_id.xml')).read()
+    try:
+      feed_diff.zero_copy_filter(data, 'atom')
+    except feed_diff.Error, e:
+      self.assertTrue('<entry> element missing <id>' in str(e))
+    else:
+      self.fail()
+    data = open(os.path.join(self.testdata, 'rss2sample.xml')).read()
+    try:
+      feed_diff.zero_copy_filter(data, 'atom')
+    except feed_diff.Error, e:
+      self.assertTrue('Enclosing tag is not <feed></feed>' in str(e))
+    else:
+      self.fail()
+
+
+class IncrementalFilterTest(TestBase):
+
+  def setUp(self):
+    TestBase.setUp(self)
+    self.batches = []
+    self.data = ('<feed><title>t</title>' +
+                 ''.join('<entry><id>%d</id></entry>' % i for i in xrange(6)) +
+                 '<link href="tail"/></feed>')
+
+  def stop_after(self, count):
+    """Returns a callback that stops once it has seen count batches."""
+    def callback(batch):
+      self.batches.append([entry_id for entry_id, content in batch])
+      return len(self.batches) >= count
+    return callback
+
+  def testAllEntries(self):
+    """Tests that entries are handed over in order when not stopping."""
+    header_footer, entries = feed_diff.incremental_filter(
+        self.data, 'atom', self.stop_after(100), batch_size=4)
+    self.assertEquals([[u'0', u'1', u'2', u'3'], [u'4', u'5']], self.batches)
+    self.assertEquals(feed_diff.zero_copy_filter(self.data, 'atom'),
+                      (header_footer, entries))
+
+  def testStopEarly(self):
+    """Tests that parsing stops and the envelope's tail is still captured."""
+    header_footer, entries = feed_diff.incremental_filter(
+        self.data, 'atom', self.stop_after(1), batch_size=2)
+    self.assertEquals([[u'0', u'1']], self.batches)
+    self.assertEquals([u'0', u'1'], sorted(entries.keys()))
+    self.assertEquals(
+        u'<feed><title>t</title><link href="tail"/>\n</feed>', header_footer)
+
+  def testStopMatchesFullEnvelope(self):
+    """Tests stopping early on real feeds gives the same header/footer."""
+    stopped = 0
+    for path in sorted(os.listdir(self.testdata)):
+      data = open(os.path.join(self.testdata, path)).read()
+      for format in ('atom', 'rss'):
+        try:
+          sax_header_footer = feed_diff.filter(data, format)[0]
+        except (xml.sax.SAXException, feed_diff.Error):
+          continue
+        full_header_footer, full_entries = feed_diff.zero_copy_filter(
+            data, format)
+        self.batches = []
+        header_footer, entries = feed_diff.incremental_filter(
+            data, format, self.stop_after(1), batch_size=1)
+        self.assertEquals(full_header_footer, header_footer,
+                          'Header/footer differs for %s' % path)
+        if len(entries) < len(full_entries):
+          stopped += 1
+        if path in ('rss2_only_link.xml', 'rss2_only_title.xml',
+                    'rss2sample.xml', 'rss_rdf.xml', 'sampleRss091.xml'):
+          # The SAX parser rebuilds the same header/footer for these.
+          self.assertEquals(sax_header_footer, header_footer)
+    self.assertTrue(stopped >= 5)
+
+  def testStopKeepsElementsBetweenSkippedEntries(self):
+    """Tests that elements between entries that were skipped are kept."""
+    data = ('<feed>\n  <title>t</title>\n' +
+            ''.join('  <entry><id>%d</id></entry>\n  <x:link n="%d"/>\n' %
+                    (i, i) for i in xrange(4)) +
+            '  <x:entry a="/"><id>4</id></x:entry>\n  <bar:entry>\n' +
+            '<id>5</id><entry>6</entry></bar:entry>\n</feed>\n')
+    header_footer, entries = feed_diff.incremental_filter(
+        data, 'atom', self.stop_after(1), batch_size=1)
+    self.assertEquals([u'0'], entries.keys())
+    self.assertEquals(feed_diff.zero_copy_filter(data, 'atom')[0],
+                      header_footer)
+    for i in xrange(4):
+      self.assertTrue(u'<x:link n="%d"/>' % i in header_footer)
+
+  def testFallback(self):
+    """Tests that unsupported documents hand over every entry at once."""
+    data = u'<feed><entry><id>1</id></entry></feed>'.encode('utf-16')
+    header_footer, entries = feed_diff.incremental_filter(
+        data, 'atom', self.stop_after(1), batch_size=1)
+    self.assertEquals([[u'1']], self.batches)
+    self.assertEquals(feed_diff.filter(data, 'atom'), (header_footer, entries))
+
+  def testGetLastEntry(self):
+    """Tests finding and parsing only the last entry of a document."""
+    self.assertEquals((u'5', u'<entry><id>5</id></entry>'),
+                      feed_diff.get_last_entry(self.data, 'atom'))
+    data = open(os.path.join(self.testdata, 'rss2sample.xml')).read()
+    entry_id, content = feed_diff.get_last_entry(data, 'rss')
+    self.assertEquals(feed_diff.filter(data, 'rss')[1][entry_id], content)
+    self.assertEquals(None, feed_diff.get_last_entry('<feed></feed>', 'atom'))
+
+
+class SniffFormatTest(TestBase):
+
+  def testTestData(self):
+    """Tests sniffing the formats of the test data files."""
+    for path, format in (('parsing.xml', 'atom'),
+                         ('atom_namespace.xml', 'atom'),
+                         ('no_xml_header.xml', 'atom'),
+                         ('rss2sample.xml', 'rss'),
+                         ('sampleRss091.xml', 'rss'),
+                         ('rss_rdf.xml', 'rss'),
+                         ('rdf_10_weirdness.xml', 'rss'),
+                         ('bad_atom_feed.xml', 'arbitrary'),
+                         ('bad_feed.xml', 'arbitrary'),
+                         ('xhtml_entities.xml', 'arbitrary')):
+      data = open(os.path.join(self.testdata, path)).read()
+      self.assertEquals(format, feed_diff.sniff_format(data),
+                        'Wrong format for %s' % path)
+
+  def testProlog(self):
+    """Tests skipping over everything that may come before the root."""
+    self.assertEquals('rss', feed_diff.sniff_format(
+        '\xef\xbb\xbf  <?xml version="1.0"?>\n<!-- <feed> -->'
+        '<?xml-stylesheet href="a.xsl"?>'
+        '<!DOCTYPE rss [<!ENTITY nbsp "&#160;">]>\n<rss version="2.0">'))
+    self.assertEquals('atom',
+                      feed_diff.sniff_format('<atom:feed xmlns:atom=""/>'))
+
+  def testNotFeeds(self):
+    """Tests documents that should go straight to the arbitrary path."""
+    for data in ('', 'plain text', '{"json": true}', '\xff\x12 binary',
+                 '<!DOCTYPE html>\n<html></html>', '<html><body/></html>',
+                 '<opml version="1.0"/>'):
+      self.assertEquals('arbitrary', feed_diff.sniff_format(data),
+                        'Wrong format for %r' % data)
+
+  def testUndetermined(self):
+    """Tests when the format can't be found from the start of the document."""
+    self.assertEquals(None, feed_diff.sniff_format('<!-- never ends'))
+    self.assertEquals(None, feed_diff.sniff_format('<?xml version="1.0"'))
+    self.assertEquals(None, feed_diff.sniff_format(
+        '<!--' + 'x' * feed_diff.SNIFF_BYTES + '--><feed/>'))
+    self.assertEquals(None, feed_diff.sniff_format(
+        u'<feed/>'.encode('utf-16')))
+
+
+class CanonicalizationRulesTest(unittest.TestCase):
+
+  def testIgnoreElements(self):
+    """Tests removing elements and their content by local name."""
+    rules = feed_diff.CanonicalizationRules(ignore_elements=['updated', 'ad'])
+    self.assertEquals(
+        '<entry><id>1</id><updated-by>me</updated-by></entry>',
+        rules.canonicalize(
+            '<entry><id>1</id><updated>2010-01-01</updated>'
+            '<updated-by>me</updated-by><ad/><x:ad kind="a">'
+            '<b>buy</b>\n</x:ad><atom:updated>now</atom:updated></entry>'))
+
+  def testIgnoreElements_nested(self):
+    """Tests removing elements that contain elements of the same name."""
+    rules = feed_diff.CanonicalizationRules(ignore_elements=['ad'])
+    self.assertEquals(
+        '<entry><id>1</id>text</entry>',
+        rules.canonicalize(
+            '<entry><id>1</id><ad><ad><ad/>inner</ad>tail</ad >text</entry>'))
+    # Elements that are never closed are left alone.
+    content = '<entry>a<ad><ad>x</ad>unclosed</entry>'
+    self.assertEquals(content, rules.canonicalize(content))
+
+  def testIgnoreAttributes(self):
+    """Tests removing attributes by local name."""
+    rules = feed_diff.CanonicalizationRules(ignore_attributes=['data-ts'])
+    self.assertEquals(
+        '<entry><a href="b">c</a><a/></entry>',
+        rules.canonicalize(
+            '<entry><a data-ts="1" href="b">c</a><a x:data-ts = \'2\'/>'
+            '</entry>'))
+
+  def testStripQueryParams(self):
+    """Tests removing query parameters from URLs in attributes and text."""
+    rules = feed_diff.CanonicalizationRules(
+        strip_query_params=['utm_*', 'ref'])
+    self.assertEquals(
+        '<link href="http://a.com/p?id=3#top"/>'
+        'see https://b.com/x now, or http://c.com/?refer=1',
+        rules.canonicalize(
+            '<link href="http://a.com/p?utm_source=x&amp;id=3&amp;ref=r#top"/>'
+            'see https://b.com/x?utm_medium=y now, or '
+            'http://c.com/?refer=1&ref=2'))
+
+  def testStripQueryStrings(self):
+    """Tests removing whole query strings from URLs."""
+    rules = feed_diff.CanonicalizationRules(strip_query_strings=True)
+    self.assertEquals(
+        '<a href="http://a.com/p#top">http://b.com/</a>',
+        rules.canonicalize(
+            '<a href="http://a.com/p?x=1#top">http://b.com/?y=2</a>'))
+
+  def testNormalizeWhitespace(self):
+    """Tests collapsing runs of whitespace."""
+    rules = feed_diff.CanonicalizationRules(normalize_whitespace=True)
+    self.assertEquals(
+        u'<entry> <id>1</id> </entry>',
+        rules.canonicalize(u'\n<entry>\n  <id>1</id>\t\r\n</entry>  '))
+
+  def testNoRules(self):
+    """Tests that content is left alone when there are no rules."""
+    content = '<entry>  <a href="http://a.com/?utm_source=x"/></entry>'
+    self.assertEquals(
+        content, feed_diff.CanonicalizationRules().canonicalize(content))
+
+
 if __name__ == '__main__':
   ## feed_diff.DEBUG = True
   ## logging.getLogger().setLevel(logging.DEBUG)
@@ -30,6 +30,14 @@ import xml.sax.saxutils
 # Set to true to see stack level messages and other debugging information.
 DEBUG = False
 
+# Number of bytes to hand to the parser at a time. Parsing stops as soon as the
+# feed's ID has been found, so most of a large document is never looked at.
+PARSE_CHUNK_SIZE = 4096
+
+
+class StopParsing(Exception):
+  """Raised by a handler once the feed's ID has been found."""
+
 
 class TrivialEntityResolver(xml.sax.handler.EntityResolver):
   """Pass-through entity resolver."""
@@ -71,6 +79,7 @@ class FeedIdentifier(xml.sax.handler.ContentHandler):
   def endElement(self, name):
     if self.link:
       self.capture_next_element = False
+      raise StopParsing()
     else:
       if DEBUG: logging.debug('End stack level %r', name)
       self.tag_stack.pop()
@@ -103,12 +112,17 @@ class RssFeedIdentifier(FeedIdentifier):
       [re.compile(k).match for k in ('channel', 'link')])
 
 
-def identify(data, format):
+def identify(data, format, partial=False):
   """Identifies a feed.
 
+  The document is parsed incrementally and parsing stops as soon as the ID
+  has been found.
+
   Args:
     data: String containing the data of the XML feed to parse.
     format: String naming the format of the data. Should be 'rss' or 'atom'.
+    partial: True if data is only a prefix of the document, such as the
+      result of a Range request, so it is not expected to be complete.
 
   Returns:
     The ID of the feed, or None if one could not be determined (due to parse
@@ -117,7 +131,6 @@ def identify(data, format):
   Raises:
     xml.sax.SAXException on parse errors.
   """
-  data_stream = cStringIO.StringIO(data)
   parser = xml.sax.make_parser()
 
   if format == 'atom':
@@ -129,7 +142,14 @@ def identify(data, format):
 
   parser.setContentHandler(handler)
   parser.setEntityResolver(TrivialEntityResolver())
-  parser.parse(data_stream)
+  try:
+    # Always feed at least once so empty documents are reported as errors.
+    for position in xrange(0, max(len(data), 1), PARSE_CHUNK_SIZE):
+      parser.feed(data[position:position+PARSE_CHUNK_SIZE])
+    if not partial:
+      parser.close()
+  except StopParsing:
+    pass
 
   return handler.get_link()
 
@@ -103,6 +103,39 @@ class RssTest(TestBase):
                       'rss')
 
 
+class IncrementalTest(TestBase):
+  """Tests for stopping parsing early and parsing document prefixes."""
+
+  def testStopsAtFeedId(self):
+    """Tests that the rest of the document isn't parsed once the ID is found."""
+    data = '<feed><id>my-id</id><entry><this is not xml'
+    self.assertEquals('my-id', feed_identifier.identify(data, 'atom'))
+    data = '<rss><channel><link>my-link</link><item><not xml'
+    self.assertEquals('my-link', feed_identifier.identify(data, 'rss'))
+
+  def testLargeDocument(self):
+    """Tests finding an ID that spans chunks of the document."""
+    data = '<feed><title>%s</title><id>my-id</id></feed>' % (
+        'x' * (feed_identifier.PARSE_CHUNK_SIZE - 20))
+    self.assertEquals('my-id', feed_identifier.identify(data, 'atom'))
+
+  def testPartial(self):
+    """Tests parsing only a prefix of a document."""
+    data = self.load('parsing.xml')[:1000]
+    self.assertRaises(xml.sax.SAXParseException,
+                      feed_identifier.identify, data[:20], 'atom')
+    self.assertEquals(
+        'tag:diveintomark.org,2001-07-29:/',
+        feed_identifier.identify(data, 'atom', partial=True))
+    self.assertTrue(
+        feed_identifier.identify(data[:20], 'atom', partial=True) is None)
+
+  def testEmpty(self):
+    """Tests that empty documents are parse errors."""
+    self.assertRaises(xml.sax.SAXParseException,
+                      feed_identifier.identify, '', 'atom')
+
+
 if __name__ == '__main__':
   feed_identifier.DEBUG = True
   unittest.main()
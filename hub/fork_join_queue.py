@@ -93,6 +93,8 @@ from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import db
 
+import storage_codec
+
 # TODO: Consider using multiple work indexes to alleviate the memcache
 # hotspot for the writer path.
 
@@ -475,8 +477,8 @@ class MemcacheForkJoinQueue(ShardedForkJoinQueue):
     start = end - len(entity_list)
     key_map = {}
     for number, entity in zip(xrange(start, end), entity_list):
-      key_map[self._create_index_key(index, number)] = db.model_to_protobuf(
-          entity)
+      key_map[self._create_index_key(index, number)] = storage_codec.encode(
+          db.model_to_protobuf(entity).Encode())
 
     result = memset(key_map, time=self.expiration_seconds)
     if result:
@@ -503,6 +505,9 @@ class MemcacheForkJoinQueue(ShardedForkJoinQueue):
       proto = results.get(key)
       if not proto:
         continue
+      # Items put before they were encoded are stored as EntityProtos.
+      if isinstance(proto, str):
+        proto = storage_codec.decode(proto)
       try:
         result_list.append(db.model_from_protobuf(proto))
       except ProtocolBuffer.ProtocolBufferDecodeError:
@@ -34,12 +34,14 @@ from google.appengine.ext import db
 from google.appengine.ext import webapp
 
 import fork_join_queue
+import storage_codec
 
 ################################################################################
 
 class TestModel(db.Model):
   work_index = db.IntegerProperty()
   number = db.IntegerProperty()
+  text = db.TextProperty()
 
 
 TEST_QUEUE = fork_join_queue.ForkJoinQueue(
@@ -519,6 +521,29 @@ class ForkJoinQueueTest(unittest.TestCase):
     result_list = MEMCACHE_QUEUE.pop_request(request)
     self.assertEquals([1, 3], [r.number for r in result_list])
 
+  def testMemcacheQueue_Encoded(self):
+    """Tests that work items are compressed in memcache."""
+    work_index = MEMCACHE_QUEUE.next_index()
+    work_items = [TestModel(key=db.Key.from_path(TestModel.kind(), i),
+                            work_index=work_index, number=i,
+                            text='my text' * 1000)
+                  for i in xrange(1, 3)]
+    MEMCACHE_QUEUE.put(work_index, work_items)
+    value = memcache.get(MEMCACHE_QUEUE._create_index_key(work_index, 0))
+    self.assertEquals(storage_codec.MARKER, value[0])
+    self.assertTrue(len(value) < 1000)
+
+    # Items put before they were encoded.
+    memcache.set(MEMCACHE_QUEUE._create_index_key(work_index, 1),
+                 db.model_to_protobuf(work_items[1]))
+
+    request = testutil.create_test_request('POST', None)
+    os.environ['HTTP_X_APPENGINE_TASKNAME'] = \
+        self.expect_task(work_index)['name']
+    result_list = MEMCACHE_QUEUE.pop_request(request)
+    self.assertEquals([1, 2], [r.number for r in result_list])
+    self.assertEquals('my text' * 1000, result_list[0].text)
+
   def testMemcacheQueue_PopDecodeError(self):
     """Tests when proto decoding fails on the pop() call."""
     work_index = MEMCACHE_QUEUE.next_index()
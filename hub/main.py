@@ -38,6 +38,9 @@
 * KnownFeedStats: Statistics about a topic URL. Used to provide subscriber
   counts to publishers on feed fetch.
 
+* SubscriberCountShard: One shard of the count of a topic's verified
+  subscribers, which is summed into its KnownFeedStats.
+
 * FeedRecord: Metadata information about a feed, the last time it was polled,
   and any headers that may affect future polling. Also contains any debugging
   information about the last feed fetch and why it may have failed.
@@ -45,6 +48,9 @@
 * FeedEntryRecord: Record of a single entry in a single feed. May eventually
   be garbage collected after enough time has passed since it was last seen.
 
+* FeedContinuation: A feed document with more new entries than one parse may
+  save, kept so the rest can be parsed without fetching it again.
+
 * EventToDeliver: Work item that contains the content to deliver for a feed
   event. Maintains current position in subscribers and number of delivery
   failures. Used to coordinate delivery retries. Will be deleted in successful
@@ -61,7 +67,9 @@ of simultaneous subscriptions for the same topic URL. FeedToFetch is also in
 its own entity group for the same reason. FeedRecord, FeedEntryRecord, and
 EventToDeliver entries are all in the same entity group, however, to ensure that
 each feed polling is either full committed and delivered to subscribers or fails
-and will be retried at a later time.
+and will be retried at a later time. Only the FeedRecord, with its digest of
+seen entries, and the EventToDeliver are written in that transaction; the
+FeedEntryRecords are written after it commits.
 
                   ------------
                  | FeedRecord |
@@ -83,6 +91,7 @@ and will be retried at a later time.
 # - Do not poll a feed if we've gotten an event from the publisher in less
 #   than the polling period.
 
+import bisect
 import datetime
 import gc
 import hashlib
@@ -90,7 +99,9 @@ import hmac
 import logging
 import os
 import random
+import re
 import sgmllib
+import struct
 import time
 import traceback
 import urllib
@@ -99,25 +110,30 @@ import wsgiref.handlers
 import xml.sax
 
 from google.appengine import runtime
+from google.appengine.api import datastore
 from google.appengine.api import datastore_types
 from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from google.appengine.api import urlfetch_errors
 from google.appengine.api import taskqueue
 from google.appengine.api import users
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 from google.appengine.runtime import apiproxy_errors
 
 import async_apiproxy
+import datastore_async
 import dos
 import feed_diff
 import feed_identifier
 import fork_join_queue
+import storage_codec
 import urlfetch_async
 
 import mapreduce.control
+import mapreduce.mapreduce_pipeline
 import mapreduce.model
 
 async_proxy = async_apiproxy.AsyncAPIProxy()
@@ -154,6 +170,9 @@ DELIVERY_RETRY_PERIOD = 30 # seconds
 # Period at which feed IDs should be refreshed.
 FEED_IDENTITY_UPDATE_PERIOD = (20 * 24 * 60 * 60) # 20 days
 
+# Number of bytes at the start of a feed to request when looking for its ID.
+FEED_IDENTITY_PREFIX_BYTES = 64 * 1024
+
 # Number of polling feeds to fetch from the Datastore at a time.
 BOOSTRAP_FEED_CHUNK_SIZE = 50
 
@@ -192,10 +211,163 @@ MAX_FEED_ENTRY_RECORD_LOOKUPS = 500
 # a new EventToDeliver is being written.
 MAX_FEED_RECORD_SAVES = 100
 
+# Maximum total bytes of encoded entities to save at the same time when a new
+# EventToDeliver is being written. Leaves headroom below the Datastore API's
+# request size limit for the rest of the request.
+MAX_FEED_RECORD_SAVE_BYTES = 900000
+
 # Maximum number of new FeedEntryRecords to process and insert at a time. Any
 # remaining will be split into another EventToDeliver instance.
 MAX_NEW_FEED_ENTRY_RECORDS = 200
 
+# Number of consecutive, already-seen entries after which feed diffing stops
+# parsing the rest of a feed document. Zero disables stopping early.
+MAX_SEEN_ENTRY_RUN = 10
+
+# Number of days after which a feed document is diffed in full again, without
+# stopping at a run of seen entries, so the entries after the run are marked
+# as seen too. Must be well under the age_days of the job that prunes
+# FeedEntryRecords by when their entries were last seen.
+FULL_DIFF_INTERVAL_DAYS = 7
+
+# Number of parsed entries to look up in FeedEntryRecord at a time when
+# diffing feeds incrementally.
+INCREMENTAL_DIFF_BATCH_SIZE = 10
+
+# Number of bytes of the sha1 hashes of an entry's ID and of its content that
+# are kept in a FeedRecord's packed digest of seen entries.
+SEEN_ENTRY_DIGEST_BYTES = 8
+
+# Maximum number of entries remembered in a FeedRecord's digest of seen
+# entries. When full, the entries that were seen longest ago are forgotten,
+# except that a digest never shrinks below the number of entries it held or
+# that were seen while diffing a single document.
+MAX_SEEN_ENTRIES = 5000
+
+# Hard limit on the number of entries in a digest of seen entries, which keeps
+# the FeedRecord well below the Datastore's entity size limit even for feed
+# documents with more entries than MAX_SEEN_ENTRIES.
+SEEN_ENTRY_LIMIT = 30000
+
+# Whether to still write a FeedEntryRecord for each new or updated entry. The
+# FeedRecord's digest of seen entries is used for diffing either way; this only
+# keeps the per-entry records around as a fallback.
+SAVE_FEED_ENTRY_RECORDS = False
+
+# Rules for masking the volatile parts of entries, like timestamps or tracking
+# parameters, before their content is hashed to find changed entries. Keys are
+# topic URLs or domains; the rules for a domain also apply to its subdomains
+# and the '' key applies to all topics. Values are instances of
+# feed_diff.CanonicalizationRules. For example:
+#   {'example.com': feed_diff.CanonicalizationRules(
+#        ignore_elements=['updated'], strip_query_params=['utm_*'])}
+CONTENT_HASH_RULES = {}
+
+# Maximum bytes of new or updated entry payloads held in memory while diffing a
+# single feed document. Once reached, parsing stops and only the entries found
+# so far are delivered; the rest are picked up by continuing the parse.
+MAX_FEED_PARSE_BYTES = 1024 * 1024
+
+# Maximum bytes of an encoded feed document to keep for continuing its parse
+# when it has more new entries than MAX_NEW_FEED_ENTRY_RECORDS or
+# MAX_FEED_PARSE_BYTES allow at once. Larger documents are fetched again.
+MAX_FEED_CONTINUATION_BYTES = 900000
+
+# Maximum bytes of feed documents fetched and parsed by a single feed pull
+# batch. Each fetch reserves the size of its feed's last document before it
+# starts, and feeds that don't fit are retried in tasks of their own without
+# being fetched. Documents that turn out larger than reserved and go over are
+# kept for a task to parse, like a cut-off parse, instead of being fetched
+# again.
+MAX_FETCH_BATCH_BYTES = 4 * 1024 * 1024
+
+# Feed documents larger than this are reported as over budget. They are still
+# parsed, keeping only the first new entries that fit in MAX_FEED_PARSE_BYTES,
+# but are too large to keep for continuing the parse, so the rest of their new
+# entries are found when the fetch is retried.
+MAX_FEED_DOCUMENT_BYTES = 4 * 1024 * 1024
+
+# Number of worker processes that parse and diff fetched feeds, so one large
+# feed doesn't hold up the rest of a pull batch. Only for deployments that can
+# use the multiprocessing module, which App Engine can't. Zero parses feeds
+# inline in the fetch callbacks.
+PARSE_POOL_SIZE = 0
+
+# How long memcache remembers that a topic has verified subscribers. Adding a
+# subscription refreshes this right away and removing one clears it, so this
+# only bounds how long a missed update can linger.
+HAS_SUBSCRIBERS_CACHE_SECONDS = (60 * 60)  # 1 hour
+
+# How long memcache remembers that a topic has no verified subscribers. Kept
+# short because a new subscription that fails to update memcache would have its
+# feed ignored until this runs out.
+NO_SUBSCRIBERS_CACHE_SECONDS = 60
+
+# Maximum number of topics whose URL aliases each instance keeps in memory.
+TOPIC_ALIAS_LOCAL_CACHE_SIZE = 10000
+
+# How long an instance keeps a topic's URL aliases in memory. Changes to the
+# aliases only clear the memory of the instance that made them, so this bounds
+# how long the other instances can publish to a stale set of aliases.
+TOPIC_ALIAS_LOCAL_CACHE_SECONDS = 60
+
+# How long memcache remembers a topic's URL aliases, or that it has none.
+TOPIC_ALIAS_CACHE_SECONDS = (10 * 60)  # 10 minutes
+
+# Whether publish pings enqueue every valid topic URL for fetching without
+# first checking that it's a known feed or looking up its aliases. The check is
+# made by the feed pull worker for its whole batch instead, so answering a ping
+# only needs memcache and task queue calls.
+DEFER_PUBLISH_FILTERING = False
+
+# How long memcache keeps FeedRecords. They are replaced in memcache whenever
+# a feed pull writes them, so this only limits how long unused ones stay.
+FEED_RECORD_CACHE_SECONDS = (24 * 60 * 60)  # 1 day
+
+# How long memcache keeps SubscriberCountShards. They are replaced in memcache
+# whenever a subscription change writes them, so this only limits how long
+# unused ones stay.
+FEED_STATS_CACHE_SECONDS = (60 * 60)  # 1 hour
+
+# Number of shards each topic's subscriber count is split into. Each shard is
+# its own entity group, so this limits how many subscription changes per
+# second a single topic can sustain. Must be at least 2, since the first shard
+# is only written by the offline job.
+SUBSCRIBER_COUNT_SHARD_COUNT = 4
+
+# Number of shards each topic's SubscriberRoster is split into. Each shard
+# covers a contiguous range of callback hashes and must stay well under the
+# 1MB entity size limit for the largest topics.
+ROSTER_SHARD_COUNT = 256
+
+# Topics with at least this many verified subscribers are given a roster by
+# the offline roster job. Smaller topics page through Subscription queries.
+ROSTER_MIN_SUBSCRIBERS = 1000
+
+# How many roster shards to retrieve in a single batch get during delivery.
+ROSTER_READ_BATCH_SIZE = 8
+
+# How many Subscriptions to retrieve in a single query while rebuilding a
+# roster shard.
+MAX_ROSTER_REFRESH_LOOKUPS = 500
+
+# How long after an EventPayload was last written a new event with the same
+# payload, or a delivery pass of an event using it, will rewrite it to push
+# back its offline cleanup. The cleanup job must keep payloads at least this
+# much longer than events, plus however long a delivery pass may take.
+EVENT_PAYLOAD_REFRESH_SECONDS = (24 * 60 * 60)  # 1 day
+
+# Maximum number of event payloads each instance keeps in memory. Payloads
+# may be up to a few megabytes each, so keep this small.
+EVENT_PAYLOAD_LOCAL_CACHE_SIZE = 20
+
+# How long an instance keeps an event payload in memory. Payloads never
+# change, so this only limits how long unused ones take up memory.
+EVENT_PAYLOAD_LOCAL_CACHE_SECONDS = (10 * 60)  # 10 minutes
+
+# How long memcache keeps event payloads.
+EVENT_PAYLOAD_CACHE_SECONDS = (60 * 60)  # 1 hour
+
 ################################################################################
 # URL scoring Parameters
 
@@ -330,7 +502,94 @@ FETCH_DOMAIN_SAMPLE_DAY_LATENCY = dos.ReservoirConfig(
     value_units='ms')
 
 
-def report_fetch(reporter, url, success, latency):
+FETCH_URL_SAMPLE_MINUTE_UNCHANGED = dos.ReservoirConfig(
+    'fetch_url_1m_unchanged',
+    period=60,
+    samples=10000,
+    by_url=True,
+    value_units='% unchanged')
+
+FETCH_URL_SAMPLE_30_MINUTE_UNCHANGED = dos.ReservoirConfig(
+    'fetch_url_30m_unchanged',
+    period=1800,
+    samples=10000,
+    by_url=True,
+    value_units='% unchanged')
+
+FETCH_URL_SAMPLE_HOUR_UNCHANGED = dos.ReservoirConfig(
+    'fetch_url_1h_unchanged',
+    period=3600,
+    samples=10000,
+    by_url=True,
+    value_units='% unchanged')
+
+FETCH_URL_SAMPLE_DAY_UNCHANGED = dos.ReservoirConfig(
+    'fetch_url_1d_unchanged',
+    period=86400,
+    samples=10000,
+    by_url=True,
+    value_units='% unchanged')
+
+FETCH_DOMAIN_SAMPLE_MINUTE_UNCHANGED = dos.ReservoirConfig(
+    'fetch_domain_1m_unchanged',
+    period=60,
+    samples=10000,
+    by_domain=True,
+    value_units='% unchanged')
+
+FETCH_DOMAIN_SAMPLE_30_MINUTE_UNCHANGED = dos.ReservoirConfig(
+    'fetch_domain_30m_unchanged',
+    period=1800,
+    samples=10000,
+    by_domain=True,
+    value_units='% unchanged')
+
+FETCH_DOMAIN_SAMPLE_HOUR_UNCHANGED = dos.ReservoirConfig(
+    'fetch_domain_1h_unchanged',
+    period=3600,
+    samples=10000,
+    by_domain=True,
+    value_units='% unchanged')
+
+FETCH_DOMAIN_SAMPLE_DAY_UNCHANGED = dos.ReservoirConfig(
+    'fetch_domain_1d_unchanged',
+    period=86400,
+    samples=10000,
+    by_domain=True,
+    value_units='% unchanged')
+
+
+FETCH_URL_SAMPLE_HOUR_OVER_BUDGET = dos.ReservoirConfig(
+    'fetch_url_1h_over_budget',
+    period=3600,
+    samples=10000,
+    by_url=True,
+    value_units='% over budget')
+
+FETCH_URL_SAMPLE_DAY_OVER_BUDGET = dos.ReservoirConfig(
+    'fetch_url_1d_over_budget',
+    period=86400,
+    samples=10000,
+    by_url=True,
+    value_units='% over budget')
+
+FETCH_DOMAIN_SAMPLE_HOUR_OVER_BUDGET = dos.ReservoirConfig(
+    'fetch_domain_1h_over_budget',
+    period=3600,
+    samples=10000,
+    by_domain=True,
+    value_units='% over budget')
+
+FETCH_DOMAIN_SAMPLE_DAY_OVER_BUDGET = dos.ReservoirConfig(
+    'fetch_domain_1d_over_budget',
+    period=86400,
+    samples=10000,
+    by_domain=True,
+    value_units='% over budget')
+
+
+def report_fetch(reporter, url, success, latency, unchanged=False,
+                 over_budget=False):
   """Reports statistics information for a feed fetch.
 
   Args:
@@ -338,6 +597,11 @@ def report_fetch(reporter, url, success, latency):
     url: The URL of the topic URL that was fetched.
     success: True if the fetch was successful, False otherwise.
     latency: End-to-end fetch latency in milliseconds.
+    unchanged: True if the feed's body was identical to the last one parsed,
+      so parsing and diffing were skipped.
+    over_budget: True if the feed was only partially parsed, was deferred, or
+      was larger than MAX_FEED_PARSE_BYTES, MAX_FETCH_BATCH_BYTES, or
+      MAX_FEED_DOCUMENT_BYTES allow.
   """
   value = 100 * int(not success)
   reporter.set(url, FETCH_URL_SAMPLE_MINUTE, value)
@@ -356,6 +620,34 @@ def report_fetch(reporter, url, success, latency):
   reporter.set(url, FETCH_DOMAIN_SAMPLE_30_MINUTE_LATENCY, latency)
   reporter.set(url, FETCH_DOMAIN_SAMPLE_HOUR_LATENCY, latency)
   reporter.set(url, FETCH_DOMAIN_SAMPLE_DAY_LATENCY, latency)
+  value = 100 * int(unchanged)
+  reporter.set(url, FETCH_URL_SAMPLE_MINUTE_UNCHANGED, value)
+  reporter.set(url, FETCH_URL_SAMPLE_30_MINUTE_UNCHANGED, value)
+  reporter.set(url, FETCH_URL_SAMPLE_HOUR_UNCHANGED, value)
+  reporter.set(url, FETCH_URL_SAMPLE_DAY_UNCHANGED, value)
+  reporter.set(url, FETCH_DOMAIN_SAMPLE_MINUTE_UNCHANGED, value)
+  reporter.set(url, FETCH_DOMAIN_SAMPLE_30_MINUTE_UNCHANGED, value)
+  reporter.set(url, FETCH_DOMAIN_SAMPLE_HOUR_UNCHANGED, value)
+  reporter.set(url, FETCH_DOMAIN_SAMPLE_DAY_UNCHANGED, value)
+  report_over_budget(reporter, url, over_budget)
+
+
+def report_over_budget(reporter, url, over_budget=True):
+  """Reports whether a feed fetch went over its budget.
+
+  Used on its own for feeds that are deferred before they are fetched, so
+  there is no latency to report.
+
+  Args:
+    reporter: dos.Reporter instance.
+    url: The URL of the topic URL that was fetched.
+    over_budget: True if the feed went over its budget.
+  """
+  value = 100 * int(over_budget)
+  reporter.set(url, FETCH_URL_SAMPLE_HOUR_OVER_BUDGET, value)
+  reporter.set(url, FETCH_URL_SAMPLE_DAY_OVER_BUDGET, value)
+  reporter.set(url, FETCH_DOMAIN_SAMPLE_HOUR_OVER_BUDGET, value)
+  reporter.set(url, FETCH_DOMAIN_SAMPLE_DAY_OVER_BUDGET, value)
 
 
 FETCH_SAMPLER = dos.MultiSampler([
@@ -375,6 +667,18 @@ FETCH_SAMPLER = dos.MultiSampler([
     FETCH_DOMAIN_SAMPLE_30_MINUTE_LATENCY,
     FETCH_DOMAIN_SAMPLE_HOUR_LATENCY,
     FETCH_DOMAIN_SAMPLE_DAY_LATENCY,
+    FETCH_URL_SAMPLE_MINUTE_UNCHANGED,
+    FETCH_URL_SAMPLE_30_MINUTE_UNCHANGED,
+    FETCH_URL_SAMPLE_HOUR_UNCHANGED,
+    FETCH_URL_SAMPLE_DAY_UNCHANGED,
+    FETCH_DOMAIN_SAMPLE_MINUTE_UNCHANGED,
+    FETCH_DOMAIN_SAMPLE_30_MINUTE_UNCHANGED,
+    FETCH_DOMAIN_SAMPLE_HOUR_UNCHANGED,
+    FETCH_DOMAIN_SAMPLE_DAY_UNCHANGED,
+    FETCH_URL_SAMPLE_HOUR_OVER_BUDGET,
+    FETCH_URL_SAMPLE_DAY_OVER_BUDGET,
+    FETCH_DOMAIN_SAMPLE_HOUR_OVER_BUDGET,
+    FETCH_DOMAIN_SAMPLE_DAY_OVER_BUDGET,
 ])
 
 ################################################################################
@@ -565,6 +869,8 @@ SUBSCRIPTION_QUEUE = 'subscriptions'
 
 MAPPINGS_QUEUE = 'mappings'
 
+ENTRY_RECORDS_QUEUE = 'entry-records'
+
 ################################################################################
 # Helper functions
 
@@ -609,6 +915,28 @@ def sha1_hash(value):
   return hashlib.sha1(utf8encoded(value)).hexdigest()
 
 
+# Whitespace around the brackets of markup, which is ignored when
+# fingerprinting feed documents.
+MARKUP_WHITESPACE_RE = re.compile(r'\s*([<>])\s*')
+
+
+def get_content_fingerprints(content):
+  """Returns fingerprints of a feed document for detecting identical bodies.
+
+  Args:
+    content: The feed document.
+
+  Returns:
+    Tuple (content_hash, normalized_hash) with the sha1 hash of the raw
+    document and the sha1 hash of the document with whitespace next to its
+    markup removed and every other run of whitespace collapsed to a single
+    space. Whitespace within text is kept, so documents that only differ in
+    where words are split are not considered the same.
+  """
+  normalized = MARKUP_WHITESPACE_RE.sub(r'\1', ' '.join(content.split()))
+  return sha1_hash(content), sha1_hash(normalized)
+
+
 def get_hash_key_name(value):
   """Returns a valid entity key_name that's a hash of the supplied value."""
   return 'hash_' + sha1_hash(value)
@@ -683,6 +1011,203 @@ def get_random_challenge():
   """Returns a string containing a random challenge token."""
   return ''.join(random.choice(_VALID_CHARS) for i in xrange(128))
 
+class LruCache(object):
+  """In-memory cache local to an instance, with entries that expire.
+
+  Once full, the least recently used entries are evicted. Entries are not
+  shared between instances, so they should only live as long as serving a
+  value that has been changed elsewhere is acceptable.
+  """
+
+  def __init__(self, max_size, ttl_seconds, now=time.time):
+    """Initializer.
+
+    Args:
+      max_size: Maximum number of entries to keep.
+      ttl_seconds: Seconds after which an entry expires.
+      now: Callable that returns the current time in seconds. Used for testing.
+    """
+    self.max_size = max_size
+    self.ttl_seconds = ttl_seconds
+    self.now = now
+    self.clear()
+
+  def clear(self):
+    """Removes all entries."""
+    # Maps keys to lists [last_use, expiration_time, value].
+    self.entries = {}
+    self.uses = 0
+
+  def get(self, key, default=None):
+    """Returns the value for a key, or default if missing or expired."""
+    entry = self.entries.get(key)
+    if entry is None:
+      return default
+    if entry[1] <= self.now():
+      del self.entries[key]
+      return default
+    self.uses += 1
+    entry[0] = self.uses
+    return entry[2]
+
+  def set(self, key, value):
+    """Sets the value for a key, evicting old entries if full."""
+    self.uses += 1
+    self.entries[key] = [self.uses, self.now() + self.ttl_seconds, value]
+    if len(self.entries) > self.max_size:
+      # Evict a quarter of the entries at once so sorting them is rare.
+      by_use = sorted(self.entries.iteritems(), key=lambda item: item[1][0])
+      for old_key, entry in by_use[:len(by_use) - self.max_size * 3 // 4]:
+        del self.entries[old_key]
+
+  def delete(self, key):
+    """Removes the entry for a key, if any."""
+    self.entries.pop(key, None)
+
+
+class EntityCache(object):
+  """Read-through and write-through memcache layer for entities of a model.
+
+  Entities are cached as encoded protocol buffers, each stamped with the
+  version number that memcache had for it when it was read. Writers bump the
+  version once their write has committed, so a reader that raced with the
+  write can't leave the older entity cached: its stamp no longer matches.
+  """
+
+  # Encoded entities larger than this are not cached; memcache values are
+  # limited to 1MB.
+  MAX_VALUE_BYTES = 1000000
+
+  def __init__(self, prefix, expiration_seconds):
+    """Initializer.
+
+    Args:
+      prefix: Prefix of the memcache keys used by this cache.
+      expiration_seconds: How long memcache keeps cached entities.
+    """
+    self.prefix = prefix
+    self.expiration_seconds = expiration_seconds
+
+  def get_names(self, key):
+    """Returns the memcache keys (entity, version) for a db.Key."""
+    names = []
+    while key is not None:
+      names.insert(0, str(key.id_or_name()))
+      key = key.parent()
+    name = '/'.join(names)
+    return ('%s:%s' % (self.prefix, name),
+            '%s_version:%s' % (self.prefix, name))
+
+  def encode(self, version, model):
+    """Returns the memcache value for an entity, or None if too large."""
+    encoded = db.model_to_protobuf(model).Encode()
+    if len(encoded) > self.MAX_VALUE_BYTES:
+      return None
+    return (version, encoded)
+
+  def get(self, key_list, async_proxy=None, callback=None):
+    """Retrieves entities from memcache, or the Datastore on a miss.
+
+    Args:
+      key_list: List of db.Key instances to retrieve.
+      async_proxy: If not None, AsyncAPIProxy to use for retrieving the
+        entities missing from memcache asynchronously, in which case callback
+        is required.
+      callback: Callable that takes (model_list, exception), where model_list
+        is what would have been returned. Exactly one of the two arguments is
+        None. Called before this method returns if all entities were cached.
+
+    Returns:
+      List of db.Model instances in the same order as key_list, with None for
+      each entity that does not exist; None if async_proxy was supplied.
+    """
+    name_list = [self.get_names(k) for k in key_list]
+    found = memcache.get_multi([n for pair in name_list for n in pair])
+    model_list = []
+    # Maps the index of each key that missed to the version that its entity
+    # will be cached with, or None if it will not be cached.
+    stamps = {}
+    new_versions = {}
+    for index, (entity_name, version_name) in enumerate(name_list):
+      version = found.get(version_name)
+      cached = found.get(entity_name)
+      if version is not None and cached is not None and cached[0] == version:
+        model_list.append(
+            db.model_from_protobuf(entity_pb.EntityProto(cached[1])))
+        continue
+      model_list.append(None)
+      stamps[index] = version
+      if version is None:
+        new_versions[version_name] = random.randint(0, 2**31)
+    if new_versions:
+      # Entities that had no version are cached by the next read.
+      memcache.add_multi(new_versions)
+
+    missing = sorted(stamps)
+    def fill(found_list):
+      to_cache = {}
+      for index, model in zip(missing, found_list):
+        model_list[index] = model
+        if model is None or stamps[index] is None:
+          continue
+        value = self.encode(stamps[index], model)
+        if value is not None:
+          to_cache[name_list[index][0]] = value
+      if to_cache:
+        memcache.set_multi(to_cache, time=self.expiration_seconds)
+      return model_list
+
+    if async_proxy is None:
+      if missing:
+        fill(db.get([key_list[i] for i in missing]))
+      return model_list
+
+    if not missing:
+      callback(model_list, None)
+      return
+    def get_callback(found_list, exception):
+      if exception:
+        callback(None, exception)
+      else:
+        callback(fill(found_list), None)
+    datastore_async.get([key_list[i] for i in missing], async_proxy,
+                        get_callback)
+
+  def put(self, model_list):
+    """Caches entities that have just been written to the Datastore.
+
+    Must only be called once the write has committed.
+
+    Args:
+      model_list: List of db.Model instances that were written.
+    """
+    name_list = [self.get_names(m.key()) for m in model_list]
+    versions = memcache.offset_multi(dict((v, 1) for e, v in name_list))
+    to_cache = {}
+    for model, (entity_name, version_name) in zip(model_list, name_list):
+      version = versions.get(version_name)
+      if version is None:
+        continue
+      value = self.encode(version, model)
+      if value is not None:
+        to_cache[entity_name] = value
+    if to_cache:
+      memcache.set_multi(to_cache, time=self.expiration_seconds)
+
+  def invalidate(self, key_list):
+    """Invalidates cached entities that may have been written.
+
+    Args:
+      key_list: List of db.Key instances of the entities.
+    """
+    memcache.offset_multi(
+        dict((self.get_names(k)[1], 1) for k in key_list))
+
+
+# Caches of the FeedRecord and SubscriberCountShards read by each feed pull.
+FEED_RECORD_CACHE = EntityCache('feed_record', FEED_RECORD_CACHE_SECONDS)
+FEED_STATS_CACHE = EntityCache('feed_stats', FEED_STATS_CACHE_SECONDS)
+
 ################################################################################
 # Models
 
@@ -714,6 +1239,35 @@ class Subscription(db.Model):
   subscription_state = db.StringProperty(default=STATE_NOT_VERIFIED,
                                          choices=STATES)
 
+  # Prefix of the memcache keys that cache whether a topic has subscribers.
+  HAS_SUBSCRIBERS_PREFIX = 'has_subscribers:'
+
+  @classmethod
+  def has_subscribers_key(cls, topic):
+    """Returns the memcache key caching whether a topic has subscribers.
+
+    Args:
+      topic: URL of the topic.
+
+    Returns:
+      String containing the memcache key.
+    """
+    return cls.HAS_SUBSCRIBERS_PREFIX + sha1_hash(topic)
+
+  @classmethod
+  def forget_subscribers(cls, topic_list):
+    """Clears the cached subscriber presence for a set of topics.
+
+    The next has_subscribers call for these topics will query the Datastore.
+
+    Args:
+      topic_list: Iterable of topic URLs.
+    """
+    keys = set(cls.has_subscribers_key(t) for t in topic_list)
+    if keys and not memcache.delete_multi(list(keys)):
+      logging.error('Could not clear subscriber presence for topics %r',
+                    topic_list)
+
   @staticmethod
   def create_key_name(callback, topic):
     """Returns the key name for a Subscription entity.
@@ -773,14 +1327,22 @@ class Subscription(db.Model):
                   hash_func=hash_func,
                   lease_seconds=lease_seconds,
                   expiration_time=now_time)
+      newly_verified = sub.subscription_state != cls.STATE_VERIFIED
       sub.subscription_state = cls.STATE_VERIFIED
       sub.expiration_time = now_time + datetime.timedelta(seconds=lease_seconds)
       sub.confirm_failures = 0
       sub.verify_token = verify_token
       sub.secret = secret
       sub.put()
-      return sub_is_new
-    return db.run_in_transaction(txn)
+      return sub_is_new, newly_verified
+    sub_is_new, newly_verified = db.run_in_transaction(txn)
+    if not memcache.set(cls.has_subscribers_key(topic), True,
+                        time=HAS_SUBSCRIBERS_CACHE_SECONDS):
+      cls.forget_subscribers([topic])
+    SubscriberRoster.add(callback, topic, secret, verify_token)
+    if newly_verified:
+      SubscriberCountShard.increment(topic, 1)
+    return sub_is_new
 
   @classmethod
   def request_insert(cls,
@@ -862,9 +1424,15 @@ class Subscription(db.Model):
       sub = cls.get_by_key_name(key_name)
       if sub is not None:
         sub.delete()
-        return True
-      return False
-    return db.run_in_transaction(txn)
+        return True, sub.subscription_state == cls.STATE_VERIFIED
+      return False, False
+    removed, was_verified = db.run_in_transaction(txn)
+    if removed:
+      cls.forget_subscribers([topic])
+      SubscriberRoster.discard(callback, topic)
+    if was_verified:
+      SubscriberCountShard.increment(topic, -1)
+    return removed
 
   @classmethod
   def request_remove(cls, callback, topic, verify_token):
@@ -906,11 +1474,18 @@ class Subscription(db.Model):
     key_name = cls.create_key_name(callback, topic)
     def txn():
       sub = cls.get_by_key_name(key_name)
-      if sub is not None:
-        sub.subscription_state = cls.STATE_TO_DELETE
-        sub.confirm_failures = 0
-        sub.put()
-    return db.run_in_transaction(txn)
+      if sub is None:
+        return False
+      was_verified = sub.subscription_state == cls.STATE_VERIFIED
+      sub.subscription_state = cls.STATE_TO_DELETE
+      sub.confirm_failures = 0
+      sub.put()
+      return was_verified
+    was_verified = db.run_in_transaction(txn)
+    cls.forget_subscribers([topic])
+    SubscriberRoster.discard(callback, topic)
+    if was_verified:
+      SubscriberCountShard.increment(topic, -1)
 
   @classmethod
   def has_subscribers(cls, topic):
@@ -922,11 +1497,89 @@ class Subscription(db.Model):
     Returns:
       True if it has verified subscribers, False otherwise.
     """
-    if (cls.all(keys_only=True).filter('topic_hash =', sha1_hash(topic))
-        .filter('subscription_state =', cls.STATE_VERIFIED).get() is not None):
-      return True
-    else:
-      return False
+    return cls.has_subscribers_multi([topic])[0]
+
+  @classmethod
+  def has_subscribers_multi(cls, topic_list, async_proxy=None, callback=None):
+    """Check if each of a set of topic URLs has verified subscribers.
+
+    Answers from memcache where possible and queries the Datastore for the
+    rest. Query results are only added to memcache, never set, so a
+    subscription inserted while the query ran can't be hidden by a stale
+    'no subscribers' answer.
+
+    Args:
+      topic_list: List of topic URLs to check for subscribers.
+      async_proxy: If not None, AsyncAPIProxy to use for running the
+        Datastore queries concurrently, in which case callback is required.
+      callback: Callable that takes (topic, has_subscribers). Called once for
+        each distinct topic as soon as its answer is known, which for cached
+        topics is before this method returns.
+
+    Returns:
+      List of booleans, one for each topic in topic_list, that are True if
+      the topic has verified subscribers and False otherwise; None if
+      async_proxy was supplied.
+    """
+    key_list = [cls.has_subscribers_key(t) for t in topic_list]
+    found = memcache.get_multi(key_list)
+    missing = {}
+    for topic, key in zip(topic_list, key_list):
+      if key not in found:
+        missing[key] = topic
+
+    def cache(answers):
+      present = [k for k, v in answers.iteritems() if v]
+      absent = [k for k, v in answers.iteritems() if not v]
+      if present:
+        memcache.add_multi(dict((k, True) for k in present),
+                           time=HAS_SUBSCRIBERS_CACHE_SECONDS)
+      if absent:
+        memcache.add_multi(dict((k, False) for k in absent),
+                           time=NO_SUBSCRIBERS_CACHE_SECONDS)
+
+    if async_proxy is None:
+      answers = {}
+      for key, topic in missing.iteritems():
+        answers[key] = (
+            cls.all(keys_only=True).filter('topic_hash =', sha1_hash(topic))
+            .filter('subscription_state =', cls.STATE_VERIFIED).get()
+            is not None)
+      cache(answers)
+      found.update(answers)
+      return [bool(found[key]) for key in key_list]
+
+    answered = set()
+    for topic, key in zip(topic_list, key_list):
+      if key in found and key not in answered:
+        answered.add(key)
+        callback(topic, bool(found[key]))
+
+    # Answers are cached together once the last query finishes.
+    answers = {}
+    def create_callback(key, topic):
+      def query_callback(result_list, exception):
+        if exception:
+          # Err toward fetching the feed and don't cache the guess.
+          logging.warning('Could not check for subscribers to topic %r. '
+                          '%s: %s', topic, exception.__class__, exception)
+          has_subscribers = True
+        else:
+          has_subscribers = bool(result_list)
+          answers[key] = has_subscribers
+        del missing[key]
+        if not missing:
+          cache(answers)
+        callback(topic, has_subscribers)
+      return query_callback
+
+    for key, topic in missing.items():
+      query = datastore.Query(cls.kind(), {
+          'topic_hash =': sha1_hash(topic),
+          'subscription_state =': cls.STATE_VERIFIED,
+        }, keys_only=True)
+      datastore_async.run_query(query, 1, async_proxy,
+                                create_callback(key, topic))
 
   @classmethod
   def get_subscribers(cls, topic, count, starting_at_callback=None):
@@ -1040,6 +1693,344 @@ class Subscription(db.Model):
     return db.run_in_transaction(txn)
 
 
+class RosterEntry(object):
+  """A subscriber read from a SubscriberRoster.
+
+  Has the Subscription attributes used for pushing events, so it may be
+  delivered to in place of the Subscription it was derived from.
+  """
+
+  def __init__(self, topic, callback_hash, callback, secret, verify_token):
+    """Initializer.
+
+    Args:
+      topic: URL of the topic subscribed to.
+      callback_hash: Hash of the callback URL.
+      callback: URL of the callback subscriber.
+      secret: Shared secret used for HMACs, or None.
+      verify_token: The subscription's verify token, or None.
+    """
+    self.topic = topic
+    self.callback_hash = callback_hash
+    self.callback = callback
+    self.secret = secret
+    self.verify_token = verify_token
+
+  def key(self):
+    """Returns the db.Key of the corresponding Subscription."""
+    return datastore_types.Key.from_path(
+        Subscription.kind(),
+        Subscription.create_key_name(self.callback, self.topic))
+
+
+class SubscriberRoster(db.Model):
+  """Compact list of a topic's verified subscribers in callback hash order.
+
+  Event delivery only needs a few fields of each Subscription. Rosters keep
+  just those fields so large topics can be paged through without querying
+  full Subscription entities. A topic's roster is split into
+  ROSTER_SHARD_COUNT shards by callback hash range, each in its own entity
+  group. The properties are parallel lists sorted by callback hash.
+
+  Rosters are only created by the offline roster job; Subscription changes
+  keep existing rosters up to date. A topic missing any of its shards, or
+  with shards that are still being built, has no roster and its subscribers
+  must be queried instead. Shards that could not be kept up to date are
+  deleted until the next rebuild for the same reason.
+
+  Every change to a shard increments its version, so the offline job can
+  rebuild a shard without losing changes made while it queried the topic's
+  Subscriptions.
+  """
+
+  callback_hashes = db.StringListProperty(indexed=False)
+  callbacks = db.ListProperty(db.Text)
+  secrets = db.ListProperty(db.Text)
+  verify_tokens = db.ListProperty(db.Text)
+  version = db.IntegerProperty(default=0, indexed=False)
+  # True until the offline job has filled in a shard that it created empty.
+  building = db.BooleanProperty(default=False, indexed=False)
+
+  @classmethod
+  def create_key(cls, topic_hash, shard):
+    """Creates a key for a shard of a topic's roster.
+
+    Args:
+      topic_hash: Hash of the topic URL.
+      shard: Index of the shard.
+
+    Returns:
+      db.Key instance.
+    """
+    return datastore_types.Key.from_path(
+        cls.kind(), 'hash_%s/%d' % (topic_hash, shard))
+
+  @staticmethod
+  def get_shard(callback_hash):
+    """Returns the index of the shard containing a callback hash."""
+    return int(callback_hash[:4], 16) * ROSTER_SHARD_COUNT // 0x10000
+
+  @classmethod
+  def build(cls, topic_hash, entry_list):
+    """Creates a complete roster for a topic.
+
+    Args:
+      topic_hash: Hash of the topic URL.
+      entry_list: List of tuples (callback_hash, callback, secret,
+        verify_token) for each verified subscriber of the topic.
+
+    Returns:
+      List of ROSTER_SHARD_COUNT SubscriberRoster instances that have not been
+      stored, one for each shard.
+    """
+    shard_lists = [([], [], [], []) for i in xrange(ROSTER_SHARD_COUNT)]
+    for callback_hash, callback, secret, verify_token in sorted(entry_list):
+      lists = shard_lists[cls.get_shard(callback_hash)]
+      lists[0].append(callback_hash)
+      lists[1].append(db.Text(callback))
+      lists[2].append(db.Text(secret or ''))
+      lists[3].append(db.Text(verify_token or ''))
+
+    roster_list = []
+    for shard, (hashes, callbacks, secrets, tokens) in enumerate(shard_lists):
+      roster_list.append(cls(key=cls.create_key(topic_hash, shard),
+                             callback_hashes=hashes,
+                             callbacks=callbacks,
+                             secrets=secrets,
+                             verify_tokens=tokens))
+    return roster_list
+
+  def find(self, callback_hash):
+    """Finds where a callback hash is or would be in this shard.
+
+    Returns:
+      Tuple (index, present) where index is the position of the callback hash
+      and present is True if the callback hash is already in this shard.
+    """
+    index = bisect.bisect_left(self.callback_hashes, callback_hash)
+    present = (index < len(self.callback_hashes) and
+               self.callback_hashes[index] == callback_hash)
+    return index, present
+
+  @classmethod
+  def drop_shard(cls, key):
+    """Deletes a roster shard that could not be kept up to date.
+
+    Failures are logged; the shard may then be stale until the next rebuild.
+
+    Args:
+      key: db.Key of the shard.
+    """
+    try:
+      db.delete(key)
+    except (db.Error, apiproxy_errors.Error):
+      logging.exception('Could not delete stale roster shard %s', key.name())
+
+  @classmethod
+  def add(cls, callback, topic, secret, verify_token):
+    """Adds or updates a subscriber in a topic's roster, if it has one.
+
+    Failures are logged and the shard is dropped, so the topic's subscribers
+    are queried until the offline job rebuilds it.
+
+    Args:
+      callback: URL of the callback subscriber.
+      topic: URL of the topic subscribed to.
+      secret: Shared secret used for HMACs, or None.
+      verify_token: The subscription's verify token, or None.
+    """
+    callback_hash = sha1_hash(callback)
+    key = cls.create_key(sha1_hash(topic), cls.get_shard(callback_hash))
+    def txn():
+      roster = cls.get(key)
+      if roster is None:
+        return
+      index, present = roster.find(callback_hash)
+      if present:
+        del roster.callback_hashes[index]
+        del roster.callbacks[index]
+        del roster.secrets[index]
+        del roster.verify_tokens[index]
+      roster.callback_hashes.insert(index, callback_hash)
+      roster.callbacks.insert(index, db.Text(callback))
+      roster.secrets.insert(index, db.Text(secret or ''))
+      roster.verify_tokens.insert(index, db.Text(verify_token or ''))
+      roster.version += 1
+      roster.put()
+    try:
+      db.run_in_transaction(txn)
+    except (db.Error, apiproxy_errors.Error):
+      logging.exception('Could not add callback = %s to roster for '
+                        'topic = %s', callback, topic)
+      cls.drop_shard(key)
+
+  @classmethod
+  def discard(cls, callback, topic):
+    """Removes a subscriber from a topic's roster, if it is present.
+
+    Failures are handled like they are for add().
+
+    Args:
+      callback: URL of the callback subscriber.
+      topic: URL of the topic subscribed to.
+    """
+    callback_hash = sha1_hash(callback)
+    key = cls.create_key(sha1_hash(topic), cls.get_shard(callback_hash))
+    def txn():
+      roster = cls.get(key)
+      if roster is None:
+        return
+      index, present = roster.find(callback_hash)
+      if present:
+        del roster.callback_hashes[index]
+        del roster.callbacks[index]
+        del roster.secrets[index]
+        del roster.verify_tokens[index]
+      # Saved even if absent, so a refresh that found the Subscription before
+      # it was removed will see the shard changed and query again.
+      roster.version += 1
+      roster.put()
+    try:
+      db.run_in_transaction(txn)
+    except (db.Error, apiproxy_errors.Error):
+      logging.exception('Could not discard callback = %s from roster for '
+                        'topic = %s', callback, topic)
+      cls.drop_shard(key)
+
+  @classmethod
+  def start_build(cls, topic_hash):
+    """Creates the missing shards of a topic's roster, marked as building.
+
+    Subscription changes update the shards as soon as they exist, so refresh()
+    can safely fill them in afterwards.
+
+    Args:
+      topic_hash: Hash of the topic URL.
+    """
+    key_list = [cls.create_key(topic_hash, shard)
+                for shard in xrange(ROSTER_SHARD_COUNT)]
+    def txn(key):
+      if cls.get(key) is None:
+        cls(key=key, building=True).put()
+    for key, roster in zip(key_list, cls.get(key_list)):
+      if roster is None:
+        db.run_in_transaction(txn, key)
+
+  @classmethod
+  def refresh(cls, topic, shard):
+    """Rebuilds a shard of a topic's roster from its Subscriptions.
+
+    The shard is only saved if it did not change while the Subscriptions were
+    queried; otherwise the query is run again. Since Subscription changes
+    update the shard after they commit, none of them are lost.
+
+    Args:
+      topic: URL of the topic.
+      shard: Index of the shard.
+
+    Returns:
+      True if the shard was changed, False if it was already up to date or
+      does not exist.
+    """
+    key = cls.create_key(sha1_hash(topic), shard)
+    start = '%04x' % -(-shard * 0x10000 // ROSTER_SHARD_COUNT)
+    end = None
+    if shard < ROSTER_SHARD_COUNT - 1:
+      end = '%04x' % -(-(shard + 1) * 0x10000 // ROSTER_SHARD_COUNT)
+    while True:
+      roster = cls.get(key)
+      if roster is None:
+        return False
+      version = roster.version
+
+      sub_list = []
+      operator = '>='
+      while True:
+        query = Subscription.all()
+        query.filter('topic_hash =', sha1_hash(topic))
+        query.filter('subscription_state =', Subscription.STATE_VERIFIED)
+        query.filter('callback_hash %s' % operator, start)
+        if end is not None:
+          query.filter('callback_hash <', end)
+        query.order('callback_hash')
+        batch = query.fetch(MAX_ROSTER_REFRESH_LOOKUPS)
+        sub_list.extend(batch)
+        if len(batch) < MAX_ROSTER_REFRESH_LOOKUPS:
+          break
+        operator, start = '>', batch[-1].callback_hash
+
+      callback_hashes = [sub.callback_hash for sub in sub_list]
+      callbacks = [db.Text(sub.callback) for sub in sub_list]
+      secrets = [db.Text(sub.secret or '') for sub in sub_list]
+      verify_tokens = [db.Text(sub.verify_token or '') for sub in sub_list]
+      if (not roster.building and
+          (roster.callback_hashes, roster.callbacks, roster.secrets,
+           roster.verify_tokens) ==
+          (callback_hashes, callbacks, secrets, verify_tokens)):
+        return False
+
+      def txn():
+        roster = cls.get(key)
+        if roster is None:
+          return True
+        if roster.version != version:
+          return False
+        roster.callback_hashes = callback_hashes
+        roster.callbacks = callbacks
+        roster.secrets = secrets
+        roster.verify_tokens = verify_tokens
+        roster.building = False
+        roster.version += 1
+        roster.put()
+        return True
+      if db.run_in_transaction(txn):
+        return True
+
+  @classmethod
+  def get_subscribers(cls, topic, count, starting_at_callback=None):
+    """Gets the list of subscribers from a topic's roster.
+
+    Args:
+      topic: The topic URL to retrieve subscribers for.
+      count: How many subscribers to retrieve.
+      starting_at_callback: A string containing the callback hash to offset
+        to when retrieving more subscribers. The callback at the given offset
+        *will* be included in the results. If None, then subscribers will
+        be retrieved from the beginning.
+
+    Returns:
+      List of RosterEntry objects in callback hash order, the same order as
+      Subscription.get_subscribers. Returns None if the topic has no roster or
+      it is still being built.
+    """
+    topic_hash = sha1_hash(topic)
+    if starting_at_callback:
+      start_hash = sha1_hash(starting_at_callback)
+      shard = cls.get_shard(start_hash)
+    else:
+      start_hash = ''
+      shard = 0
+
+    entry_list = []
+    while shard < ROSTER_SHARD_COUNT and len(entry_list) < count:
+      end_shard = min(shard + ROSTER_READ_BATCH_SIZE, ROSTER_SHARD_COUNT)
+      key_list = [cls.create_key(topic_hash, i)
+                  for i in xrange(shard, end_shard)]
+      for roster in cls.get(key_list):
+        if roster is None or roster.building:
+          return None
+        index = roster.find(start_hash)[0]
+        end_index = index + count - len(entry_list)
+        for i in xrange(index, min(end_index, len(roster.callback_hashes))):
+          entry_list.append(RosterEntry(topic,
+                                        roster.callback_hashes[i],
+                                        roster.callbacks[i],
+                                        roster.secrets[i] or None,
+                                        roster.verify_tokens[i] or None))
+      shard = end_shard
+    return entry_list
+
+
 class FeedToFetch(db.Expando):
   """A feed that has new data that needs to be pulled.
 
@@ -1054,6 +2045,7 @@ class FeedToFetch(db.Expando):
   source_keys = db.StringListProperty(indexed=False)
   source_values = db.StringListProperty(indexed=False)
   work_index = db.IntegerProperty()
+  needs_expansion = db.BooleanProperty(default=False, indexed=False)
 
   # TODO(bslatkin): Add fetching failure reason (urlfetch, parsing, etc) and
   # surface it on the topic details page.
@@ -1073,7 +2065,8 @@ class FeedToFetch(db.Expando):
     return cls.get_by_key_name(get_hash_key_name(topic))
 
   @classmethod
-  def insert(cls, topic_list, source_dict=None, memory_only=True):
+  def insert(cls, topic_list, source_dict=None, memory_only=True,
+             needs_expansion=False):
     """Inserts a set of FeedToFetch entities for a set of topics.
 
     Overwrites any existing entities that are already there.
@@ -1083,6 +2076,8 @@ class FeedToFetch(db.Expando):
       source_dict: Dictionary of sources for the feed. Defaults to an empty
         dictionary.
       memory_only: Only save FeedToFetch records to memory, not to disk.
+      needs_expansion: True if the topics have not been checked for being
+        known feeds or expanded by their aliases yet.
 
     Returns:
       The list of FeedToFetch records that was created.
@@ -1110,7 +2105,8 @@ class FeedToFetch(db.Expando):
               topic=topic,
               source_keys=list(source_keys),
               source_values=list(source_values),
-              work_index=work_index)
+              work_index=work_index,
+              needs_expansion=needs_expansion)
           for topic in set(topic_list)]
       if memory_only:
         cls.FORK_JOIN_QUEUE.put(work_index, feed_list)
@@ -1157,6 +2153,26 @@ class FeedToFetch(db.Expando):
       logging.exception('Could not mark feed fetching as a failure: topic=%r',
                         self.topic)
 
+  def defer(self,
+            retry_period=FEED_PULL_RETRY_PERIOD,
+            now=datetime.datetime.utcnow):
+    """Puts off fetching this feed to a task of its own.
+
+    Unlike fetch_failed(), this does not count as a fetching failure.
+
+    Args:
+      retry_period: Seconds to wait before fetching the feed again.
+      now: Returns the current time as a UTC datetime.
+    """
+    def txn():
+      self.eta = now() + datetime.timedelta(seconds=retry_period)
+      self._enqueue_retry_task()
+      self.put()
+    try:
+      db.run_in_transaction_custom_retries(2, txn)
+    except:
+      logging.exception('Could not defer feed fetching: topic=%r', self.topic)
+
   def done(self):
     """The feed fetch has completed successfully.
 
@@ -1217,21 +2233,260 @@ FeedToFetch.FORK_JOIN_QUEUE = fork_join_queue.MemcacheForkJoinQueue(
     expiration_seconds=600)  # Give up on fetches after 10 minutes.
 
 
-class FeedRecord(db.Model):
-  """Represents record of the feed from when it has been polled.
+class SeenEntries(object):
+  """Packed digest of the entries that have been seen for a topic.
+
+  Each entry is stored as the first SEEN_ENTRY_DIGEST_BYTES of the binary sha1
+  hash of its ID followed by the same number of bytes of the sha1 hash of its
+  content and the day it was last seen, in the order the entries were last
+  seen. Entries are seen when they are added or found unchanged while diffing
+  a document, so the ones that are forgotten first are those that have left
+  the feed. Digests packed before the day was kept have no DAYS_FORMAT marker;
+  their entries are treated as seen on the day they are loaded.
+
+  Digests of topics that were last pulled before digests existed start out
+  empty and have a legacy_topic; the FeedEntryRecords of the entries in the
+  documents being diffed are added as they are needed.
+
+  When CONTENT_HASH_RULES apply to a topic, the content digest is taken from
+  the hash of the entry's canonical form except for its last byte, which comes
+  from the hash of the raw content. That byte is only used to count the entries
+  whose raw content changed while their canonical form did not; it is updated
+  when such a change is counted, so each change is only counted once.
+  """
+
+  # Leading byte of packed digests that keep the day each entry was last seen.
+  # It makes their length odd, while older digests are a multiple of 2*size.
+  DAYS_FORMAT = '\x01'
+
+  # Days last seen are counted from this date.
+  EPOCH = datetime.date(2010, 1, 1)
+
+  def __init__(self, packed=None, legacy_topic=None,
+               now=datetime.datetime.utcnow):
+    """Initializer.
+
+    Args:
+      packed: String of packed digests, as returned by pack().
+      legacy_topic: Topic URL whose FeedEntryRecords should be consulted for
+        entries that are not in the digest, or None.
+      now: Returns the current time as a UTC datetime.
+    """
+    self.entries = {}
+    self.next_order = 0
+    self.today = (now().date() - self.EPOCH).days
+    packed = packed or ''
+    size = SEEN_ENTRY_DIGEST_BYTES
+    if len(packed) % (2*size):
+      packed = packed[len(self.DAYS_FORMAT):]
+      stride = 2*size + 2
+    else:
+      stride = 2*size
+    for position in xrange(0, len(packed) - stride + 1, stride):
+      if stride > 2*size:
+        day = struct.unpack('>H', packed[position+2*size:position+stride])[0]
+      else:
+        day = self.today
+      self.entries[packed[position:position+size]] = (
+          self.next_order, packed[position+size:position+2*size], day)
+      self.next_order += 1
+    self.loaded = len(self.entries)
+    # ID digests of the entries seen since the digest was loaded.
+    self.seen = set()
+    self.legacy_topic = legacy_topic
+    # Number of entries found unchanged only because of CONTENT_HASH_RULES.
+    self.suppressed = 0
+
+  @staticmethod
+  def digest(hex_hash):
+    """Truncates a hex sha1 hash to a binary digest."""
+    return hex_hash[:2*SEEN_ENTRY_DIGEST_BYTES].decode('hex')
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self, id_hash):
+    return self.digest(id_hash) in self.entries
+
+  def last_seen(self, id_hash):
+    """Returns the date an entry was last seen, or None if not in the digest.
+
+    Args:
+      id_hash: Hex sha1 hash of the entry's ID.
+    """
+    found = self.entries.get(self.digest(id_hash))
+    if found is None:
+      return None
+    return self.EPOCH + datetime.timedelta(days=found[2])
+
+  def is_unchanged(self, id_hash, content_hash, raw_hash=None):
+    """Returns True if the entry has been seen with the same content.
+
+    Entries last seen before CONTENT_HASH_RULES applied to the topic are also
+    unchanged if their raw content is the same. Entries that are unchanged
+    only because of CONTENT_HASH_RULES are counted in the suppressed attribute.
+
+    Args:
+      id_hash: Hex sha1 hash of the entry's ID.
+      content_hash: Hex sha1 hash of the entry's canonical content.
+      raw_hash: Hex sha1 hash of the entry's raw content, if different.
+    """
+    id_digest = self.digest(id_hash)
+    found = self.entries.get(id_digest)
+    if found is None:
+      return False
+    found_digest = found[1]
+    content_digest = self.digest(content_hash)
+    if raw_hash is None or raw_hash == content_hash:
+      unchanged = found_digest == content_digest
+    else:
+      raw_digest = self.digest(raw_hash)
+      unchanged = (found_digest == raw_digest or
+                   found_digest[:-1] == content_digest[:-1])
+      if unchanged and found_digest[-1] != raw_digest[-1]:
+        self.suppressed += 1
+        found_digest = found_digest[:-1] + raw_digest[-1]
+    if unchanged:
+      self._mark_seen(id_digest, found_digest)
+    return unchanged
+
+  def add(self, id_hash, content_hash, raw_hash=None):
+    """Marks an entry as seen with the given content.
+
+    Args:
+      id_hash: Hex sha1 hash of the entry's ID.
+      content_hash: Hex sha1 hash of the entry's canonical content.
+      raw_hash: Hex sha1 hash of the entry's raw content, if different.
+    """
+    content_digest = self.digest(content_hash)
+    if raw_hash is not None:
+      content_digest = content_digest[:-1] + self.digest(raw_hash)[-1]
+    self._mark_seen(self.digest(id_hash), content_digest)
+
+  def _mark_seen(self, id_digest, content_digest):
+    """Makes an entry the most recently seen one."""
+    self.entries[id_digest] = (self.next_order, content_digest, self.today)
+    self.next_order += 1
+    self.seen.add(id_digest)
+
+  def add_legacy_records(self, entry_id_list):
+    """Adds the FeedEntryRecords of entries that are not in the digest yet.
+
+    Does nothing unless the digest has a legacy_topic.
+
+    Args:
+      entry_id_list: IDs of the entries found in the document being diffed.
+    """
+    if self.legacy_topic is None:
+      return
+    missing = [entry_id for entry_id in entry_id_list
+               if self.digest(sha1_hash(entry_id)) not in self.entries]
+    STEP = MAX_FEED_ENTRY_RECORD_LOOKUPS
+    for position in xrange(0, len(missing), STEP):
+      for entry in FeedEntryRecord.get_legacy_entries_for_topic(
+          self.legacy_topic, missing[position:position+STEP]):
+        self.add(entry.id_hash, entry.entry_content_hash,
+                 getattr(entry, 'raw_content_hash', None))
+
+  def merge(self, packed):
+    """Merges in a digest that was saved since this one was loaded.
+
+    Used when another parse of the same topic saved its digest first. The
+    entries seen since this digest was loaded stay the most recently seen
+    ones, with the content they were seen with here.
+
+    Args:
+      packed: String of packed digests, as returned by pack().
+    """
+    other = SeenEntries(packed)
+    old_entries = self.entries
+    self.entries = other.entries
+    self.next_order = other.next_order
+    for order, id_digest in sorted((old_entries[d][0], d) for d in self.seen):
+      self.entries[id_digest] = (self.next_order,) + old_entries[id_digest][1:]
+      self.next_order += 1
+    self.loaded = max(self.loaded, other.loaded)
+
+  def copy_from(self, other):
+    """Takes over the state of a copy of this digest, such as one that was
+    used to diff a document in a ParsePool worker process."""
+    self.entries = other.entries
+    self.next_order = other.next_order
+    self.loaded = other.loaded
+    self.seen = other.seen
+    self.suppressed = other.suppressed
+
+  def pack(self):
+    """Returns the packed digests, keeping only the newest entries.
+
+    At least MAX_SEEN_ENTRIES are kept, and no fewer than were loaded or
+    have been seen since, up to SEEN_ENTRY_LIMIT.
+    """
+    keep = min(SEEN_ENTRY_LIMIT,
+               max(MAX_SEEN_ENTRIES, self.loaded, len(self.seen)))
+    if len(self.seen) > keep:
+      logging.warning('Digest of seen entries cannot hold all %d entries '
+                      'seen; keeping the newest %d', len(self.seen), keep)
+    ordered = sorted((order, id_digest, content_digest, day)
+                     for id_digest, (order, content_digest, day)
+                     in self.entries.iteritems())
+    return self.DAYS_FORMAT + ''.join(
+        id_digest + content_digest + struct.pack('>H', day)
+        for order, id_digest, content_digest, day in ordered[-keep:])
+
+
+class FeedRecord(db.Model):
+  """Represents record of the feed from when it has been polled.
 
   This contains everything in a feed except for the entry data. That means any
   footers, top-level XML elements, namespace declarations, etc, will be
-  captured in this entity.
+  captured in this entity. It also has a SeenEntries digest of the entries
+  that have been delivered for the topic.
 
   The key name of this entity is a get_hash_key_name() of the topic URL.
   """
 
   topic = db.TextProperty(required=True)
+  # Only set for records saved before header_footer_data was introduced.
   header_footer = db.TextProperty()
+  # UTF-8 header and footer encoded with storage_codec.
+  header_footer_data = db.BlobProperty()
   last_updated = db.DateTimeProperty(auto_now=True, indexed=False)
   format = db.TextProperty()  # 'atom', 'rss', or 'arbitrary'
 
+  # Packed SeenEntries digest. None if the topic has not been diffed since
+  # digests were introduced; its FeedEntryRecords are used to build one.
+  seen_entries = db.BlobProperty()
+
+  # Fingerprints of the last document that was parsed completely; see
+  # get_content_fingerprints().
+  content_hash = db.StringProperty(indexed=False)
+  normalized_content_hash = db.StringProperty(indexed=False)
+
+  # Last feed ID found while parsing; the KnownFeed is only updated when this
+  # changes. See update_feed_id().
+  feed_id = db.TextProperty()
+
+  # Total number of entries that were not delivered again because only the
+  # parts masked by CONTENT_HASH_RULES had changed.
+  suppressed_entries = db.IntegerProperty(default=0, indexed=False)
+
+  # Number of times saving a parse's entities still had to be split in half
+  # because a put was too large despite MAX_FEED_RECORD_SAVE_BYTES.
+  put_splits = db.IntegerProperty(default=0, indexed=False)
+
+  # True if the last parse was cut short by MAX_FEED_PARSE_BYTES or
+  # MAX_NEW_FEED_ENTRY_RECORDS, so the next one must not stop early at
+  # already-seen entries.
+  over_budget = db.BooleanProperty(default=False, indexed=False)
+
+  # When a document was last diffed in full; see can_stop_early().
+  last_full_diff = db.DateTimeProperty(indexed=False)
+
+  # Size of the last feed document that was parsed, which a feed pull batch
+  # reserves against MAX_FETCH_BATCH_BYTES before fetching the feed again.
+  content_bytes = db.IntegerProperty(indexed=False)
+
   # Content-related headers served by the feed's host.
   content_type = db.TextProperty()
   last_modified = db.TextProperty()
@@ -1250,26 +2505,42 @@ class FeedRecord(db.Model):
     return get_hash_key_name(topic)
 
   @classmethod
-  def get_or_create_all(cls, topic_list):
+  def get_or_create_all(cls, topic_list, async_proxy=None, callback=None):
     """Retrieves and/or creates FeedRecord entities for the supplied topics.
 
     Args:
       topic_list: List of topics to retrieve.
+      async_proxy: If not None, AsyncAPIProxy to use for retrieving the
+        entities asynchronously, in which case callback is required.
+      callback: Callable that takes (feed_record_list, exception), where
+        feed_record_list is what would have been returned. Exactly one of the
+        two arguments is None.
 
     Returns:
       The list of FeedRecords corresponding to the input topic list in the
-      same order they were supplied.
+      same order they were supplied; None if async_proxy was supplied.
     """
     key_list = [db.Key.from_path(cls.kind(), cls.create_key_name(t))
                 for t in topic_list]
-    found_list = db.get(key_list)
-    results = []
-    for topic, key, found in zip(topic_list, key_list, found_list):
-      if found:
-        results.append(found)
+    def create(found_list):
+      results = []
+      for topic, key, found in zip(topic_list, key_list, found_list):
+        if found:
+          results.append(found)
+        else:
+          results.append(cls(key=key, topic=topic))
+      return results
+
+    if async_proxy is None:
+      return create(FEED_RECORD_CACHE.get(key_list))
+
+    def get_callback(found_list, exception):
+      if exception:
+        callback(None, exception)
       else:
-        results.append(cls(key=key, topic=topic))
-    return results
+        callback(create(found_list), None)
+    FEED_RECORD_CACHE.get(key_list, async_proxy=async_proxy,
+                          callback=get_callback)
 
   @classmethod
   def get_or_create(cls, topic):
@@ -1284,7 +2555,7 @@ class FeedRecord(db.Model):
     """
     return cls.get_or_insert(FeedRecord.create_key_name(topic), topic=topic)
 
-  def update(self, headers, header_footer=None, format=None):
+  def update(self, headers, header_footer=None, format=None, content=None):
     """Updates the polling record of this feed.
 
     This method will *not* insert this instance into the Datastore.
@@ -1296,6 +2567,8 @@ class FeedRecord(db.Model):
         if not supplied, the old value will remain. Only saved for feeds.
       format: The last parsing format that worked correctly for this feed.
         Should be 'rss', 'atom', or 'arbitrary'.
+      content: The feed document that was parsed, which is fingerprinted for
+        is_unchanged(). If not supplied, the old fingerprints will remain.
     """
     try:
       self.content_type = headers.get('Content-Type', '').lower()
@@ -1315,7 +2588,118 @@ class FeedRecord(db.Model):
     if format is not None:
       self.format = format
     if header_footer is not None and self.format != ARBITRARY:
-      self.header_footer = header_footer
+      self.header_footer = None
+      self.header_footer_data = db.Blob(
+          storage_codec.encode(utf8encoded(header_footer)))
+    if content is not None:
+      self.content_hash, self.normalized_content_hash = (
+          get_content_fingerprints(content))
+      self.content_bytes = len(content)
+
+  def save_headers(self, headers):
+    """Updates the response headers of this feed and saves them if changed.
+
+    Used for documents that are not parsed, so the next fetch of the feed
+    still sends the publisher's latest ETag and Last-Modified values. Saving
+    is best effort, so Datastore errors are logged and ignored.
+
+    Args:
+      headers: Dictionary of response headers found during feed fetching.
+
+    Returns:
+      True if the headers changed and were saved, False otherwise.
+    """
+    old_headers = (self.content_type, self.etag, self.last_modified)
+    self.update(headers)
+    if old_headers == (self.content_type, self.etag, self.last_modified):
+      return False
+    try:
+      self.put()
+    except (db.Error, apiproxy_errors.Error):
+      logging.exception('Could not save response headers for topic %r',
+                        self.topic)
+      FEED_RECORD_CACHE.invalidate([self.key()])
+      return False
+    FEED_RECORD_CACHE.put([self])
+    return True
+
+  def get_header_footer(self):
+    """Returns the feed's header and footer as unicode, or None if not saved."""
+    if self.header_footer_data is not None:
+      return storage_codec.decode(self.header_footer_data).decode('utf-8')
+    return self.header_footer
+
+  def is_unchanged(self, content):
+    """Returns True if a feed document is the same as the last one parsed.
+
+    Documents that only differ in whitespace are considered the same. Arbitrary
+    content is never considered unchanged, since the publisher has told us it
+    changed and there are no entries to diff.
+
+    Args:
+      content: The newly fetched feed document.
+    """
+    if not self.content_hash or self.format == ARBITRARY:
+      return False
+    content_hash, normalized_hash = get_content_fingerprints(content)
+    return (content_hash == self.content_hash or
+            normalized_hash == self.normalized_content_hash)
+
+  def can_stop_early(self, seen_entries, now=datetime.datetime.utcnow):
+    """Returns True if diffing may stop at a run of already-seen entries.
+
+    The whole document must be diffed if the last parse was cut short, if the
+    digest is still being built from FeedEntryRecords, or if it has not been
+    diffed in full for FULL_DIFF_INTERVAL_DAYS, so the entries after such a
+    run have their last-seen day refreshed before they are pruned.
+
+    Args:
+      seen_entries: The SeenEntries for this topic from get_seen_entries().
+      now: Returns the current time as a UTC datetime.
+    """
+    if self.over_budget or seen_entries.legacy_topic is not None:
+      return False
+    # Digests without entries have nothing to refresh.
+    return not len(seen_entries) or (
+        self.last_full_diff is not None and self.last_full_diff >
+        now() - datetime.timedelta(days=FULL_DIFF_INTERVAL_DAYS))
+
+  def get_seen_entries(self):
+    """Returns the SeenEntries digest for this topic.
+
+    Topics that were last pulled before digests existed only have their
+    FeedEntryRecord children. Their digest is built from the records of the
+    entries in the documents that are diffed, so already-seen entries are not
+    delivered again.
+
+    Returns:
+      A SeenEntries instance.
+    """
+    if self.seen_entries is not None:
+      return SeenEntries(self.seen_entries)
+    if self.is_saved():
+      return SeenEntries(legacy_topic=self.topic)
+    return SeenEntries()
+
+  def add_seen_entries(self, seen_entries, entry_list):
+    """Adds entries to the seen entries digest of this topic.
+
+    This method will *not* insert this instance into the Datastore.
+
+    Args:
+      seen_entries: The SeenEntries for this topic from get_seen_entries().
+      entry_list: List of FeedEntryRecord instances for new or updated entries.
+    """
+    for entry in entry_list:
+      seen_entries.add(entry.id_hash, entry.entry_content_hash,
+                       getattr(entry, 'raw_content_hash', None))
+    self.seen_entries = db.Blob(seen_entries.pack())
+    if seen_entries.suppressed:
+      logging.info('Suppressed %d entries with masked changes for topic %r',
+                   seen_entries.suppressed, self.topic)
+      self.suppressed_entries = (
+          (self.suppressed_entries or 0) + seen_entries.suppressed)
+      seen_entries.suppressed = 0
 
   def get_request_headers(self, subscriber_count):
     """Returns the request headers that should be used to pull this feed.
@@ -1345,7 +2729,16 @@ class FeedRecord(db.Model):
 class FeedEntryRecord(db.Expando):
   """Represents a feed entry that has been seen.
 
-  The key name of this entity is a get_hash_key_name() hash of the entry_id.
+  The key name of this entity is the FeedRecord key name of the topic followed
+  by an underscore and the sha1 hash of the entry_id. Each record is its own
+  entity group so saving records never contends with the topic's FeedRecord.
+
+  Records saved before then are children of the FeedRecord with a
+  get_hash_key_name() hash of the entry_id as their key name. They are only
+  read to build the digest of seen entries of topics that do not have one
+  yet, and records of the current kind are only saved once a topic has a
+  digest, so each lookup only needs to read one kind of record. Legacy
+  records are pruned like any other.
   """
   entry_content_hash = db.StringProperty(indexed=False)
   update_time = db.DateTimeProperty(auto_now=True, indexed=False)
@@ -1353,12 +2746,48 @@ class FeedEntryRecord(db.Expando):
   @property
   def id_hash(self):
     """Returns the sha1 hash of the entry ID."""
-    return self.key().name()[len('hash_'):]
+    return self.key().name().split('_')[-1]
+
+  @property
+  def feed_record_key(self):
+    """Returns the Key of the FeedRecord for this entry's topic."""
+    key = self.key()
+    if key.parent() is not None:
+      return key.parent()
+    return db.Key.from_path(FeedRecord.kind(),
+                            key.name()[:-len(self.id_hash) - 1])
 
   @classmethod
   def create_key(cls, topic, entry_id):
     """Creates a new Key for a FeedEntryRecord entity.
 
+    Args:
+      topic: The topic URL to retrieve entries for.
+      entry_id: String containing the entry_id.
+
+    Returns:
+      Key instance for this FeedEntryRecord.
+    """
+    return cls.create_key_for_hash(topic, sha1_hash(entry_id))
+
+  @classmethod
+  def create_key_for_hash(cls, topic, id_hash):
+    """Creates a new Key for a FeedEntryRecord entity by its ID hash.
+
+    Args:
+      topic: The topic URL to retrieve entries for.
+      id_hash: Hex sha1 hash of the entry_id.
+
+    Returns:
+      Key instance for this FeedEntryRecord.
+    """
+    return db.Key.from_path(
+        cls.kind(), '%s_%s' % (FeedRecord.create_key_name(topic), id_hash))
+
+  @classmethod
+  def create_legacy_key(cls, topic, entry_id):
+    """Creates a Key for a FeedEntryRecord that is a child of its FeedRecord.
+
     Args:
       topic: The topic URL to retrieve entries for.
       entry_id: String containing the entry_id.
@@ -1389,7 +2818,23 @@ class FeedEntryRecord(db.Expando):
     return [r for r in results if r]
 
   @classmethod
-  def create_entry_for_topic(cls, topic, entry_id, content_hash):
+  def get_legacy_entries_for_topic(cls, topic, entry_id_list):
+    """Gets multiple legacy FeedEntryRecord children of a topic's FeedRecord.
+
+    Args:
+      topic: The topic URL to retrieve entries for.
+      entry_id_list: Sequence of entry_ids to retrieve.
+
+    Returns:
+      List of FeedEntryRecords that were found, if any.
+    """
+    results = cls.get([cls.create_legacy_key(topic, entry_id)
+                       for entry_id in entry_id_list])
+    return [r for r in results if r]
+
+  @classmethod
+  def create_entry_for_topic(cls, topic, entry_id, content_hash,
+                             raw_content_hash=None):
     """Creates multiple FeedEntryRecords entities for a topic.
 
     Does not actually insert the entities into the Datastore. This is left to
@@ -1401,13 +2846,363 @@ class FeedEntryRecord(db.Expando):
       content_hash: Sha1 hash of the entry's entire XML content. For example,
         with Atom this would apply to everything from <entry> to </entry> with
         the surrounding tags included. With RSS it would be everything from
-        <item> to </item>.
+        <item> to </item>. This is the hash of the entry's canonical form
+        when CONTENT_HASH_RULES apply to the topic.
+      raw_content_hash: Sha1 hash of the entry's raw content, if it is
+        different from content_hash.
+
+    Returns:
+      A new FeedEntryRecord that should be inserted into the Datastore.
+    """
+    return cls.create_entry_for_hash(
+        topic, sha1_hash(entry_id), content_hash, raw_content_hash)
+
+  @classmethod
+  def create_entry_for_hash(cls, topic, id_hash, content_hash,
+                            raw_content_hash=None):
+    """Creates a FeedEntryRecord for a topic by the hash of its entry_id.
+
+    Does not actually insert the entity into the Datastore.
+
+    Args:
+      topic: The topic URL to insert entities for.
+      id_hash: Hex sha1 hash of the entry_id.
+      content_hash: Sha1 hash of the entry's content, as for
+        create_entry_for_topic().
+      raw_content_hash: Sha1 hash of the entry's raw content, if different.
 
     Returns:
       A new FeedEntryRecord that should be inserted into the Datastore.
     """
-    key = cls.create_key(topic, entry_id)
-    return cls(key=key, entry_content_hash=content_hash)
+    key = cls.create_key_for_hash(topic, id_hash)
+    entry = cls(key=key, entry_content_hash=content_hash)
+    if raw_content_hash is not None and raw_content_hash != content_hash:
+      entry.raw_content_hash = raw_content_hash
+    return entry
+
+  @staticmethod
+  def enqueue_save(topic, entry_list):
+    """Enqueues a Task that will save FeedEntryRecords for a topic.
+
+    The Task is transactional, so it is only enqueued if the transaction this
+    is called in commits. Records are passed as lines of their hashes, which
+    stays well under the Task size limit for MAX_NEW_FEED_ENTRY_RECORDS.
+
+    Args:
+      topic: The topic URL the records are for.
+      entry_list: List of FeedEntryRecords to save.
+    """
+    records = '\n'.join(
+        ' '.join(filter(None, (entry.id_hash, entry.entry_content_hash,
+                               getattr(entry, 'raw_content_hash', None))))
+        for entry in entry_list)
+    RETRIES = 3
+    for i in xrange(RETRIES):
+      try:
+        taskqueue.Task(
+            url='/work/save_entry_records',
+            params={'topic': topic, 'records': records}
+            ).add(ENTRY_RECORDS_QUEUE, transactional=True)
+      except (taskqueue.Error, apiproxy_errors.Error):
+        logging.exception('Could not insert task to save %d FeedEntryRecords '
+                          'for topic = %s', len(entry_list), topic)
+        if i == (RETRIES - 1):
+          raise
+      else:
+        return
+
+
+class FeedContinuation(db.Model):
+  """Represents a feed document whose new entries are still being parsed.
+
+  When a document has more new entries than a single parse may save, it is
+  kept here and a task parses it again for the rest instead of fetching it
+  again; the entries saved so far are in the topic's digest of seen entries
+  by then. This is a child of the topic's FeedRecord so it is saved in the
+  same transaction as the entries that were parsed.
+
+  The key name of this entity is a get_hash_key_name() hash of the topic URL.
+  """
+
+  topic = db.TextProperty(required=True)
+  # Feed document encoded with storage_codec.
+  content = db.BlobProperty()
+  content_type = db.TextProperty()
+  etag = db.TextProperty()
+  last_modified = db.TextProperty()
+  # True for documents that were fetched but not parsed at all because their
+  # feed pull batch went over MAX_FETCH_BATCH_BYTES.
+  deferred = db.BooleanProperty(default=False, indexed=False)
+  # Other topics the parsed events are for, as passed to parse_feed().
+  alternate_topics = db.ListProperty(db.Text, indexed=False)
+
+  HEADERS = (
+    ('content_type', 'Content-Type'),
+    ('etag', 'ETag'),
+    ('last_modified', 'Last-Modified'),
+  )
+
+  @classmethod
+  def create_key(cls, topic):
+    """Creates a new Key for a FeedContinuation entity.
+
+    Args:
+      topic: The topic URL of the feed.
+
+    Returns:
+      Key instance for this FeedContinuation.
+    """
+    return db.Key.from_path(
+        FeedRecord.kind(),
+        FeedRecord.create_key_name(topic),
+        cls.kind(),
+        get_hash_key_name(topic))
+
+  @classmethod
+  def create(cls, topic, headers, content, alternate_topics=None):
+    """Creates a FeedContinuation for a feed document.
+
+    Does not actually insert the entity into the Datastore. This is left to
+    the caller so it can be done as part of a larger batch put().
+
+    Args:
+      topic: The topic URL of the feed.
+      headers: Dictionary of response headers found during feed fetching.
+      content: The feed document.
+      alternate_topics: List of other topics the parsed events are for, if
+        any, as passed to parse_feed().
+
+    Returns:
+      The new FeedContinuation, or None if the encoded document is larger
+      than MAX_FEED_CONTINUATION_BYTES.
+    """
+    encoded = storage_codec.encode(content)
+    if len(encoded) > MAX_FEED_CONTINUATION_BYTES:
+      return None
+    continuation = cls(key=cls.create_key(topic), topic=topic,
+                       content=db.Blob(encoded),
+                       alternate_topics=[db.Text(t)
+                                         for t in alternate_topics or []])
+    for name, header in cls.HEADERS:
+      try:
+        setattr(continuation, name, headers.get(header))
+      except UnicodeDecodeError:
+        logging.exception('%s header had bad encoding', header)
+    return continuation
+
+  @classmethod
+  def save_deferred(cls, topic, headers, content):
+    """Keeps a fetched feed document for a task to parse.
+
+    Args:
+      topic: The topic URL of the feed.
+      headers: Dictionary of response headers found during feed fetching.
+      content: The feed document.
+
+    Returns:
+      True if the document was saved and its task enqueued, False if it is
+      too large to keep or could not be saved, so it must be fetched again.
+    """
+    continuation = cls.create(topic, headers, content)
+    if continuation is None:
+      return False
+    continuation.deferred = True
+    def txn():
+      continuation.put()
+      continuation.enqueue()
+    try:
+      db.run_in_transaction(txn)
+    except (db.Error, taskqueue.Error, apiproxy_errors.Error):
+      logging.exception('Could not keep deferred feed document for topic %r',
+                        topic)
+      return False
+    return True
+
+  def get_headers(self):
+    """Returns the saved response headers of the feed as a dictionary."""
+    headers = {}
+    for name, header in self.HEADERS:
+      value = getattr(self, name)
+      if value is not None:
+        headers[header] = value
+    return headers
+
+  def get_content(self):
+    """Returns the feed document."""
+    return storage_codec.decode(self.content)
+
+  def enqueue(self):
+    """Enqueues a Task that will continue parsing this feed document."""
+    RETRIES = 3
+    if os.environ.get('HTTP_X_APPENGINE_QUEUENAME') == POLLING_QUEUE:
+      target_queue = POLLING_QUEUE
+    else:
+      target_queue = FEED_QUEUE
+    for i in xrange(RETRIES):
+      try:
+        taskqueue.Task(
+            url='/work/continue_feeds',
+            params={'topic': self.topic}
+            ).add(target_queue, transactional=True)
+      except (taskqueue.Error, apiproxy_errors.Error):
+        logging.exception('Could not insert task to continue parsing '
+                          'feed document for topic = %s', self.topic)
+        if i == (RETRIES - 1):
+          raise
+      else:
+        return
+
+
+# Event payloads by hash, for instances delivering many chunks of an event.
+EVENT_PAYLOAD_CACHE = LruCache(EVENT_PAYLOAD_LOCAL_CACHE_SIZE,
+                               EVENT_PAYLOAD_LOCAL_CACHE_SECONDS)
+
+
+class EventPayload(db.Model):
+  """Represents the payload of one or more events to deliver.
+
+  Payloads are immutable and keyed by their hash, so events with identical
+  content (such as those for alias topics or repeated virtual feed updates)
+  share a single entity, and recording delivery progress on an event does
+  not rewrite its payload. An offline job removes payloads that have not been
+  written for longer than events are kept; events that are still being
+  retried refresh their payload after each delivery pass.
+
+  Since payloads never change they are also cached in instance memory and in
+  memcache, split into chunks that fit within memcache's value size limit.
+  The stored and memcached data is encoded with storage_codec.
+  """
+
+  data = db.BlobProperty()
+  last_modified = db.DateTimeProperty(required=True, indexed=False)
+
+  # Prefix of the memcache keys that cache payloads.
+  CACHE_PREFIX = 'event_payload:'
+
+  # Size of each chunk of a payload in memcache; values are limited to 1MB.
+  CACHE_CHUNK_BYTES = 1000000 - 1024
+
+  @staticmethod
+  def create_key_name(payload_hash):
+    """Returns the key name for an EventPayload given the payload's hash."""
+    return 'hash_' + payload_hash
+
+  @classmethod
+  def store(cls, payload, now=datetime.datetime.utcnow):
+    """Saves a payload unless it was already saved recently.
+
+    Must not be called inside a transaction.
+
+    Args:
+      payload: The payload as a byte string.
+      now: Returns the current time as a UTC datetime. Used in tests.
+
+    Returns:
+      The hash of the payload.
+    """
+    payload_hash = sha1_hash(payload)
+    key_name = cls.create_key_name(payload_hash)
+    now_time = now()
+    existing = cls.get_by_key_name(key_name)
+    if existing is None or existing.last_modified < (
+        now_time - datetime.timedelta(seconds=EVENT_PAYLOAD_REFRESH_SECONDS)):
+      data = storage_codec.encode(payload)
+      cls(key_name=key_name,
+          data=db.Blob(data),
+          last_modified=now_time).put()
+      cls.cache(payload_hash, data)
+    return payload_hash
+
+  @classmethod
+  def refresh(cls, payload_hash, last_modified):
+    """Pushes back the offline cleanup of a payload an event still needs.
+
+    Must not be called inside a transaction.
+
+    Args:
+      payload_hash: The hash of the payload.
+      last_modified: The event's last_modified time as a UTC datetime; the
+        payload is kept for at least as long as the event.
+    """
+    payload = cls.get_by_key_name(cls.create_key_name(payload_hash))
+    if payload is not None and payload.last_modified < (
+        last_modified -
+        datetime.timedelta(seconds=EVENT_PAYLOAD_REFRESH_SECONDS)):
+      payload.last_modified = last_modified
+      payload.put()
+
+  @classmethod
+  def cache(cls, payload_hash, payload):
+    """Saves an encoded payload in memcache.
+
+    The first chunk of the payload is stored along with the number of chunks
+    under the payload's hash. The rest of the chunks are stored first under
+    the hash and their index, so readers never find an incomplete set.
+
+    Args:
+      payload_hash: The hash of the payload.
+      payload: The encoded payload as a byte string.
+    """
+    step = cls.CACHE_CHUNK_BYTES
+    chunks = [payload[i:i+step] for i in xrange(0, len(payload), step)]
+    if not chunks:
+      chunks = ['']
+    rest = dict(('%s:%d' % (payload_hash, i), chunks[i])
+                for i in xrange(1, len(chunks)))
+    if rest and memcache.set_multi(rest, time=EVENT_PAYLOAD_CACHE_SECONDS,
+                                   key_prefix=cls.CACHE_PREFIX):
+      logging.warning('Could not cache payload %s', payload_hash)
+      return
+    if not memcache.set(cls.CACHE_PREFIX + payload_hash,
+                        (len(chunks), chunks[0]),
+                        time=EVENT_PAYLOAD_CACHE_SECONDS):
+      logging.warning('Could not cache payload %s', payload_hash)
+
+  @classmethod
+  def get_cached(cls, payload_hash):
+    """Retrieves an encoded payload from memcache.
+
+    Args:
+      payload_hash: The hash of the payload.
+
+    Returns:
+      The encoded payload as a byte string, or None if it is not entirely in
+      memcache.
+    """
+    header = memcache.get(cls.CACHE_PREFIX + payload_hash)
+    if header is None:
+      return None
+    count, first = header
+    if count == 1:
+      return first
+    keys = ['%s:%d' % (payload_hash, i) for i in xrange(1, count)]
+    found = memcache.get_multi(keys, key_prefix=cls.CACHE_PREFIX)
+    if len(found) != len(keys):
+      return None
+    return ''.join([first] + [found[k] for k in keys])
+
+  @classmethod
+  def load(cls, payload_hash):
+    """Retrieves a payload through instance memory and memcache.
+
+    Args:
+      payload_hash: The hash of the payload.
+
+    Returns:
+      The payload as a byte string, or None if it does not exist.
+    """
+    payload = EVENT_PAYLOAD_CACHE.get(payload_hash)
+    if payload is None:
+      data = cls.get_cached(payload_hash)
+      if data is None:
+        stored = cls.get_by_key_name(cls.create_key_name(payload_hash))
+        if stored is None:
+          return None
+        data = stored.data
+        cls.cache(payload_hash, data)
+      payload = storage_codec.decode(data)
+      EVENT_PAYLOAD_CACHE.set(payload_hash, payload)
+    return payload
 
 
 class EventToDeliver(db.Expando):
@@ -1443,6 +3238,13 @@ class EventToDeliver(db.Expando):
   totally_failed = db.BooleanProperty(default=False, indexed=False)
   content_type = db.TextProperty(default='')
   max_failures = db.IntegerProperty(indexed=False)
+  # None until the first normal delivery chunk checks for a SubscriberRoster.
+  use_roster = db.BooleanProperty(indexed=False)
+  # Hash of the EventPayload; None for events with an inline 'payload'.
+  payload_hash = db.StringProperty(indexed=False)
+
+  # Payload retrieved or created by this instance, if any.
+  _payload = None
 
   @classmethod
   def create_event_for_topic(cls,
@@ -1456,6 +3258,9 @@ class EventToDeliver(db.Expando):
                              max_failures=None):
     """Creates an event to deliver for a topic and set of published entries.
 
+    Stores the event's payload as an EventPayload, so this must not be called
+    inside a transaction.
+
     Args:
       topic: The topic that had the event.
       format: Format of the feed, 'atom', 'rss', or 'arbitrary'.
@@ -1476,7 +3281,8 @@ class EventToDeliver(db.Expando):
         None (the default) it will use the MAX_DELIVERY_FAILURES constant.
 
     Returns:
-      A new EventToDeliver instance that has not been stored.
+      A new EventToDeliver instance that has not been stored, though its
+      payload has been.
     """
     if format in (ATOM, RSS):
       # This is feed XML.
@@ -1514,14 +3320,31 @@ class EventToDeliver(db.Expando):
     if isinstance(payload, unicode):
       payload = payload.encode('utf-8')
 
-    return cls(
+    event = cls(
         parent=parent,
         topic=topic,
         topic_hash=sha1_hash(topic),
-        payload=db.Blob(payload),
+        payload_hash=EventPayload.store(payload, now=now),
         last_modified=now(),
         content_type=content_type,
         max_failures=max_failures)
+    event._payload = payload
+    return event
+
+  def get_payload(self):
+    """Retrieves the payload to deliver for this event.
+
+    Returns:
+      The payload as a byte string, or None if its EventPayload no longer
+      exists.
+    """
+    if self._payload is None:
+      if self.payload_hash is None:
+        # Events from before payloads were stored separately.
+        self._payload = self.payload
+      else:
+        self._payload = EventPayload.load(self.payload_hash)
+    return self._payload
 
   def get_next_subscribers(self, chunk_size=None):
     """Retrieve the next set of subscribers to attempt delivery for this event.
@@ -1536,14 +3359,23 @@ class EventToDeliver(db.Expando):
           after the returned 'subscription_list' has been contacted; this value
           should be passed to update() after the delivery is attempted.
         subscription_list: List of Subscription entities to attempt to contact
-          for this event.
+          for this event. These are RosterEntry objects instead when normal
+          delivery pages through the topic's SubscriberRoster.
     """
     if chunk_size is None:
       chunk_size = EVENT_SUBSCRIBER_CHUNK_SIZE
 
     if self.delivery_mode == EventToDeliver.NORMAL:
-      all_subscribers = Subscription.get_subscribers(
-          self.topic, chunk_size + 1, starting_at_callback=self.last_callback)
+      all_subscribers = None
+      if self.use_roster is not False:
+        # Rosters and queries share the same order, so delivery can switch
+        # to querying if a roster disappears part way through.
+        all_subscribers = SubscriberRoster.get_subscribers(
+            self.topic, chunk_size + 1, starting_at_callback=self.last_callback)
+        self.use_roster = all_subscribers is not None
+      if all_subscribers is None:
+        all_subscribers = Subscription.get_subscribers(
+            self.topic, chunk_size + 1, starting_at_callback=self.last_callback)
       if all_subscribers:
         self.last_callback = all_subscribers[-1].callback
       else:
@@ -1631,6 +3463,11 @@ class EventToDeliver(db.Expando):
         except OverflowError:
           pass
 
+      if self.payload_hash is not None:
+        # The offline cleanup would otherwise remove the payload of events
+        # that are retried for longer than payloads are kept.
+        EventPayload.refresh(self.payload_hash, self.last_modified)
+
       if self.delivery_mode == EventToDeliver.NORMAL:
         logging.debug('Normal delivery done; %d broken callbacks remain',
                       len(self.failed_callbacks))
@@ -1698,6 +3535,24 @@ class KnownFeed(db.Model):
     """
     return cls(key_name=get_hash_key_name(topic), topic=topic)
 
+  def update_feed_id(self, feed_id):
+    """Updates the ID of this feed and its KnownFeedIdentity mappings.
+
+    Args:
+      feed_id: The feed's newly discovered ID.
+    """
+    logging.info('For topic = %s found new feed ID %r; old feed ID was %r',
+                 self.topic, feed_id, self.feed_id)
+
+    if self.feed_id and self.feed_id != feed_id:
+      logging.info('Removing old feed_id relation from '
+                   'topic = %r to feed_id = %r', self.topic, self.feed_id)
+      KnownFeedIdentity.remove(self.feed_id, self.topic)
+
+    KnownFeedIdentity.update(feed_id, self.topic)
+    self.feed_id = feed_id
+    self.put()
+
   @classmethod
   def record(cls, topic):
     """Enqueues a task to create a new KnownFeed and initiate feed ID discovery.
@@ -1751,10 +3606,111 @@ class KnownFeed(db.Model):
     return result
 
 
+class SubscriberCountShard(db.Model):
+  """Represents one shard of the count of a topic's verified subscribers.
+
+  Subscription changes add to or subtract from a random shard, so the count
+  of a single shard may be negative; the sum of all of a topic's shards is its
+  subscriber count. Each shard is its own entity group so popular topics can
+  change in parallel. An offline job reconciles the sum with a full count of
+  Subscription entities to repair any drift.
+
+  Only the offline job writes the first shard, so a topic without one has
+  not been counted from scratch yet; its count still includes the
+  KnownFeedStats entity saved by the old count job, if any.
+  """
+
+  count = db.IntegerProperty(default=0, indexed=False)
+  last_modified = db.DateTimeProperty(auto_now=True, indexed=False)
+
+  @classmethod
+  def create_key(cls, topic_hash, shard):
+    """Creates a key for a shard of a topic's subscriber count.
+
+    Args:
+      topic_hash: Hash of the topic URL.
+      shard: Index of the shard.
+
+    Returns:
+      db.Key instance.
+    """
+    return datastore_types.Key.from_path(
+        cls.kind(), 'hash_%s/%d' % (topic_hash, shard))
+
+  @classmethod
+  def get_keys(cls, topic_hash):
+    """Returns the keys of all shards of a topic's subscriber count."""
+    return [cls.create_key(topic_hash, i)
+            for i in xrange(SUBSCRIBER_COUNT_SHARD_COUNT)]
+
+  @classmethod
+  def increment(cls, topic, delta):
+    """Changes a topic's subscriber count.
+
+    Failures are logged and left for the offline job to reconcile.
+
+    Args:
+      topic: URL of the topic.
+      delta: Amount to add to the count; may be negative.
+    """
+    key = cls.create_key(
+        sha1_hash(topic), random.randint(1, SUBSCRIBER_COUNT_SHARD_COUNT - 1))
+    def txn():
+      shard = cls.get(key)
+      if shard is None:
+        shard = cls(key=key)
+      shard.count += delta
+      shard.put()
+      return shard
+    try:
+      shard = db.run_in_transaction(txn)
+    except (db.Error, apiproxy_errors.Error):
+      logging.exception('Could not change subscriber count by %d for '
+                        'topic = %s', delta, topic)
+      FEED_STATS_CACHE.invalidate([key])
+    else:
+      FEED_STATS_CACHE.put([shard])
+
+  @classmethod
+  def reconcile(cls, topic_hash, count):
+    """Sets a topic's subscriber count after it was counted from scratch.
+
+    Adjusts the first shard so the sum of all shards equals the new count.
+    Changes made to other shards while the count was computed are lost until
+    the next reconciliation.
+
+    Args:
+      topic_hash: Hash of the topic URL.
+      count: The number of verified subscribers to the topic.
+
+    Returns:
+      True if the count was changed, False if it was already correct.
+    """
+    key_list = cls.get_keys(topic_hash)
+    others = sum(s.count for s in db.get(key_list[1:]) if s is not None)
+    def txn():
+      shard = cls.get(key_list[0])
+      if shard is None:
+        shard = cls(key=key_list[0])
+      elif shard.count + others == count:
+        return None
+      shard.count = count - others
+      shard.put()
+      return shard
+    shard = db.run_in_transaction(txn)
+    if shard is None:
+      return False
+    FEED_STATS_CACHE.put([shard])
+    return True
+
+
 class KnownFeedStats(db.Model):
   """Represents stats about a feed we know that exists.
 
-  Parent is the KnownFeed entity for a given topic URL.
+  Parent is the KnownFeed entity for a given topic URL. The subscriber count
+  is summed from the topic's SubscriberCountShards by get_or_create_all(), so
+  these entities are no longer stored. Those stored by the old count job are
+  still read for topics the offline job has not counted yet.
   """
 
   subscriber_count = db.IntegerProperty()
@@ -1781,25 +3737,56 @@ class KnownFeedStats(db.Model):
                             cls.kind(), 'overall')
 
   @classmethod
-  def get_or_create_all(cls, topic_list):
+  def get_or_create_all(cls, topic_list, async_proxy=None, callback=None):
     """Retrieves and/or creates KnownFeedStats entities for the supplied topics.
 
     Args:
       topic_list: List of topics to retrieve.
+      async_proxy: If not None, AsyncAPIProxy to use for retrieving the
+        entities asynchronously, in which case callback is required.
+      callback: Callable that takes (feed_stats_list, exception), where
+        feed_stats_list is what would have been returned. Exactly one of the
+        two arguments is None.
 
     Returns:
       The list of KnownFeedStats corresponding to the input topic list in
-      the same order they were supplied.
-    """
-    key_list = [cls.create_key(t) for t in topic_list]
-    found_list = db.get(key_list)
-    results = []
-    for topic, key, found in zip(topic_list, key_list, found_list):
-      if found:
-        results.append(found)
+      the same order they were supplied; None if async_proxy was supplied.
+    """
+    step = SUBSCRIBER_COUNT_SHARD_COUNT + 1
+    key_list = []
+    for topic in topic_list:
+      key_list.extend(SubscriberCountShard.get_keys(sha1_hash(topic)))
+      key_list.append(cls.create_key(topic))
+    def create(found_list):
+      results = []
+      for index, topic in enumerate(topic_list):
+        found = found_list[index*step:(index+1)*step]
+        shards = [s for s in found[:-1] if s]
+        count = sum(s.count for s in shards)
+        times = [s.last_modified for s in shards]
+        old_stats = found[-1]
+        if found[0] is None and old_stats is not None:
+          count += old_stats.subscriber_count or 0
+          times.append(old_stats.update_time)
+        update_time = None
+        if times:
+          update_time = max(times)
+        results.append(cls(
+            key=cls.create_key(topic),
+            subscriber_count=max(0, count),
+            update_time=update_time))
+      return results
+
+    if async_proxy is None:
+      return create(FEED_STATS_CACHE.get(key_list))
+
+    def get_callback(found_list, exception):
+      if exception:
+        callback(None, exception)
       else:
-        results.append(cls(key=key, subscriber_count=0))
-    return results
+        callback(create(found_list), None)
+    FEED_STATS_CACHE.get(key_list, async_proxy=async_proxy,
+                         callback=get_callback)
 
 
 class PollingMarker(db.Model):
@@ -1845,6 +3832,11 @@ class PollingMarker(db.Model):
       return False
 
 
+# Each topic URL's set of aliases, as derived by KnownFeedIdentity.
+TOPIC_ALIAS_CACHE = LruCache(TOPIC_ALIAS_LOCAL_CACHE_SIZE,
+                             TOPIC_ALIAS_LOCAL_CACHE_SECONDS)
+
+
 class KnownFeedIdentity(db.Model):
   """Stores a set of known URL aliases for a particular feed."""
 
@@ -1852,6 +3844,26 @@ class KnownFeedIdentity(db.Model):
   topics = db.ListProperty(db.Text)
   last_update = db.DateTimeProperty()
 
+  # Prefix of the memcache keys that cache each topic's set of aliases.
+  ALIASES_PREFIX = 'topic_aliases:'
+
+  @classmethod
+  def forget_aliases(cls, topics):
+    """Clears the cached aliases for a set of topics.
+
+    Only this instance's memory is cleared along with memcache; other
+    instances keep theirs until TOPIC_ALIAS_LOCAL_CACHE_SECONDS pass.
+
+    Args:
+      topics: Iterable of topic URLs.
+    """
+    topics = set(topics)
+    for topic in topics:
+      TOPIC_ALIAS_CACHE.delete(topic)
+    if topics and not memcache.delete_multi(
+        [sha1_hash(t) for t in topics], key_prefix=cls.ALIASES_PREFIX):
+      logging.error('Could not clear aliases for topics %r', list(topics))
+
   @classmethod
   def create_key(cls, feed_id):
     """Creates a key for a KnownFeedIdentity.
@@ -1887,11 +3899,14 @@ class KnownFeedIdentity(db.Model):
       known_feed.put()
       return known_feed
     try:
-      return db.run_in_transaction(txn)
+      known_feed = db.run_in_transaction(txn)
     except (db.BadRequestError, apiproxy_errors.RequestTooLargeError):
       logging.exception(
           'Could not update feed_id=%r; expansion is already too large',
           feed_id)
+    else:
+      cls.forget_aliases(known_feed.topics)
+      return known_feed
 
   @classmethod
   def remove(cls, feed_id, topic):
@@ -1906,13 +3921,17 @@ class KnownFeedIdentity(db.Model):
       did not exist previously or has now been deleted because it has no
       active mappings.
     """
+    # Topics whose aliases change, kept in a list for the closure.
+    changed_topics = []
     def txn():
       known_feed = db.get(cls.create_key(feed_id))
       if not known_feed:
         return None
+      changed_topics[:] = known_feed.topics
       try:
         known_feed.topics.remove(db.Text(topic))
       except ValueError:
+        changed_topics[:] = []
         return None
 
       if not known_feed.topics:
@@ -1922,12 +3941,70 @@ class KnownFeedIdentity(db.Model):
         known_feed.last_update = datetime.datetime.now()
         known_feed.put()
         return known_feed
-    return db.run_in_transaction(txn)
+    known_feed = db.run_in_transaction(txn)
+    cls.forget_aliases(changed_topics)
+    return known_feed
 
   @classmethod
   def derive_additional_topics(cls, topics):
     """Derives topic URL aliases from a set of topics by using feed IDs.
 
+    Aliases are served from this instance's memory, then memcache, and only
+    looked up in the Datastore for the remaining topics. See
+    lookup_additional_topics for how aliases are derived.
+
+    Args:
+      topics: Iterable of topic URLs.
+
+    Returns:
+      Dictionary mapping input topic URLs to their full set of aliases,
+      including the input topic URL.
+    """
+    # Maps topics to tuples of their aliases; empty if they have none.
+    found = {}
+    missing = []
+    for topic in set(topics):
+      aliases = TOPIC_ALIAS_CACHE.get(topic)
+      if aliases is None:
+        missing.append(topic)
+      else:
+        found[topic] = aliases
+
+    if missing:
+      key_list = [sha1_hash(t) for t in missing]
+      cached = memcache.get_multi(key_list, key_prefix=cls.ALIASES_PREFIX)
+      not_cached = []
+      for topic, key in zip(missing, key_list):
+        aliases = cached.get(key)
+        if aliases is None:
+          not_cached.append(topic)
+        else:
+          found[topic] = aliases
+          TOPIC_ALIAS_CACHE.set(topic, aliases)
+
+      if not_cached:
+        looked_up = cls.lookup_additional_topics(not_cached)
+        to_cache = {}
+        for topic in not_cached:
+          aliases = tuple(looked_up.get(topic, ()))
+          found[topic] = aliases
+          to_cache[sha1_hash(topic)] = aliases
+          TOPIC_ALIAS_CACHE.set(topic, aliases)
+        # Added instead of set so a stale lookup can't replace aliases that
+        # were cached after a concurrent change.
+        memcache.add_multi(to_cache, time=TOPIC_ALIAS_CACHE_SECONDS,
+                           key_prefix=cls.ALIASES_PREFIX)
+
+    output_dict = {}
+    for topic, aliases in found.iteritems():
+      if aliases:
+        output_dict[topic] = set(aliases)
+    return output_dict
+
+  @classmethod
+  def lookup_additional_topics(cls, topics):
+    """Looks up topic URL aliases for a set of topics in the Datastore.
+
     If a topic URL has a KnownFeed entry but no valid feed_id or
     KnownFeedIdentity record, the input topic will be echoed in the output
     dictionary directly. This properly handles the case where the feed_id has
@@ -2244,6 +4321,84 @@ class SubscriptionReconfirmHandler(webapp.RequestHandler):
           done_callback_queue=POLLING_QUEUE))
 
 
+def start_mapreduce_pipeline(name, mapper_spec, reducer_spec, entity_kind,
+                             shards):
+  """Starts a MapReduce over every entity of a kind.
+
+  Args:
+    name: Name of the job.
+    mapper_spec, reducer_spec: Names of the map and reduce functions.
+    entity_kind: Name of the model class to map over.
+    shards: Number of shards to run the job with.
+
+  Returns:
+    The ID of the job's pipeline.
+  """
+  job = mapreduce.mapreduce_pipeline.MapreducePipeline(
+      name,
+      mapper_spec,
+      reducer_spec,
+      'mapreduce.input_readers.DatastoreInputReader',
+      mapper_params=dict(entity_kind=entity_kind),
+      shards=shards)
+  # TODO(bslatkin): Pass through the queue name to run the job on. This is
+  # a limitation in the mapper library.
+  job.start()
+  return job.pipeline_id
+
+
+class OfflineJobHandler(webapp.RequestHandler):
+  """Base class for periodic handlers that start a MapReduce once a day.
+
+  Subclasses set the job's NAME, MAPPER_SPEC, REDUCER_SPEC, ENTITY_KIND, and
+  SHARDS, and the TASK_URL they are mapped to.
+  """
+
+  def __init__(self, now=time.time, start_pipeline=start_mapreduce_pipeline):
+    """Initializer."""
+    webapp.RequestHandler.__init__(self)
+    self.now = now
+    self.start_pipeline = start_pipeline
+
+  @work_queue_only
+  def get(self):
+    # Use the name, such that only one of these tasks runs per calendar day.
+    name = '%s-%s' % (self.TASK_URL.split('/')[-1].replace('_', '-'),
+                      time.strftime('%Y-%m-%d', time.gmtime(self.now())))
+    try:
+      taskqueue.Task(url=self.TASK_URL, name=name).add(POLLING_QUEUE)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      logging.exception('Could not enqueue task to start %r; must have '
+                        'already run today.', self.NAME)
+
+  @work_queue_only
+  def post(self):
+    self.start_pipeline(self.NAME, self.MAPPER_SPEC, self.REDUCER_SPEC,
+                        self.ENTITY_KIND, self.SHARDS)
+
+
+class BuildRostersHandler(OfflineJobHandler):
+  """Periodic handler that rebuilds the SubscriberRosters of large topics."""
+
+  TASK_URL = '/work/build_rosters'
+  NAME = 'Build subscriber rosters'
+  MAPPER_SPEC = 'offline_jobs.roster_topic_for_subscription'
+  REDUCER_SPEC = 'offline_jobs.save_roster_for_topic'
+  ENTITY_KIND = 'main.Subscription'
+  SHARDS = 4
+
+
+class CountSubscriptionsHandler(OfflineJobHandler):
+  """Periodic handler that reconciles the subscriber counts of topics."""
+
+  TASK_URL = '/work/count_subscriptions'
+  NAME = 'Count subscriptions'
+  MAPPER_SPEC = 'offline_jobs.count_subscriptions_for_topic'
+  REDUCER_SPEC = 'offline_jobs.save_subscription_counts_for_topic'
+  ENTITY_KIND = 'main.Subscription'
+  SHARDS = 4
+
+
 # TODO(bslatkin): Move this to an offline job.
 class SubscriptionCleanupHandler(webapp.RequestHandler):
   """Background worker for cleaning up deleted Subscription instances."""
@@ -2259,6 +4414,7 @@ class SubscriptionCleanupHandler(webapp.RequestHandler):
         db.delete(subscriptions)
       except (db.Error, apiproxy_errors.Error, runtime.DeadlineExceededError):
         logging.exception('Could not clean-up Subscription instances')
+      Subscription.forget_subscribers([s.topic for s in subscriptions])
 
 
 class CleanupMapperHandler(webapp.RequestHandler):
@@ -2325,17 +4481,19 @@ class PublishHandlerBase(webapp.RequestHandler):
     urls = set(normalize_iri(u) for u in urls)
 
     # Only insert FeedToFetch entities for feeds that are known to have
-    # subscribers. The rest will be ignored.
-    topic_map = KnownFeedIdentity.derive_additional_topics(urls)
-    if not topic_map:
-      urls = set()
-    else:
-      # Expand topic URLs by their feed ID to properly handle any aliases
-      # this feed may have active subscriptions for.
-      urls = set()
-      for topic, value in topic_map.iteritems():
-        urls.update(value)
-      logging.info('Topics with known subscribers: %s', urls)
+    # subscribers. The rest will be ignored. When deferred, the pull worker
+    # does this for all of the topics in its batch at once.
+    if not DEFER_PUBLISH_FILTERING:
+      topic_map = KnownFeedIdentity.derive_additional_topics(urls)
+      if not topic_map:
+        urls = set()
+      else:
+        # Expand topic URLs by their feed ID to properly handle any aliases
+        # this feed may have active subscriptions for.
+        urls = set()
+        for topic, value in topic_map.iteritems():
+          urls.update(value)
+        logging.info('Topics with known subscribers: %s', urls)
 
     source_dict = hooks.execute(derive_sources, self, urls)
 
@@ -2343,7 +4501,8 @@ class PublishHandlerBase(webapp.RequestHandler):
     # double-check if there are any subscribers that need event delivery and
     # will skip any unused feeds.
     try:
-      FeedToFetch.insert(urls, source_dict)
+      FeedToFetch.insert(urls, source_dict,
+                         needs_expansion=DEFER_PUBLISH_FILTERING)
     except (taskqueue.Error, apiproxy_errors.Error, db.Error,
             runtime.DeadlineExceededError, fork_join_queue.Error):
       logging.exception('Failed to insert FeedToFetch records')
@@ -2358,44 +4517,192 @@ class PublishHandlerBase(webapp.RequestHandler):
 class PublishHandler(PublishHandlerBase):
   """End-user accessible handler for the Publish event."""
 
-  def get(self):
-    self.response.out.write(template.render('publish_debug.html', {}))
+  def get(self):
+    self.response.out.write(template.render('publish_debug.html', {}))
+
+  @dos.limit(count=100, period=1)
+  def post(self):
+    self.response.headers['Content-Type'] = 'text/plain'
+
+    mode = self.request.get('hub.mode')
+    if mode.lower() != 'publish':
+      self.response.set_status(400)
+      self.response.out.write('hub.mode MUST be "publish"')
+      return
+
+    urls = set(self.request.get_all('hub.url'))
+    if not urls:
+      self.response.set_status(400)
+      self.response.out.write('MUST supply at least one hub.url parameter')
+      return
+
+    logging.debug('Publish event for %d URLs (showing first 25): %s',
+                  len(urls), list(urls)[:25])
+    error = self.receive_publish(urls, 204, 'hub.url')
+    if error:
+      self.response.out.write(error)
+
+################################################################################
+# Pulling
+
+def get_content_hash_rules(topic):
+  """Returns the CONTENT_HASH_RULES that apply to a topic.
+
+  Args:
+    topic: The topic URL.
+
+  Returns:
+    The feed_diff.CanonicalizationRules for the topic URL, for its domain or
+    closest parent domain, or the default rules, in that order; None if no
+    rules apply.
+  """
+  if not CONTENT_HASH_RULES:
+    return None
+  rules = CONTENT_HASH_RULES.get(topic)
+  if rules is not None:
+    return rules
+  labels = urlparse.urlparse(topic)[1].split(':')[0].lower().split('.')
+  for index in xrange(len(labels)):
+    rules = CONTENT_HASH_RULES.get('.'.join(labels[index:]))
+    if rules is not None:
+      return rules
+  return CONTENT_HASH_RULES.get('')
+
+
+def diff_entries(topic, entries, seen_entries=None, format=None):
+  """Determines which of a feed's entries are new or have changed.
+
+  Entries are compared by the hash of their canonical form when
+  CONTENT_HASH_RULES apply to the topic, so changes to masked parts alone do
+  not make an entry look changed.
+
+  Hashes saved before entries were sliced out of documents by the zero-copy
+  parser were taken from entries rebuilt by feed_diff.filter(). When a known
+  entry's hash does not match and the format is given, the entry is rebuilt
+  the same way and is unchanged if that hash matches; the digest is then
+  rewritten with the new hash so the entry is only rebuilt once.
+
+  Args:
+    topic: The topic URL of the feed.
+    entries: List of (entry_id, content) tuples.
+    seen_entries: SeenEntries digest for the topic, or None to look up the
+      entries' FeedEntryRecords instead.
+    format: The string 'atom' or 'rss' to match hashes saved from
+      feed_diff.filter() output, or None to only match the content as given.
+
+  Returns:
+    List with a tuple (content_hash, raw_content_hash) of sha1 hashes of the
+    canonical and raw content of each entry that is new or has changed, or
+    None for entries that are unchanged, in the same order as the entries
+    argument. Both hashes are the same if no rules apply.
+  """
+  raw_hashes = [sha1_hash(content) for (entry_id, content) in entries]
+  rules = get_content_hash_rules(topic)
+  if rules is None:
+    content_hashes = raw_hashes
+  else:
+    content_hashes = [sha1_hash(rules.canonicalize(content))
+                      for (entry_id, content) in entries]
+
+  if seen_entries is not None:
+    seen_entries.add_legacy_records([entry_id for (entry_id, c) in entries])
+    is_unchanged = seen_entries.is_unchanged
+    is_known = seen_entries.__contains__
+  else:
+    STEP = MAX_FEED_ENTRY_RECORD_LOOKUPS
+    existing_entries = []
+    for position in xrange(0, len(entries), STEP):
+      existing_entries.extend(FeedEntryRecord.get_entries_for_topic(
+          topic, [i for (i, c) in entries[position:position+STEP]]))
+    existing_dict = dict((e.id_hash, e.entry_content_hash)
+                         for e in existing_entries)
+    is_unchanged = lambda id_hash, content_hash, raw_hash: (
+        existing_dict.get(id_hash) in (content_hash, raw_hash))
+    is_known = existing_dict.__contains__
+
+  def is_legacy_unchanged(id_hash, content):
+    if format is None or not is_known(id_hash):
+      return False
+    legacy_content = feed_diff.filter_entry(content, format)
+    if legacy_content is None or legacy_content == content:
+      return False
+    legacy_raw_hash = sha1_hash(legacy_content)
+    if rules is None:
+      legacy_hash = legacy_raw_hash
+    else:
+      legacy_hash = sha1_hash(rules.canonicalize(legacy_content))
+    return is_unchanged(id_hash, legacy_hash, legacy_raw_hash)
+
+  results = []
+  for (entry_id, content), content_hash, raw_hash in zip(
+      entries, content_hashes, raw_hashes):
+    id_hash = sha1_hash(entry_id)
+    if is_unchanged(id_hash, content_hash, raw_hash):
+      results.append(None)
+    elif is_legacy_unchanged(id_hash, content):
+      if seen_entries is not None:
+        seen_entries.add(id_hash, content_hash, raw_hash)
+      results.append(None)
+    else:
+      results.append((content_hash, raw_hash))
+  return results
+
+
+class ParseBudget(object):
+  """Budget for the bytes of entry payloads kept while diffing a feed."""
+
+  def __init__(self, max_bytes):
+    """Initializer.
+
+    Args:
+      max_bytes: Maximum total size of the entry payloads to keep.
+    """
+    self.remaining = max_bytes
+    self.entries = 0
+    self.exceeded = False
 
-  @dos.limit(count=100, period=1)
-  def post(self):
-    self.response.headers['Content-Type'] = 'text/plain'
+  def charge(self, payload):
+    """Charges an entry payload against the budget.
 
-    mode = self.request.get('hub.mode')
-    if mode.lower() != 'publish':
-      self.response.set_status(400)
-      self.response.out.write('hub.mode MUST be "publish"')
-      return
+    The first entry always fits, so a feed with a single oversized entry still
+    makes progress.
 
-    urls = set(self.request.get_all('hub.url'))
-    if not urls:
-      self.response.set_status(400)
-      self.response.out.write('MUST supply at least one hub.url parameter')
-      return
+    Args:
+      payload: The entry's payload.
 
-    logging.debug('Publish event for %d URLs (showing first 25): %s',
-                  len(urls), list(urls)[:25])
-    error = self.receive_publish(urls, 204, 'hub.url')
-    if error:
-      self.response.out.write(error)
+    Returns:
+      True if the entry fits in the budget and should be kept, False if it
+      and any later entries should be dropped.
+    """
+    if self.exceeded or (self.entries and len(payload) > self.remaining):
+      self.exceeded = True
+      return False
+    self.remaining -= len(payload)
+    self.entries += 1
+    return True
 
-################################################################################
-# Pulling
 
-def find_feed_updates(topic, format, feed_content,
-                      filter_feed=feed_diff.filter):
+def find_feed_updates(topic, format, feed_content, filter_feed=None,
+                      seen_entries=None, budget=None, stop_early=True):
   """Determines the updated entries for a feed and returns their records.
 
+  Unless a filter_feed function is supplied, the feed is diffed incrementally
+  and parsing stops after MAX_SEEN_ENTRY_RUN consecutive entries that are
+  already known; see find_feed_updates_incremental().
+
   Args:
     topic: The topic URL of the feed.
     format: The string 'atom', 'rss', or 'arbitrary'.
     feed_content: The content of the feed, which may include unicode characters.
       For arbitrary content, this is just the content itself.
     filter_feed: Used for dependency injection.
+    seen_entries: SeenEntries digest for the topic, or None to look up each
+      entry's FeedEntryRecord instead.
+    budget: ParseBudget for the new or updated entries that are returned, or
+      None for no limit. Entries past the budget are dropped; check its
+      exceeded attribute afterwards.
+    stop_early: False to diff the whole document even if a run of seen entries
+      is found, such as when the last parse was cut short by its budget.
 
   Returns:
     Tuple (header_footer, entry_list, entry_payloads) where:
@@ -2413,39 +4720,111 @@ def find_feed_updates(topic, format, feed_content,
   if format == ARBITRARY:
     return (feed_content, [], [])
 
+  if filter_feed is None:
+    if MAX_SEEN_ENTRY_RUN > 0:
+      return find_feed_updates_incremental(
+          topic, format, feed_content, seen_entries=seen_entries,
+          budget=budget, stop_early=stop_early)
+    filter_feed = feed_diff.zero_copy_filter
+
   header_footer, entries_map = filter_feed(feed_content, format)
 
   # Find the new entries we've never seen before, and any entries that we
   # knew about that have been updated.
-  STEP = MAX_FEED_ENTRY_RECORD_LOOKUPS
-  all_keys = entries_map.keys()
-  existing_entries = []
-  for position in xrange(0, len(all_keys), STEP):
-    key_set = all_keys[position:position+STEP]
-    existing_entries.extend(FeedEntryRecord.get_entries_for_topic(
-        topic, key_set))
-
-  existing_dict = dict((e.id_hash, e.entry_content_hash)
-                       for e in existing_entries if e)
-  logging.debug('Retrieved %d feed entries, %d of which have been seen before',
-                len(entries_map), len(existing_dict))
+  entries = entries_map.items()
+  content_hashes = diff_entries(topic, entries, seen_entries=seen_entries,
+                                format=format)
 
   entities_to_save = []
   entry_payloads = []
-  for entry_id, new_content in entries_map.iteritems():
-    new_content_hash = sha1_hash(new_content)
-    new_entry_id_hash = sha1_hash(entry_id)
-    # Mark the entry as new if the sha1 hash is different.
-    try:
-      old_content_hash = existing_dict[new_entry_id_hash]
-      if old_content_hash == new_content_hash:
-        continue
-    except KeyError:
-      pass
-
+  for (entry_id, new_content), new_content_hashes in zip(entries,
+                                                         content_hashes):
+    if new_content_hashes is None:
+      continue
+    if budget is not None and not budget.charge(new_content):
+      break
     entry_payloads.append(new_content)
     entities_to_save.append(FeedEntryRecord.create_entry_for_topic(
-        topic, entry_id, new_content_hash))
+        topic, entry_id, *new_content_hashes))
+
+  logging.debug('Retrieved %d feed entries, %d of which are unchanged',
+                len(entries), len(entries) - len(entry_payloads))
+  return header_footer, entities_to_save, entry_payloads
+
+
+def find_feed_updates_incremental(topic, format, feed_content,
+                                  seen_entries=None, budget=None,
+                                  stop_early=True):
+  """Determines the updated entries for a feed, stopping at known entries.
+
+  Entries are diffed in batches as they are parsed. Once a run of
+  MAX_SEEN_ENTRY_RUN consecutive unchanged entries is found the rest of the
+  document is skipped, on the assumption that the feed lists its entries
+  newest-first. Feeds that list entries oldest-first are caught by checking
+  the last entry in the document up front: if it's new or changed, the whole
+  document is diffed.
+
+  Parsing also stops once the budget is exceeded, so oversized feeds never
+  have all of their new entries in memory at once.
+
+  Args:
+    topic: The topic URL of the feed.
+    format: The string 'atom' or 'rss'.
+    feed_content: The content of the feed.
+    seen_entries: SeenEntries digest for the topic, or None to look up each
+      entry's FeedEntryRecord instead.
+    budget: ParseBudget for the new or updated entries, or None for no limit.
+    stop_early: False to diff the whole document regardless of seen entries.
+
+  Returns:
+    Tuple (header_footer, entry_list, entry_payloads); see find_feed_updates().
+
+  Raises:
+    xml.sax.SAXException if there is a parse error.
+    feed_diff.Error if the feed could not be diffed for any other reason.
+  """
+  can_stop = False
+  last_entry = None
+  if stop_early:
+    last_entry = feed_diff.get_last_entry(feed_content, format)
+  if last_entry is not None:
+    can_stop = diff_entries(topic, [last_entry], seen_entries=seen_entries,
+                            format=format) == [None]
+
+  entities_to_save = []
+  entry_payloads = []
+  seen_ids = set()
+  stats = {'diffed': 0, 'run': 0}
+
+  def diff_batch(batch):
+    if budget is not None and budget.exceeded:
+      return True
+    # The SAX fallback hands over every entry, including ones already diffed.
+    batch = [(i, c) for (i, c) in batch if i not in seen_ids]
+    seen_ids.update(i for (i, c) in batch)
+    stats['diffed'] += len(batch)
+
+    content_hashes = diff_entries(topic, batch, seen_entries=seen_entries,
+                                  format=format)
+    for (entry_id, new_content), new_content_hashes in zip(batch,
+                                                           content_hashes):
+      if new_content_hashes is None:
+        stats['run'] += 1
+        continue
+      stats['run'] = 0
+      if budget is not None and not budget.charge(new_content):
+        return True
+      entry_payloads.append(new_content)
+      entities_to_save.append(FeedEntryRecord.create_entry_for_topic(
+          topic, entry_id, *new_content_hashes))
+
+    return can_stop and stats['run'] >= MAX_SEEN_ENTRY_RUN
+
+  header_footer, entries_map = feed_diff.incremental_filter(
+      feed_content, format, diff_batch,
+      batch_size=INCREMENTAL_DIFF_BATCH_SIZE)
+  logging.debug('Retrieved %d feed entries, %d of which are unchanged',
+                stats['diffed'], stats['diffed'] - len(entry_payloads))
 
   return header_footer, entities_to_save, entry_payloads
 
@@ -2523,11 +4902,295 @@ def inform_event(event_to_deliver, alternate_topics):
   pass
 
 
+def update_feed_id(feed_record, header_footer, format):
+  """Records the ID of a feed that was pulled, if it has changed.
+
+  The ID is found in the feed's header/footer from the diff, so the document
+  doesn't need to be fetched or parsed again by RecordFeedHandler. Must only
+  be called once the parse's transaction has committed, so the ID is never
+  recorded from a parse that is thrown away. The FeedRecord's feed_id is then
+  saved in a transaction of its own. Failures are logged and retried on the
+  next pull. FeedRecords saved before feed IDs were kept on them only have
+  the ID filled in if the KnownFeed already has the same one.
+
+  Args:
+    feed_record: The FeedRecord object of the topic that was parsed.
+    header_footer: The header/footer data of the feed.
+    format: The string 'atom' or 'rss'.
+  """
+  try:
+    feed_id = feed_identifier.identify(utf8encoded(header_footer), format)
+  except xml.sax.SAXException, e:
+    logging.debug('Could not identify feed for topic %r. %s: %s',
+                  feed_record.topic, e.__class__.__name__, e)
+    return
+  if not feed_id or feed_id == feed_record.feed_id:
+    return
+
+  known_feed = (KnownFeed.get(KnownFeed.create_key(feed_record.topic)) or
+                KnownFeed.create(feed_record.topic))
+  if known_feed.feed_id != feed_id:
+    try:
+      known_feed.update_feed_id(feed_id)
+    except (db.Error, apiproxy_errors.Error):
+      logging.exception('Could not record feed ID %r for topic %r',
+                        feed_id, feed_record.topic)
+      return
+
+  def txn():
+    current = FeedRecord.get(feed_record.key())
+    if current is not None:
+      current.feed_id = feed_id
+      current.put()
+    return current
+  try:
+    current = db.run_in_transaction(txn)
+  except (db.Error, apiproxy_errors.Error):
+    logging.exception('Could not save feed ID %r for topic %r',
+                      feed_id, feed_record.topic)
+    FEED_RECORD_CACHE.invalidate([feed_record.key()])
+    return
+  feed_record.feed_id = feed_id
+  if current is not None:
+    FEED_RECORD_CACHE.put([current])
+
+
+def get_parse_formats(feed_record, headers, content):
+  """Yields the formats to try parsing a feed document with, in order.
+
+  The format that last parsed correctly is cached on the FeedRecord and tried
+  first. Otherwise, or if parsing with it fails, the format is sniffed from the
+  start of the document. Arbitrary content is always tried last, and is never
+  trusted from the cache since a publisher may serve an error page once.
+
+  Args:
+    feed_record: The FeedRecord object of the topic that has new content.
+    headers: Dictionary of response headers found during feed fetching.
+    content: The feed document.
+  """
+  tried = []
+  if feed_record.format in (ATOM, RSS):
+    tried.append(feed_record.format)
+    yield feed_record.format
+
+  format = feed_diff.sniff_format(content)
+  if format is None:
+    # The sniffer couldn't tell. The content-type header is extremely
+    # unreliable for determining the feed's format, so only use it as a hint
+    # for which format to try first, with a bias towards Atom content.
+    content_type = (headers.get('Content-Type') or
+                    feed_record.content_type or '')
+    if 'rss' in content_type.lower():
+      order = (RSS, ATOM, ARBITRARY)
+    else:
+      order = (ATOM, RSS, ARBITRARY)
+  elif format == ARBITRARY:
+    order = (ARBITRARY,)
+  else:
+    order = (format, ARBITRARY)
+
+  for format in order:
+    if format not in tried:
+      yield format
+
+
+def diff_feed(feed_record, headers, content, seen_entries):
+  """Parses a feed document and determines its new or updated entries.
+
+  Each format from get_parse_formats() is tried in turn. This does no
+  Datastore work as long as seen_entries is supplied.
+
+  Args:
+    feed_record: The FeedRecord object of the topic that has new content.
+    headers: Dictionary of response headers found during feed fetching.
+    content: The feed document possibly containing new entries.
+    seen_entries: SeenEntries digest for the topic.
+
+  Returns:
+    Tuple (format, header_footer, entities_to_save, entry_payloads,
+    over_budget), or None if the document is beyond hope: it could not be
+    parsed in any format or its character encoding is not supported.
+  """
+  stop_early = feed_record.can_stop_early(seen_entries)
+  for format in get_parse_formats(feed_record, headers, content):
+    budget = ParseBudget(MAX_FEED_PARSE_BYTES)
+    try:
+      header_footer, entities_to_save, entry_payloads = find_feed_updates(
+          feed_record.topic, format, content, seen_entries=seen_entries,
+          budget=budget, stop_early=stop_early)
+      return (format, header_footer, entities_to_save, entry_payloads,
+              budget.exceeded)
+    except (xml.sax.SAXException, feed_diff.Error), e:
+      error_traceback = traceback.format_exc()
+      logging.debug(
+          'Could not get entries for content of %d bytes in format "%s" '
+          'for topic %r:\n%s',
+          len(content), format, feed_record.topic, error_traceback)
+    except LookupError, e:
+      error_traceback = traceback.format_exc()
+      logging.warning('Could not decode encoding of feed document %s\n%s',
+                      feed_record.topic, error_traceback)
+      return None
+
+  logging.error('Could not parse feed %r; giving up:\n%s',
+                feed_record.topic, error_traceback)
+  return None
+
+
+def diff_feed_in_worker(topic, format, content_type, over_budget,
+                        last_full_diff, header_content_type, content,
+                        packed_seen_entries):
+  """Runs diff_feed() in a ParsePool worker process.
+
+  Only plain values cross the process boundary: the parts of the FeedRecord
+  that diff_feed() uses, and the encoded FeedEntryRecords that it returns.
+
+  Returns:
+    Tuple (result, seen_entries) where result is the return value of
+    diff_feed() with its entities encoded as protocol buffers, and
+    seen_entries is the SeenEntries digest after diffing, with the entries
+    that were seen and the number of entries it suppressed.
+  """
+  feed_record = FeedRecord(topic=topic, format=format,
+                           content_type=content_type, over_budget=over_budget,
+                           last_full_diff=last_full_diff)
+  headers = {}
+  if header_content_type is not None:
+    headers['Content-Type'] = header_content_type
+  seen_entries = SeenEntries(packed_seen_entries)
+  result = diff_feed(feed_record, headers, content, seen_entries)
+  if result is not None:
+    format, header_footer, entities_to_save, entry_payloads, over_budget = (
+        result)
+    result = (format, header_footer,
+              [db.model_to_protobuf(e).Encode() for e in entities_to_save],
+              entry_payloads, over_budget)
+  return result, seen_entries
+
+
+class ParsePool(object):
+  """Pool of worker processes that run diff_feed() for PullFeedHandler.
+
+  The pool is started on first use with PARSE_POOL_SIZE workers. Its results
+  are exactly what diff_feed() would return inline; Datastore work stays in
+  the request thread.
+  """
+
+  def __init__(self):
+    """Initializer."""
+    self.pool = None
+    self.size = 0
+
+  def get_pool(self):
+    """Returns the multiprocessing pool, or None to parse feeds inline."""
+    if self.size != PARSE_POOL_SIZE:
+      self.close()
+      if PARSE_POOL_SIZE > 0:
+        try:
+          import multiprocessing
+        except ImportError:
+          logging.error('multiprocessing is not available; parsing feeds '
+                        'inline')
+        else:
+          self.pool = multiprocessing.Pool(PARSE_POOL_SIZE)
+      self.size = PARSE_POOL_SIZE
+    return self.pool
+
+  def close(self):
+    """Stops the worker processes, if any."""
+    if self.pool is not None:
+      self.pool.terminate()
+      self.pool = None
+    self.size = 0
+
+  def submit(self, feed_record, headers, content, seen_entries):
+    """Starts diffing a feed document in a worker process.
+
+    Args:
+      feed_record: The FeedRecord object of the topic that has new content.
+      headers: Dictionary of response headers found during feed fetching.
+      content: The feed document.
+      seen_entries: SeenEntries digest for the topic.
+
+    Returns:
+      Handle to pass to get_result(), or None if there is no pool or the
+      digest is still being built from FeedEntryRecords, which needs the
+      Datastore.
+    """
+    if seen_entries.legacy_topic is not None:
+      return None
+    pool = self.get_pool()
+    if pool is None:
+      return None
+    return pool.apply_async(diff_feed_in_worker, (
+        feed_record.topic, feed_record.format, feed_record.content_type,
+        feed_record.over_budget, feed_record.last_full_diff,
+        headers.get('Content-Type'), content, seen_entries.pack()))
+
+  @staticmethod
+  def get_result(handle, seen_entries):
+    """Waits for the result of a document submitted to the pool.
+
+    Args:
+      handle: Return value of submit().
+      seen_entries: The SeenEntries digest passed to submit(); it is updated
+        with the entries the worker saw.
+
+    Returns:
+      The return value of diff_feed().
+    """
+    result, worker_seen_entries = handle.get()
+    seen_entries.copy_from(worker_seen_entries)
+    if result is not None:
+      format, header_footer, entities_to_save, entry_payloads, over_budget = (
+          result)
+      result = (format, header_footer,
+                [db.model_from_protobuf(entity_pb.EntityProto(e))
+                 for e in entities_to_save],
+                entry_payloads, over_budget)
+    return result
+
+
+PARSE_POOL = ParsePool()
+
+
+def plan_put_batches(entity_list, max_count, max_bytes):
+  """Groups entities into batches that each fit in a single put() call.
+
+  Entities keep their order. An entity larger than max_bytes by itself gets
+  a batch of its own.
+
+  Args:
+    entity_list: List of db.Model instances to save.
+    max_count: Maximum number of entities in a batch.
+    max_bytes: Maximum total size of the encoded entities in a batch.
+
+  Returns:
+    List of lists of db.Model instances.
+  """
+  batch_list = []
+  batch = []
+  batch_bytes = 0
+  for entity in entity_list:
+    size = len(db.model_to_protobuf(entity).Encode())
+    if batch and (len(batch) >= max_count or batch_bytes + size > max_bytes):
+      batch_list.append(batch)
+      batch = []
+      batch_bytes = 0
+    batch.append(entity)
+    batch_bytes += size
+  if batch:
+    batch_list.append(batch)
+  return batch_list
+
+
 def parse_feed(feed_record,
                headers,
                content,
                true_on_bad_feed=True,
-               alternate_topics=None):
+               alternate_topics=None,
+               seen_entries=None,
+               diff_result=None):
   """Parses a feed's content, determines changes, enqueues notifications.
 
   This function will only enqueue new notifications if the feed has changed.
@@ -2543,50 +5206,25 @@ def parse_feed(feed_record,
       response to this function.
     alternate_topics: A list of alternative Feed topics that this parsed event
       should be delievered for in addition to the main FeedRecord's topic.
+    seen_entries: SeenEntries digest for the topic, if already retrieved.
+    diff_result: Return value of diff_feed() for the content, if the feed was
+      already diffed by the ParsePool.
 
   Returns:
-    True if successfully parsed the feed content; False on error.
+    True if successfully parsed the feed content, or if the rest of its new
+    entries will be parsed by a FeedContinuation; False on error.
   """
-  # The content-type header is extremely unreliable for determining the feed's
-  # content-type. Using a regex search for "<rss" could work, but an RE is
-  # just another thing to maintain. Instead, try to parse the content twice
-  # and use any hints from the content-type as best we can. This has
-  # a bias towards Atom content (let's cross our fingers!). We save the format
-  # of the last successful parse in the feed_record instance to speed this up
-  # for the next time through.
-  if 'rss' in (feed_record.format or feed_record.content_type or ''):
-    order = (RSS, ATOM, ARBITRARY)
-  else:
-    order = (ATOM, RSS, ARBITRARY)
-
-  parse_failures = 0
-  for format in order:
-    # Parse the feed. If this fails we will give up immediately.
-    try:
-      header_footer, entities_to_save, entry_payloads = find_feed_updates(
-          feed_record.topic, format, content)
-      break
-    except (xml.sax.SAXException, feed_diff.Error), e:
-      error_traceback = traceback.format_exc()
-      logging.debug(
-          'Could not get entries for content of %d bytes in format "%s" '
-          'for topic %r:\n%s',
-          len(content), format, feed_record.topic, error_traceback)
-      parse_failures += 1
-    except LookupError, e:
-      error_traceback = traceback.format_exc()
-      logging.warning('Could not decode encoding of feed document %s\n%s',
-                      feed_record.topic, error_traceback)
-      # Yes-- returning True here. This feed is beyond all hope because we just
-      # don't support this character encoding presently.
-      return true_on_bad_feed
-
-  if parse_failures == len(order):
-    logging.error('Could not parse feed %r; giving up:\n%s',
-                  feed_record.topic, error_traceback)
+  if seen_entries is None:
+    seen_entries = feed_record.get_seen_entries()
+  full_diff = not feed_record.can_stop_early(seen_entries)
+  if diff_result is None:
+    diff_result = diff_feed(feed_record, headers, content, seen_entries)
+  if diff_result is None:
     # That's right, we return True. This will cause the fetch to be
     # abandoned on parse failures because the feed is beyond hope!
     return true_on_bad_feed
+  (format, header_footer, entities_to_save, entry_payloads,
+   over_budget) = diff_result
 
   # If we have more entities than we'd like to handle, only save a subset of
   # them and force this task to retry as if it failed. This will cause two
@@ -2598,9 +5236,22 @@ def parse_feed(feed_record,
     entities_to_save = entities_to_save[:MAX_NEW_FEED_ENTRY_RECORDS]
     entry_payloads = entry_payloads[:MAX_NEW_FEED_ENTRY_RECORDS]
     parse_successful = False
+  elif over_budget:
+    # Same for documents whose new entries would take too much memory; the
+    # entries that did not fit are found when the fetch is retried.
+    logging.warning('Feed for topic %r exceeded its parse budget; saving '
+                    'the first %d new entries', feed_record.topic,
+                    len(entities_to_save))
+    parse_successful = False
   else:
-    feed_record.update(headers, header_footer, format)
+    feed_record.update(headers, header_footer, format, content=content)
     parse_successful = True
+    if full_diff:
+      feed_record.last_full_diff = datetime.datetime.utcnow()
+
+  # Entries that were cut off may come after a run of seen entries.
+  was_over_budget = feed_record.over_budget
+  feed_record.over_budget = not parse_successful
 
   if format != ARBITRARY and not entities_to_save:
     logging.debug('No new entries found')
@@ -2614,39 +5265,86 @@ def parse_feed(feed_record,
     event_to_deliver = EventToDeliver.create_event_for_topic(
         feed_record.topic, format, feed_record.content_type,
         header_footer, entry_payloads)
-    entities_to_save.insert(0, event_to_deliver)
-
-  entities_to_save.insert(0, feed_record)
-
-  # Segment all entities into smaller groups to reduce the chance of memory
-  # errors or too large of requests when the entities are put in a single
-  # call to the Datastore API.
-  all_entities = []
-  STEP = MAX_FEED_RECORD_SAVES
-  for position in xrange(0, len(entities_to_save), STEP):
-    next_entities = entities_to_save[position:position+STEP]
-    all_entities.append(next_entities)
-
-  # Doing this put in a transaction ensures that we have written all
-  # FeedEntryRecords, updated the FeedRecord, and written the EventToDeliver
-  # at the same time. Otherwise, if any of these fails individually we could
-  # drop messages on the floor. If this transaction fails, the whole fetch
-  # will be redone and find the same entries again (thus it is idempotent).
+
+  # The topic's digest of seen entries is saved along with the FeedRecord, so
+  # the per-entry records are only needed if they're kept as a fallback.
+  loaded = {'seen_entries': feed_record.seen_entries,
+            'suppressed_entries': feed_record.suppressed_entries or 0}
+  feed_record.add_seen_entries(seen_entries, entities_to_save)
+  suppressed = (feed_record.suppressed_entries or 0) - (
+      loaded['suppressed_entries'])
+  if SAVE_FEED_ENTRY_RECORDS:
+    entry_records = entities_to_save
+  else:
+    entry_records = []
+  entities_to_save = [feed_record]
+  if event_to_deliver:
+    entities_to_save.append(event_to_deliver)
+
+  # Keep the document of a cut-off parse so a task can diff it again for the
+  # rest of its entries, without fetching it again and without the backoff of
+  # a failed fetch.
+  continuation = None
+  if not parse_successful:
+    continuation = FeedContinuation.create(
+        feed_record.topic, headers, content, alternate_topics)
+    if continuation is not None:
+      entities_to_save.append(continuation)
+    else:
+      logging.warning('Feed document for topic %r is too large to keep; it '
+                      'will be fetched again', feed_record.topic)
+
+  # Segment all entities into groups that fit in a single call to the
+  # Datastore API, based on their encoded sizes, so the transaction below
+  # does not have to be retried to find out.
+  all_entities = plan_put_batches(
+      entities_to_save, MAX_FEED_RECORD_SAVES, MAX_FEED_RECORD_SAVE_BYTES)
+
+  # Doing this put in a transaction ensures that we have updated the
+  # FeedRecord's digest of seen entries, written the EventToDeliver, and
+  # enqueued its delivery at the same time. Otherwise, if any of these fails
+  # individually we could drop messages on the floor or deliver them twice. If
+  # this transaction fails, the whole fetch will be redone and find the same
+  # entries again (thus it is idempotent). FeedEntryRecords are saved by a
+  # task enqueued along with the event, since the digest is what keeps
+  # entries from being delivered again; they are their own entity groups, so
+  # saving them adds no writes to the FeedRecord's.
   def txn():
-    while all_entities:
-      group = all_entities.pop(0)
+    # Another parse of the topic may have saved the FeedRecord since it was
+    # read, so the entries it saw are merged in instead of being lost. The
+    # rest of the FeedRecord describes the latest document either way.
+    current = FeedRecord.get(feed_record.key())
+    if (current is not None and
+        current.seen_entries != loaded['seen_entries']):
+      logging.info('Merging digest of seen entries saved concurrently for '
+                   'topic %r', feed_record.topic)
+      seen_entries.merge(current.seen_entries)
+      feed_record.seen_entries = db.Blob(seen_entries.pack())
+      feed_record.suppressed_entries = (
+          (current.suppressed_entries or 0) + suppressed)
+      loaded['seen_entries'] = current.seen_entries
+    for index, group in enumerate(all_entities):
       try:
         db.put(group)
       except (db.BadRequestError, apiproxy_errors.RequestTooLargeError):
         logging.exception('Could not insert %d entities for topic %r; '
                           'splitting in half', len(group), feed_record.topic)
-        # Insert the first half at the beginning since we need to make sure that
-        # the EventToDeliver gets inserted first.
-        all_entities.insert(0, group[len(group)/2:])
-        all_entities.insert(0, group[:len(group)/2])
+        # Keep the halves in place since we need to make sure that the
+        # FeedRecord and EventToDeliver get inserted first. All groups are put
+        # again when the transaction is retried, including the FeedRecord with
+        # its updated count of splits.
+        all_entities[index:index+1] = [group[:len(group)/2],
+                                       group[len(group)/2:]]
+        feed_record.put_splits = (feed_record.put_splits or 0) + 1
         raise
     if event_to_deliver:
       event_to_deliver.enqueue()
+    if entry_records:
+      FeedEntryRecord.enqueue_save(feed_record.topic, entry_records)
+    if continuation is not None:
+      continuation.enqueue()
+    elif parse_successful and was_over_budget:
+      db.delete(FeedContinuation.create_key(feed_record.topic))
 
   try:
     for i in xrange(PUT_SPLITTING_ATTEMPTS):
@@ -2665,45 +5363,135 @@ def parse_feed(feed_record,
     # this retry for us. This ensures the queue throughputs stay consistent.
     logging.exception('Could not submit transaction for topic %r',
                       feed_record.topic)
+    # The transaction may still have committed.
+    FEED_RECORD_CACHE.invalidate([feed_record.key()])
     return False
 
+  FEED_RECORD_CACHE.put([feed_record])
+  if format != ARBITRARY:
+    update_feed_id(feed_record, header_footer, format)
+
   # Inform any hooks that there will is a new event to deliver that has
   # been recorded and delivery has begun.
   hooks.execute(inform_event, event_to_deliver, alternate_topics)
 
-  return parse_successful
+  return parse_successful or continuation is not None
 
 
 class PullFeedHandler(webapp.RequestHandler):
   """Background worker for pulling feeds."""
 
-  def _handle_fetches(self, feed_list):
-    """Handles a set of FeedToFetch records that need to be fetched."""
-    ready_feed_list = []
+  def _expand_topics(self, feed_list, stored=False):
+    """Expands FeedToFetch records that were published without filtering.
+
+    Records for topics that aren't known feeds are dropped, and finished right
+    away if they were stored in the Datastore; records popped from the
+    fork-join queue only lived in memory. The aliases of the rest are added
+    to the batch, unless already in it.
+
+    Args:
+      feed_list: List of FeedToFetch records to expand.
+      stored: True if the records were read from the Datastore.
+
+    Returns:
+      List of FeedToFetch records that need to be fetched.
+    """
+    unexpanded_list = [f for f in feed_list if f.needs_expansion]
+    if not unexpanded_list:
+      return feed_list
+
+    topic_map = KnownFeedIdentity.derive_additional_topics(
+        [f.topic for f in unexpanded_list])
+    batch_topics = set(f.topic for f in feed_list)
+    expanded_list = [f for f in feed_list if not f.needs_expansion]
+    for work in unexpanded_list:
+      aliases = topic_map.get(work.topic)
+      if not aliases:
+        logging.debug('Ignoring event for topic %s because it is not a '
+                      'known feed', work.topic)
+        if stored:
+          work.done()
+        continue
+
+      # Expanded records must not be expanded again if they are retried.
+      work.needs_expansion = False
+      expanded_list.append(work)
+      for alias in aliases:
+        if alias in batch_topics:
+          continue
+        batch_topics.add(alias)
+        expanded_list.append(FeedToFetch(
+            key=db.Key.from_path(FeedToFetch.kind(), get_hash_key_name(alias)),
+            topic=alias,
+            source_keys=work.source_keys,
+            source_values=work.source_values,
+            work_index=work.work_index))
+    return expanded_list
+
+  def _handle_fetches(self, feed_list, stored=False):
+    """Handles a set of FeedToFetch records that need to be fetched.
+
+    Args:
+      feed_list: List of FeedToFetch records to fetch.
+      stored: True if the records were read from the Datastore rather than
+        popped from the fork-join queue.
+    """
+    feed_list = self._expand_topics(feed_list, stored=stored)
     scorer_results = FETCH_SCORER.filter([f.topic for f in feed_list])
+    allowed_feed_list = []
     for to_fetch, (allow, percent) in zip(feed_list, scorer_results):
       if not allow:
         logging.warning('Scoring prevented fetch of %r '
                         'with failure rate %.2f%%',
                         to_fetch.topic, 100 * percent)
         to_fetch.done()
-      elif not Subscription.has_subscribers(to_fetch.topic):
-        logging.debug('Ignoring event because there are no subscribers '
-                      'for topic %s', to_fetch.topic)
-        to_fetch.done()
       else:
-        ready_feed_list.append(to_fetch)
+        allowed_feed_list.append(to_fetch)
 
-    if not ready_feed_list:
+    if not allowed_feed_list:
       return
 
-    topic_list = [f.topic for f in ready_feed_list]
-    feed_record_list = FeedRecord.get_or_create_all(topic_list)
-    feed_stats_list = KnownFeedStats.get_or_create_all(topic_list)
-    start_time = time.time()
+    topic_list = [f.topic for f in allowed_feed_list]
+    work_by_topic = dict((f.topic, f) for f in allowed_feed_list)
+    # Map of topic to a tuple (feed_record, feed_stats) once both are loaded.
+    loaded = {}
+    # Map of kind name to its list of entities for topic_list once loaded.
+    prefetched = {}
+    # Map of topic to True if it has subscribers, once that is known.
+    has_subscribers = {}
+    # Map of topic to the time its first fetch started.
+    start_times = {}
     reporter = dos.Reporter()
     successful_topics = []
     failed_topics = []
+    # Bytes of feed documents parsed or reserved by fetches that are still
+    # running, kept in a list for the closure.
+    batch_bytes = [0]
+    # Map of topic to the bytes reserved for its fetch.
+    reserved_bytes = {}
+    # Tuples (work, feed_record, headers, content, seen_entries, handle,
+    # latency) for documents being diffed by the ParsePool.
+    pending_diffs = []
+
+    def finish(work, fetch_success, latency, unchanged, over_budget):
+      if fetch_success:
+        successful_topics.append(work.topic)
+      else:
+        failed_topics.append(work.topic)
+      report_fetch(reporter, work.topic, fetch_success, latency,
+                   unchanged=unchanged, over_budget=over_budget)
+
+    def finish_parse(work, feed_record, headers, content, latency,
+                     seen_entries=None, diff_result=None):
+      fetch_success = False
+      if parse_feed(feed_record, headers, content, seen_entries=seen_entries,
+                    diff_result=diff_result):
+        fetch_success = True
+        work.done()
+      else:
+        work.fetch_failed()
+      finish(work, fetch_success, latency, False,
+             feed_record.over_budget or len(content) > MAX_FEED_DOCUMENT_BYTES)
 
     def create_callback(feed_record, feed_stats, work, fetch_url, attempts):
       return lambda *args: callback(
@@ -2713,6 +5501,8 @@ class PullFeedHandler(webapp.RequestHandler):
                  status_code, headers, content, exception):
       should_parse = False
       fetch_success = False
+      unchanged = False
+      over_budget = False
       if exception:
         if isinstance(exception, urlfetch.ResponseTooLargeError):
           logging.warning('Feed response too large for topic %r at url %r; '
@@ -2763,33 +5553,123 @@ class PullFeedHandler(webapp.RequestHandler):
 
       # Fetch is done one way or another.
       end_time = time.time()
-      latency = int((end_time - start_time) * 1000)
+      latency = int((end_time - start_times[work.topic]) * 1000)
+      batch_bytes[0] -= reserved_bytes.pop(work.topic, 0)
       if should_parse:
-        if parse_feed(feed_record, headers, content):
+        if len(content) > MAX_FEED_DOCUMENT_BYTES:
+          logging.warning('Feed document for topic %r is %d bytes, more than '
+                          'the limit of %d; only its first new entries will '
+                          'be parsed', work.topic, len(content),
+                          MAX_FEED_DOCUMENT_BYTES)
+        if feed_record.is_unchanged(content):
+          # Many publishers ignore our conditional request headers.
+          logging.debug('Feed publisher for topic %r returned an unchanged '
+                        'document; skipping parse', work.topic)
+          feed_record.save_headers(headers)
+          unchanged = True
           fetch_success = True
           work.done()
+        elif (batch_bytes[0] and
+              batch_bytes[0] + len(content) > MAX_FETCH_BATCH_BYTES):
+          logging.warning('Feed pull batch exceeded its budget of %d bytes; '
+                          'deferring topic %r', MAX_FETCH_BATCH_BYTES,
+                          work.topic)
+          over_budget = True
+          fetch_success = True
+          if FeedContinuation.save_deferred(work.topic, headers, content):
+            work.done()
+          else:
+            work.defer()
         else:
-          work.fetch_failed()
+          batch_bytes[0] += len(content)
+          seen_entries = feed_record.get_seen_entries()
+          handle = PARSE_POOL.submit(
+              feed_record, headers, content, seen_entries)
+          if handle is not None:
+            # Finished once all fetches are done; see below.
+            pending_diffs.append((work, feed_record, headers, content,
+                                  seen_entries, handle, latency))
+          else:
+            finish_parse(work, feed_record, headers, content, latency,
+                         seen_entries=seen_entries)
+          return
 
-      if fetch_success:
-        successful_topics.append(work.topic)
-      else:
-        failed_topics.append(work.topic)
-      report_fetch(reporter, work.topic, fetch_success, latency)
+      finish(work, fetch_success, latency, unchanged, over_budget)
       # End callback
 
-    # Fire off a fetch for every work item and wait for all callbacks.
-    for work, feed_record, feed_stats in zip(
-        ready_feed_list, feed_record_list, feed_stats_list):
+    def start_fetch(topic):
+      if topic not in loaded or topic not in has_subscribers:
+        return
+      work = work_by_topic[topic]
+      if not has_subscribers[topic]:
+        logging.debug('Ignoring event because there are no subscribers '
+                      'for topic %s', topic)
+        work.done()
+        return
+      feed_record, feed_stats = loaded[topic]
+      expected_bytes = feed_record.content_bytes or 0
+      if (batch_bytes[0] and
+          batch_bytes[0] + expected_bytes > MAX_FETCH_BATCH_BYTES):
+        logging.warning('Feed pull batch has no room in its budget of %d '
+                        'bytes; deferring topic %r before fetching',
+                        MAX_FETCH_BATCH_BYTES, topic)
+        report_over_budget(reporter, topic)
+        work.defer()
+        return
+      batch_bytes[0] += expected_bytes
+      reserved_bytes[topic] = expected_bytes
+      start_times[topic] = time.time()
       hooks.execute(pull_feed_async,
           work,
-          work.topic,
+          topic,
           feed_record.get_request_headers(feed_stats.subscriber_count),
           async_proxy,
-          create_callback(feed_record, feed_stats, work, work.topic, 1))
+          create_callback(feed_record, feed_stats, work, topic, 1))
+
+    def create_prefetch_callback(model_class):
+      def prefetch_callback(result_list, exception):
+        if exception:
+          logging.warning('Could not prefetch %s entities; retrieving them '
+                          'directly. %s: %s', model_class.kind(),
+                          exception.__class__, exception)
+          result_list = model_class.get_or_create_all(topic_list)
+        prefetched[model_class.kind()] = result_list
+        if len(prefetched) < 2:
+          return
+        for topic, feed_record, feed_stats in zip(
+            topic_list, prefetched[FeedRecord.kind()],
+            prefetched[KnownFeedStats.kind()]):
+          loaded[topic] = (feed_record, feed_stats)
+          start_fetch(topic)
+      return prefetch_callback
+
+    def subscribers_callback(topic, topic_has_subscribers):
+      has_subscribers[topic] = topic_has_subscribers
+      start_fetch(topic)
+
+    # Load the state of every work item concurrently, fire off each fetch as
+    # soon as its state is known, and wait for all callbacks.
+    FeedRecord.get_or_create_all(
+        topic_list, async_proxy=async_proxy,
+        callback=create_prefetch_callback(FeedRecord))
+    KnownFeedStats.get_or_create_all(
+        topic_list, async_proxy=async_proxy,
+        callback=create_prefetch_callback(KnownFeedStats))
+    Subscription.has_subscribers_multi(
+        topic_list, async_proxy=async_proxy, callback=subscribers_callback)
 
     try:
       async_proxy.wait()
+      for (work, feed_record, headers, content,
+           seen_entries, handle, latency) in pending_diffs:
+        try:
+          diff_result = PARSE_POOL.get_result(handle, seen_entries)
+        except Exception, e:
+          logging.exception('Could not diff topic %r in the parse pool; '
+                            'diffing inline', work.topic)
+          diff_result = None
+        finish_parse(work, feed_record, headers, content, latency,
+                     seen_entries=seen_entries, diff_result=diff_result)
     except runtime.DeadlineExceededError:
       logging.error('Could not finish all fetches due to deadline.')
     else:
@@ -2806,11 +5686,57 @@ class PullFeedHandler(webapp.RequestHandler):
       if not work:
         logging.debug('No feeds to fetch for topic = %s', topic)
         return
-      self._handle_fetches([work])
+      self._handle_fetches([work], stored=True)
     else:
       work_list = FeedToFetch.FORK_JOIN_QUEUE.pop_request(self.request)
       self._handle_fetches(work_list)
 
+
+class ContinueFeedHandler(webapp.RequestHandler):
+  """Background worker for parsing the rest of a cut-off feed document."""
+
+  @work_queue_only
+  def post(self):
+    topic = self.request.get('topic')
+    continuation = FeedContinuation.get(FeedContinuation.create_key(topic))
+    if not continuation:
+      logging.debug('No feed document to continue parsing for topic = %s',
+                    topic)
+      return
+
+    feed_record = FeedRecord.get_or_create_all([topic])[0]
+    if not continuation.deferred and not feed_record.over_budget:
+      # A later pull of the feed has parsed a whole document since.
+      logging.debug('Feed document for topic = %s is no longer needed', topic)
+      continuation.delete()
+      return
+
+    if not parse_feed(feed_record, continuation.get_headers(),
+                      continuation.get_content(),
+                      alternate_topics=continuation.alternate_topics or None):
+      # Datastore failure; the task will be retried.
+      self.response.set_status(500)
+    elif continuation.deferred and not feed_record.over_budget:
+      # Parses that are cut short replace the document with a continuation
+      # of their own; otherwise it is done.
+      continuation.delete()
+
+
+class SaveFeedEntryRecordsHandler(webapp.RequestHandler):
+  """Background worker for saving the FeedEntryRecords of parsed entries."""
+
+  @work_queue_only
+  def post(self):
+    topic = self.request.get('topic')
+    entry_list = [FeedEntryRecord.create_entry_for_hash(topic, *line.split())
+                  for line in self.request.get('records').splitlines()
+                  if line]
+    # Records are keyed by entry ID, so saving them again when the task is
+    # retried only overwrites them.
+    for group in plan_put_batches(
+        entry_list, MAX_FEED_RECORD_SAVES, MAX_FEED_RECORD_SAVE_BYTES):
+      db.put(group)
+
 ################################################################################
 # Event delivery
 
@@ -2846,6 +5772,13 @@ class PushEventHandler(webapp.RequestHandler):
       logging.debug('No events to deliver.')
       return
 
+    payload = work.get_payload()
+    if payload is None:
+      logging.critical('Payload %s for event to topic %s is missing; dropping '
+                       'the event', work.payload_hash, work.topic)
+      work.delete()
+      return
+
     # Retrieve the first N + 1 subscribers; note if we have more to contact.
     more_subscribers, subscription_list = work.get_next_subscribers()
     logging.info('%d more subscribers to contact for: '
@@ -2877,7 +5810,7 @@ class PushEventHandler(webapp.RequestHandler):
     def create_callback(sub):
       return lambda *args: callback(sub, *args)
 
-    payload_utf8 = utf8encoded(work.payload)
+    payload_utf8 = utf8encoded(payload)
     scores = DELIVERY_SCORER.filter(s.callback for s in all_callbacks)
     for sub, (allowed, percent) in zip(all_callbacks, scores):
       if not allowed:
@@ -3027,6 +5960,18 @@ class RecordFeedHandler(webapp.RequestHandler):
   @work_queue_only
   def post(self):
     topic = self.request.get('topic')
+    try:
+      self.record_feed(topic)
+    finally:
+      # Recording the feed may make it known or give it new aliases.
+      KnownFeedIdentity.forget_aliases([topic])
+
+  def record_feed(self, topic):
+    """Records a topic as a KnownFeed and discovers its feed ID.
+
+    Args:
+      topic: The feed's topic URL.
+    """
     logging.debug('Recording topic = %s', topic)
 
     known_feed_key = KnownFeed.create_key(topic)
@@ -3041,38 +5986,61 @@ class RecordFeedHandler(webapp.RequestHandler):
     else:
       known_feed = KnownFeed.create(topic)
 
-    try:
-      response = urlfetch.fetch(topic)
-    except (apiproxy_errors.Error, urlfetch.Error), e:
-      logging.warning('Could not fetch topic = %s for feed ID. %s: %s',
-                      topic, e.__class__.__name__, e)
-      known_feed.put()
-      return
-
-    # TODO(bslatkin): Add more intelligent retrying of feed identification.
-    if response.status_code != 200:
-      logging.warning('Fetching topic = %s for feed ID returned response %s',
-                      topic, response.status_code)
-      known_feed.put()
+    # The IDs of feeds that have been pulled are recorded while parsing them.
+    feed_record = FeedRecord.get_by_key_name(FeedRecord.create_key_name(topic))
+    if feed_record is not None and feed_record.format:
+      logging.debug('Topic = %s has been pulled; not fetching it for its '
+                    'feed ID', topic)
+      if feed_record.feed_id and feed_record.feed_id != known_feed.feed_id:
+        known_feed.update_feed_id(feed_record.feed_id)
+      else:
+        known_feed.put()
       return
 
-    order = (ATOM, RSS)
-    parse_failures = 0
-    error_traceback = 'Could not determine feed_id'
-    feed_id = None
-    for feed_type in order:
+    # The feed ID is near the start of the document, so only ask for a prefix
+    # of it. Servers that don't support Range requests send the whole thing.
+    # If the ID isn't in the prefix, fall back to fetching the whole document.
+    for headers in ({'Range': 'bytes=0-%d' % (FEED_IDENTITY_PREFIX_BYTES - 1)},
+                    {}):
       try:
-        feed_id = feed_identifier.identify(response.content, feed_type)
-        if feed_id is not None:
-          break
-        else:
+        response = urlfetch.fetch(topic, headers=headers)
+      except (apiproxy_errors.Error, urlfetch.Error), e:
+        logging.warning('Could not fetch topic = %s for feed ID. %s: %s',
+                        topic, e.__class__.__name__, e)
+        known_feed.put()
+        return
+
+      # TODO(bslatkin): Add more intelligent retrying of feed identification.
+      if response.status_code not in (200, 206):
+        logging.warning('Fetching topic = %s for feed ID returned response %s',
+                        topic, response.status_code)
+        known_feed.put()
+        return
+      partial = response.status_code == 206
+
+      order = (ATOM, RSS)
+      parse_failures = 0
+      error_traceback = 'Could not determine feed_id'
+      feed_id = None
+      for feed_type in order:
+        try:
+          feed_id = feed_identifier.identify(
+              response.content, feed_type, partial=partial)
+          if feed_id is not None:
+            break
+          else:
+            parse_failures += 1
+        except Exception:
+          error_traceback = traceback.format_exc()
+          logging.debug(
+              'Could not parse feed for content of %d bytes in format "%s":\n'
+              '%s', len(response.content), feed_type, error_traceback)
           parse_failures += 1
-      except Exception:
-        error_traceback = traceback.format_exc()
-        logging.debug(
-            'Could not parse feed for content of %d bytes in format "%s":\n%s',
-            len(response.content), feed_type, error_traceback)
-        parse_failures += 1
+
+      if feed_id or not partial:
+        break
+      logging.debug('Feed ID for topic = %s not found in first %d bytes; '
+                    'fetching whole document', topic, len(response.content))
 
     if parse_failures == len(order) or not feed_id:
       logging.warning('Could not record feed ID for topic=%r, feed_id=%r:\n%s',
@@ -3083,17 +6051,7 @@ class RecordFeedHandler(webapp.RequestHandler):
       # is of an arbitrary content type.
       return
 
-    logging.info('For topic = %s found new feed ID %r; old feed ID was %r',
-                 topic, feed_id, known_feed.feed_id)
-
-    if known_feed.feed_id and known_feed.feed_id != feed_id:
-      logging.info('Removing old feed_id relation from '
-                   'topic = %r to feed_id = %r', topic, known_feed.feed_id)
-      KnownFeedIdentity.remove(known_feed.feed_id, topic)
-
-    KnownFeedIdentity.update(feed_id, topic)
-    known_feed.feed_id = feed_id
-    known_feed.put()
+    known_feed.update_feed_id(feed_id)
 
 ################################################################################
 
@@ -3127,7 +6085,8 @@ class TopicDetailHandler(webapp.RequestHandler):
   @dos.limit(count=5, period=60)
   def get(self):
     topic_url = normalize_iri(self.request.get('hub.url'))
-    feed = FeedRecord.get_by_key_name(FeedRecord.create_key_name(topic_url))
+    feed = FEED_RECORD_CACHE.get([db.Key.from_path(
+        FeedRecord.kind(), FeedRecord.create_key_name(topic_url))])[0]
     if not feed:
       self.response.set_status(400)
       context = {
@@ -3142,7 +6101,10 @@ class TopicDetailHandler(webapp.RequestHandler):
         'last_content_type': feed.content_type,
         'last_etag': feed.etag,
         'last_modified': feed.last_modified,
-        'last_header_footer': feed.header_footer,
+        'last_header_footer': feed.get_header_footer(),
+        'suppressed_entries': feed.suppressed_entries,
+        'put_splits': feed.put_splits,
+        'over_budget': feed.over_budget,
         'fetch_blocked': not fetch_score[0],
         'fetch_errors': fetch_score[1] * 100,
         'fetch_url_error': FETCH_SAMPLER.get_chain(
@@ -3157,15 +6119,24 @@ class TopicDetailHandler(webapp.RequestHandler):
             FETCH_URL_SAMPLE_HOUR_LATENCY,
             FETCH_URL_SAMPLE_DAY_LATENCY,
             single_key=topic_url),
+        'fetch_url_unchanged': FETCH_SAMPLER.get_chain(
+            FETCH_URL_SAMPLE_MINUTE_UNCHANGED,
+            FETCH_URL_SAMPLE_30_MINUTE_UNCHANGED,
+            FETCH_URL_SAMPLE_HOUR_UNCHANGED,
+            FETCH_URL_SAMPLE_DAY_UNCHANGED,
+            single_key=topic_url),
+        'fetch_url_over_budget': FETCH_SAMPLER.get_chain(
+            FETCH_URL_SAMPLE_HOUR_OVER_BUDGET,
+            FETCH_URL_SAMPLE_DAY_OVER_BUDGET,
+            single_key=topic_url),
       }
 
       if users.is_current_user_admin():
-        feed_stats = db.get(KnownFeedStats.create_key(topic_url=topic_url))
-        if feed_stats:
-          context.update({
-            'subscriber_count': feed_stats.subscriber_count,
-            'feed_stats_update_time': feed_stats.update_time,
-          })
+        feed_stats = KnownFeedStats.get_or_create_all([topic_url])[0]
+        context.update({
+          'subscriber_count': feed_stats.subscriber_count,
+          'feed_stats_update_time': feed_stats.update_time,
+        })
 
       fetch = FeedToFetch.get_by_topic(topic_url)
       if fetch:
@@ -3222,7 +6193,7 @@ class SubscriptionDetailHandler(webapp.RequestHandler):
             'retry_attempts': e.retry_attempts,
             'totally_failed': e.totally_failed,
             'content_type': e.content_type,
-            'payload_trunc': e.payload[:10000],
+            'payload_trunc': (e.get_payload() or '')[:10000],
           }
           for e in failed_events],
         'delivery_blocked': not delivery_score[0],
@@ -3291,6 +6262,22 @@ class StatsHandler(webapp.RequestHandler):
           FETCH_DOMAIN_SAMPLE_30_MINUTE_LATENCY,
           FETCH_DOMAIN_SAMPLE_HOUR_LATENCY,
           FETCH_DOMAIN_SAMPLE_DAY_LATENCY),
+      'fetch_url_unchanged': FETCH_SAMPLER.get_chain(
+          FETCH_URL_SAMPLE_MINUTE_UNCHANGED,
+          FETCH_URL_SAMPLE_30_MINUTE_UNCHANGED,
+          FETCH_URL_SAMPLE_HOUR_UNCHANGED,
+          FETCH_URL_SAMPLE_DAY_UNCHANGED),
+      'fetch_domain_unchanged': FETCH_SAMPLER.get_chain(
+          FETCH_DOMAIN_SAMPLE_MINUTE_UNCHANGED,
+          FETCH_DOMAIN_SAMPLE_30_MINUTE_UNCHANGED,
+          FETCH_DOMAIN_SAMPLE_HOUR_UNCHANGED,
+          FETCH_DOMAIN_SAMPLE_DAY_UNCHANGED),
+      'fetch_url_over_budget': FETCH_SAMPLER.get_chain(
+          FETCH_URL_SAMPLE_HOUR_OVER_BUDGET,
+          FETCH_URL_SAMPLE_DAY_OVER_BUDGET),
+      'fetch_domain_over_budget': FETCH_SAMPLER.get_chain(
+          FETCH_DOMAIN_SAMPLE_HOUR_OVER_BUDGET,
+          FETCH_DOMAIN_SAMPLE_DAY_OVER_BUDGET),
       'delivery_url_error': DELIVERY_SAMPLER.get_chain(
           DELIVERY_URL_SAMPLE_MINUTE,
           DELIVERY_URL_SAMPLE_30_MINUTE,
@@ -3531,12 +6518,16 @@ def main():
       # Low-latency workers
       (r'/work/subscriptions', SubscriptionConfirmHandler),
       (r'/work/pull_feeds', PullFeedHandler),
+      (r'/work/continue_feeds', ContinueFeedHandler),
+      (r'/work/save_entry_records', SaveFeedEntryRecordsHandler),
       (r'/work/push_events', PushEventHandler),
       (r'/work/record_feeds', RecordFeedHandler),
       # Periodic workers
       (r'/work/poll_bootstrap', PollBootstrapHandler),
       (r'/work/subscription_cleanup', SubscriptionCleanupHandler),
       (r'/work/reconfirm_subscriptions', SubscriptionReconfirmHandler),
+      (r'/work/build_rosters', BuildRostersHandler),
+      (r'/work/count_subscriptions', CountSubscriptionsHandler),
       (r'/work/cleanup_mapper', CleanupMapperHandler),
     ])
   application = webapp.WSGIApplication(HANDLERS, debug=DEBUG)
@@ -112,6 +112,67 @@ class UtilityFunctionTest(unittest.TestCase):
            u'/07256788297315478906/label/\u30d6\u30ed\u30b0\u8846')
     self.assertEquals(good_iri, main.normalize_iri(iri))
 
+  def testPlanPutBatches(self):
+    topic = 'http://example.com/my-topic'
+    entity_list = [
+        FeedEntryRecord.create_entry_for_topic(topic, str(i), sha1_hash('a'))
+        for i in xrange(5)]
+    size = len(db.model_to_protobuf(entity_list[0]).Encode())
+
+    self.assertEquals([entity_list[:2], entity_list[2:4], entity_list[4:]],
+                      main.plan_put_batches(entity_list, 2, 10 * size))
+    self.assertEquals([entity_list[:3], entity_list[3:]],
+                      main.plan_put_batches(entity_list, 10, 3 * size))
+    # Entities too large by themselves get their own batches.
+    self.assertEquals([[e] for e in entity_list],
+                      main.plan_put_batches(entity_list, 10, 1))
+    self.assertEquals([], main.plan_put_batches([], 10, 1))
+
+
+class LruCacheTest(unittest.TestCase):
+  """Tests for the LruCache class."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    self.now = [1000.0]
+    self.cache = main.LruCache(4, 60, now=lambda: self.now[0])
+
+  def testGetSet(self):
+    """Tests getting and setting values."""
+    self.assertEquals(None, self.cache.get('a'))
+    self.assertEquals('default', self.cache.get('a', 'default'))
+    self.cache.set('a', 1)
+    self.assertEquals(1, self.cache.get('a'))
+    self.cache.delete('a')
+    self.assertEquals(None, self.cache.get('a'))
+    self.cache.delete('a')
+
+  def testExpiration(self):
+    """Tests that entries expire."""
+    self.cache.set('a', 1)
+    self.now[0] += 59
+    self.assertEquals(1, self.cache.get('a'))
+    self.now[0] += 1
+    self.assertEquals(None, self.cache.get('a'))
+
+  def testEviction(self):
+    """Tests that the least recently used entries are evicted when full."""
+    for key in ('a', 'b', 'c', 'd'):
+      self.cache.set(key, key)
+    self.assertEquals('a', self.cache.get('a'))
+    self.cache.set('e', 'e')
+    self.assertEquals(3, len(self.cache.entries))
+    self.assertEquals(None, self.cache.get('b'))
+    self.assertEquals(None, self.cache.get('c'))
+    for key in ('a', 'd', 'e'):
+      self.assertEquals(key, self.cache.get(key))
+
+  def testClear(self):
+    """Tests clearing all entries."""
+    self.cache.set('a', 1)
+    self.cache.clear()
+    self.assertEquals(None, self.cache.get('a'))
+
 ################################################################################
 
 class TestWorkQueueHandler(webapp.RequestHandler):
@@ -250,6 +311,7 @@ class KnownFeedIdentityTest(unittest.TestCase):
 
   def setUp(self):
     testutil.setup_for_testing()
+    main.TOPIC_ALIAS_CACHE.clear()
     self.feed_id = 'my;feed;id'
     self.feed_id2 = 'my;feed;id;2'
     self.topic = 'http://example.com/foobar1'
@@ -372,6 +434,50 @@ class KnownFeedIdentityTest(unittest.TestCase):
     }
     self.assertEquals(expected, result)
 
+  def testDeriveAdditionalTopicsCached(self):
+    """Tests that derived aliases are served from the caches."""
+    KnownFeed.create(self.topic).put()
+    expected = {self.topic: set([self.topic])}
+    self.assertEquals(
+        expected, KnownFeedIdentity.derive_additional_topics([self.topic]))
+    self.assertEquals(
+        {}, KnownFeedIdentity.derive_additional_topics([self.topic2]))
+
+    # Changes that go around KnownFeedIdentity are not seen until both the
+    # instance's memory and memcache are cleared.
+    KnownFeed.create(self.topic2).put()
+    db.delete(KnownFeed.create_key(self.topic))
+    both = [self.topic, self.topic2]
+    self.assertEquals(
+        expected, KnownFeedIdentity.derive_additional_topics(both))
+    main.TOPIC_ALIAS_CACHE.clear()
+    self.assertEquals(
+        expected, KnownFeedIdentity.derive_additional_topics(both))
+    main.TOPIC_ALIAS_CACHE.clear()
+    memcache.flush_all()
+    self.assertEquals({self.topic2: set([self.topic2])},
+                      KnownFeedIdentity.derive_additional_topics(both))
+
+  def testDeriveAdditionalTopicsInvalidation(self):
+    """Tests that updating and removing aliases clears the caches."""
+    feed = KnownFeed.create(self.topic)
+    feed.feed_id = self.feed_id
+    feed.put()
+    KnownFeedIdentity.update(self.feed_id, self.topic)
+    self.assertEquals(
+        {self.topic: set([self.topic])},
+        KnownFeedIdentity.derive_additional_topics([self.topic]))
+
+    KnownFeedIdentity.update(self.feed_id, self.topic2)
+    self.assertEquals(
+        {self.topic: set([self.topic, self.topic2])},
+        KnownFeedIdentity.derive_additional_topics([self.topic]))
+
+    KnownFeedIdentity.remove(self.feed_id, self.topic2)
+    self.assertEquals(
+        {self.topic: set([self.topic])},
+        KnownFeedIdentity.derive_additional_topics([self.topic]))
+
   def testKnownFeedIdentityTooLarge(self):
     """Tests when the fan-out expansion of the KnownFeedIdentity is too big."""
     feed = KnownFeedIdentity.update(self.feed_id, self.topic)
@@ -578,6 +684,82 @@ class SubscriptionTest(unittest.TestCase):
     self.assertTrue(Subscription.remove(self.callback, self.topic))
     self.assertFalse(Subscription.has_subscribers(self.topic))
 
+  def testHasSubscribers_cached(self):
+    """Tests that subscriber presence is answered from memcache."""
+    key = Subscription.has_subscribers_key(self.topic)
+    self.assertTrue(Subscription.insert(
+        self.callback, self.topic, self.token, self.secret))
+    self.assertTrue(memcache.get(key))
+
+    # Going around the Subscription methods leaves the cached answer alone.
+    db.delete(self.get_subscription())
+    self.assertTrue(Subscription.has_subscribers(self.topic))
+
+    # A miss queries the Datastore and caches the answer.
+    memcache.delete(key)
+    self.assertFalse(Subscription.has_subscribers(self.topic))
+    self.assertEquals(False, memcache.get(key))
+
+  def testHasSubscribers_insertOverridesCachedAbsence(self):
+    """Tests that inserting a subscription replaces a cached absence."""
+    self.assertFalse(Subscription.has_subscribers(self.topic))
+    self.assertTrue(Subscription.insert(
+        self.callback, self.topic, self.token, self.secret))
+    self.assertTrue(Subscription.has_subscribers(self.topic))
+
+  def testHasSubscribers_archive(self):
+    """Tests that archiving a subscription clears the cached presence."""
+    self.assertTrue(Subscription.insert(
+        self.callback, self.topic, self.token, self.secret))
+    self.assertTrue(Subscription.has_subscribers(self.topic))
+    Subscription.archive(self.callback, self.topic)
+    self.assertTrue(
+        memcache.get(Subscription.has_subscribers_key(self.topic)) is None)
+    self.assertFalse(Subscription.has_subscribers(self.topic))
+
+  def testHasSubscribersMulti(self):
+    """Tests checking several topics for subscribers at once."""
+    topic2 = self.topic + '/2'
+    topic3 = self.topic + '/3'
+    self.assertTrue(Subscription.insert(
+        self.callback, self.topic, self.token, self.secret))
+    self.assertTrue(Subscription.insert(
+        self.callback, topic3, self.token, self.secret))
+    memcache.flush_all()
+    self.assertEquals(
+        [True, False, True, True],
+        Subscription.has_subscribers_multi(
+            [self.topic, topic2, topic3, self.topic]))
+    self.assertEquals([], Subscription.has_subscribers_multi([]))
+
+  def testHasSubscribersMulti_async(self):
+    """Tests checking topics for subscribers with asynchronous queries."""
+    topic2 = self.topic + '/2'
+    topic3 = self.topic + '/3'
+    self.assertTrue(Subscription.insert(
+        self.callback, self.topic, self.token, self.secret))
+    self.assertTrue(Subscription.insert(
+        self.callback, topic3, self.token, self.secret))
+    memcache.delete(Subscription.has_subscribers_key(topic3))
+
+    answers = []
+    def callback(topic, has_subscribers):
+      answers.append((topic, has_subscribers))
+    async_proxy = async_apiproxy.AsyncAPIProxy()
+    self.assertTrue(Subscription.has_subscribers_multi(
+        [self.topic, topic2, topic3], async_proxy=async_proxy,
+        callback=callback) is None)
+
+    # Cached answers are given right away.
+    self.assertEquals([(self.topic, True)], answers)
+    async_proxy.wait()
+    self.assertEquals([(self.topic, True), (topic2, False), (topic3, True)],
+                      sorted(answers))
+    self.assertEquals(False,
+                      memcache.get(Subscription.has_subscribers_key(topic2)))
+    self.assertEquals(True,
+                      memcache.get(Subscription.has_subscribers_key(topic3)))
+
   def testGetSubscribers_unverified(self):
     """Tests that unverified subscribers will not be retrieved."""
     self.assertEquals([], Subscription.get_subscribers(self.topic, 10))
@@ -714,6 +896,63 @@ class SubscriptionTest(unittest.TestCase):
     sub = Subscription.get_by_key_name(sub_key)
     self.assertEquals(Subscription.STATE_TO_DELETE, sub.subscription_state)
 
+  def testSubscriberCount(self):
+    """Tests that subscription changes keep the subscriber count."""
+    def get_count():
+      return main.KnownFeedStats.get_or_create_all(
+          [self.topic])[0].subscriber_count
+    self.assertEquals(0, get_count())
+    self.assertTrue(Subscription.insert(
+        self.callback, self.topic, self.token, self.secret))
+    self.assertTrue(Subscription.insert(
+        self.callback2, self.topic, self.token, self.secret))
+    self.assertFalse(Subscription.insert(
+        self.callback2, self.topic, self.token, self.secret))
+    self.assertTrue(Subscription.request_insert(
+        self.callback3, self.topic, self.token, self.secret))
+    self.assertEquals(2, get_count())
+
+    Subscription.archive(self.callback, self.topic)
+    Subscription.archive(self.callback, self.topic)
+    self.assertEquals(1, get_count())
+    self.assertTrue(Subscription.remove(self.callback2, self.topic))
+    self.assertTrue(Subscription.remove(self.callback3, self.topic))
+    self.assertEquals(0, get_count())
+
+    # Re-subscribing an archived subscription counts it again.
+    self.assertFalse(Subscription.insert(
+        self.callback, self.topic, self.token, self.secret))
+    self.assertEquals(1, get_count())
+
+  def testSubscriberCount_reconcile(self):
+    """Tests reconciling the subscriber count with a full count."""
+    topic_hash = main.sha1_hash(self.topic)
+    for i in xrange(10):
+      main.SubscriberCountShard.increment(self.topic, 1)
+    self.assertTrue(main.SubscriberCountShard.reconcile(topic_hash, 4))
+    self.assertFalse(main.SubscriberCountShard.reconcile(topic_hash, 4))
+    stats = main.KnownFeedStats.get_or_create_all([self.topic])[0]
+    self.assertEquals(4, stats.subscriber_count)
+    self.assertTrue(stats.update_time is not None)
+
+  def testSubscriberCount_oldStats(self):
+    """Tests topics that have not been counted since the old count job."""
+    topic_hash = main.sha1_hash(self.topic)
+    def get_count():
+      return main.KnownFeedStats.get_or_create_all(
+          [self.topic])[0].subscriber_count
+    main.KnownFeedStats(key=main.KnownFeedStats.create_key(self.topic),
+                        subscriber_count=100).put()
+    self.assertEquals(100, get_count())
+    self.assertTrue(Subscription.insert(
+        self.callback, self.topic, self.token, self.secret))
+    self.assertEquals(101, get_count())
+
+    # Once counted from scratch the old stats are ignored.
+    self.assertTrue(main.SubscriberCountShard.reconcile(topic_hash, 1))
+    self.assertEquals(1, get_count())
+    self.assertFalse(main.SubscriberCountShard.reconcile(topic_hash, 1))
+
   def testArchiveMissing(self):
     """Tests the archive method when the subscription does not exist."""
     sub_key = Subscription.create_key_name(self.callback, self.topic)
@@ -723,6 +962,170 @@ class SubscriptionTest(unittest.TestCase):
 
 ################################################################################
 
+SubscriberRoster = main.SubscriberRoster
+
+
+class SubscriberRosterTest(unittest.TestCase):
+  """Tests for the SubscriberRoster model class."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing()
+    self.topic = 'http://example.com/my-topic-url'
+    self.topic_hash = main.sha1_hash(self.topic)
+    self.callback_list = ['http://example.com/callback-%d' % i
+                          for i in xrange(40)]
+    self.callback_list.sort(key=main.sha1_hash)
+    self.token = 'token'
+    self.secret = 'my secrat'
+
+  def build_roster(self, callback_list):
+    """Builds and stores a roster for the test topic."""
+    db.put(SubscriberRoster.build(
+        self.topic_hash,
+        [(main.sha1_hash(cb), cb, self.secret, self.token)
+         for cb in callback_list]))
+
+  def get_callbacks(self, count, starting_at_callback=None):
+    """Returns the callbacks found in the test topic's roster."""
+    entry_list = SubscriberRoster.get_subscribers(
+        self.topic, count, starting_at_callback=starting_at_callback)
+    return [e.callback for e in entry_list]
+
+  def testNoRoster(self):
+    """Tests topics without a roster."""
+    self.assertTrue(SubscriberRoster.get_subscribers(self.topic, 10) is None)
+    Subscription.insert(
+        self.callback_list[0], self.topic, self.token, self.secret)
+    self.assertTrue(SubscriberRoster.get_subscribers(self.topic, 10) is None)
+
+    self.build_roster([])
+    self.assertEquals([], self.get_callbacks(10))
+
+  def testMissingShard(self):
+    """Tests that a roster missing any shard is not used."""
+    self.build_roster(self.callback_list)
+    db.delete(SubscriberRoster.create_key(
+        self.topic_hash, main.ROSTER_SHARD_COUNT - 1))
+    self.assertTrue(SubscriberRoster.get_subscribers(self.topic, 100) is None)
+
+  def testPaging(self):
+    """Tests paging through a roster that spans many shards."""
+    self.build_roster(self.callback_list)
+    self.assertEquals(self.callback_list, self.get_callbacks(100))
+    self.assertEquals(self.callback_list[:5], self.get_callbacks(5))
+    for i in (1, 17, 39):
+      self.assertEquals(
+          self.callback_list[i:i+5],
+          self.get_callbacks(5, starting_at_callback=self.callback_list[i]))
+
+    entry = SubscriberRoster.get_subscribers(self.topic, 1)[0]
+    self.assertEquals(main.sha1_hash(entry.callback), entry.callback_hash)
+    self.assertEquals(self.secret, entry.secret)
+    self.assertEquals(self.token, entry.verify_token)
+    self.assertEquals(
+        db.Key.from_path(Subscription.kind(), Subscription.create_key_name(
+            self.callback_list[0], self.topic)),
+        entry.key())
+
+  def refresh_all(self):
+    """Refreshes every shard of the test topic's roster."""
+    for shard in xrange(main.ROSTER_SHARD_COUNT):
+      SubscriberRoster.refresh(self.topic, shard)
+
+  def testBuilding(self):
+    """Tests that rosters are not used until every shard is refreshed."""
+    for callback in self.callback_list:
+      Subscription.insert(callback, self.topic, self.token, self.secret)
+    SubscriberRoster.start_build(self.topic_hash)
+    self.assertTrue(SubscriberRoster.get_subscribers(self.topic, 100) is None)
+    self.refresh_all()
+    self.assertEquals(self.callback_list, self.get_callbacks(100))
+
+  def testRefresh_paging(self):
+    """Tests refreshing shards with more Subscriptions than one query gets."""
+    for callback in self.callback_list:
+      Subscription.insert(callback, self.topic, self.token, self.secret)
+    old_lookups = main.MAX_ROSTER_REFRESH_LOOKUPS
+    old_shard_count = main.ROSTER_SHARD_COUNT
+    main.MAX_ROSTER_REFRESH_LOOKUPS = 2
+    main.ROSTER_SHARD_COUNT = 3
+    try:
+      SubscriberRoster.start_build(self.topic_hash)
+      self.refresh_all()
+      self.assertEquals(self.callback_list, self.get_callbacks(100))
+    finally:
+      main.MAX_ROSTER_REFRESH_LOOKUPS = old_lookups
+      main.ROSTER_SHARD_COUNT = old_shard_count
+
+  def testRefresh_concurrentChange(self):
+    """Tests that a refresh runs again if the shard changes meanwhile."""
+    callback = self.callback_list[0]
+    shard = SubscriberRoster.get_shard(main.sha1_hash(callback))
+    Subscription.insert(callback, self.topic, self.token, self.secret)
+    self.build_roster([])
+
+    old_fetch = db.Query.fetch
+    calls = []
+    def fake_fetch(query, limit):
+      calls.append(limit)
+      result = old_fetch(query, limit)
+      if len(calls) == 1:
+        # Removed after it was queried, before the shard is saved.
+        Subscription.remove(callback, self.topic)
+      return result
+    db.Query.fetch = fake_fetch
+    try:
+      # The second query finds the shard is already up to date.
+      self.assertFalse(SubscriberRoster.refresh(self.topic, shard))
+    finally:
+      db.Query.fetch = old_fetch
+    self.assertEquals(2, len(calls))
+    self.assertEquals([], self.get_callbacks(10))
+
+  def testMaintained(self):
+    """Tests that Subscription changes update an existing roster."""
+    self.build_roster([])
+    for callback in self.callback_list[:3]:
+      Subscription.insert(callback, self.topic, self.token, self.secret)
+    self.assertEquals(self.callback_list[:3], self.get_callbacks(10))
+
+    Subscription.insert(
+        self.callback_list[1], self.topic, self.token, 'new secret')
+    entry_list = SubscriberRoster.get_subscribers(self.topic, 10)
+    self.assertEquals(3, len(entry_list))
+    self.assertEquals('new secret', entry_list[1].secret)
+
+    Subscription.remove(self.callback_list[0], self.topic)
+    self.assertEquals(self.callback_list[1:3], self.get_callbacks(10))
+    Subscription.archive(self.callback_list[2], self.topic)
+    self.assertEquals(self.callback_list[1:2], self.get_callbacks(10))
+
+  def testMaintained_errors(self):
+    """Tests that shards which could not be updated are dropped."""
+    self.build_roster(self.callback_list[:3])
+    def bad_get(*args, **kwargs):
+      raise db.Error('Bad roster')
+    SubscriberRoster.get = staticmethod(bad_get)
+    try:
+      self.assertTrue(Subscription.insert(
+          self.callback_list[3], self.topic, self.token, self.secret))
+      self.assertTrue(Subscription.remove(self.callback_list[0], self.topic))
+      Subscription.archive(self.callback_list[1], self.topic)
+    finally:
+      del SubscriberRoster.get
+
+    self.assertTrue(SubscriberRoster.get_subscribers(self.topic, 10) is None)
+    dropped = set(SubscriberRoster.get_shard(main.sha1_hash(callback))
+                  for callback in self.callback_list[:4])
+    for shard in xrange(main.ROSTER_SHARD_COUNT):
+      roster = db.get(SubscriberRoster.create_key(self.topic_hash, shard))
+      self.assertEquals(shard in dropped, roster is None)
+    self.assertTrue(Subscription.get_by_key_name(
+        Subscription.create_key_name(self.callback_list[3], self.topic)))
+
+################################################################################
+
 FeedToFetch = main.FeedToFetch
 
 class FeedToFetchTest(unittest.TestCase):
@@ -902,7 +1305,7 @@ u"""<?xml version="1.0" encoding="utf-8"?>
 <entry>article2</entry>
 <entry>article3</entry>
 </feed>"""
-    self.assertEquals(expected_data, event.payload)
+    self.assertEquals(expected_data, event.get_payload())
     self.assertEquals('application/atom+xml', event.content_type)
 
   def testCreateEventForTopic_Rss(self):
@@ -928,7 +1331,7 @@ u"""<?xml version="1.0" encoding="utf-8"?>
 <item>article3</item>
 </channel>
 </rss>"""
-    self.assertEquals(expected_data, event.payload)
+    self.assertEquals(expected_data, event.get_payload())
     self.assertEquals('application/rss+xml', event.content_type)
 
   def testCreateEventForTopic_Abitrary(self):
@@ -939,7 +1342,7 @@ u"""<?xml version="1.0" encoding="utf-8"?>
         self.topic, main.ARBITRARY, 'my crazy content type',
         self.header_footer, self.test_payloads)
     expected_data = 'this is my data here'
-    self.assertEquals(expected_data, event.payload)
+    self.assertEquals(expected_data, event.get_payload())
     self.assertEquals('my crazy content type', event.content_type)
 
   def testCreateEvent_badHeaderFooter(self):
@@ -948,6 +1351,109 @@ u"""<?xml version="1.0" encoding="utf-8"?>
         self.topic, main.ATOM, 'content type unused',
         '<feed>has no end tag', self.test_payloads)
 
+  def testPayloadStoredSeparately(self):
+    """Tests that payloads are stored once and shared between events."""
+    event = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, 'application/atom+xml',
+        self.header_footer, self.test_payloads)
+    event.put()
+    event2 = EventToDeliver.create_event_for_topic(
+        'http://example.com/alias-topic', main.ATOM, 'application/atom+xml',
+        self.header_footer, self.test_payloads)
+    event2.put()
+
+    self.assertEquals(event.payload_hash, event2.payload_hash)
+    self.assertEquals(1, len(list(main.EventPayload.all())))
+    payload = event.get_payload()
+    event = db.get(event.key())
+    self.assertFalse(hasattr(event, 'payload'))
+    self.assertEquals(payload, event.get_payload())
+
+  def testPayloadRefresh(self):
+    """Tests that old payloads are rewritten when stored again."""
+    start = datetime.datetime(2010, 1, 1)
+    key_name = main.EventPayload.create_key_name(
+        main.EventPayload.store('my payload', now=lambda: start))
+    main.EventPayload.store(
+        'my payload', now=lambda: start + datetime.timedelta(hours=1))
+    self.assertEquals(
+        start, main.EventPayload.get_by_key_name(key_name).last_modified)
+
+    later = start + datetime.timedelta(
+        seconds=main.EVENT_PAYLOAD_REFRESH_SECONDS + 1)
+    main.EventPayload.store('my payload', now=lambda: later)
+    self.assertEquals(
+        later, main.EventPayload.get_by_key_name(key_name).last_modified)
+
+  def testPayloadCache(self):
+    """Tests that payloads are read through memory and memcache."""
+    main.EVENT_PAYLOAD_CACHE.clear()
+    event = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, 'application/atom+xml',
+        self.header_footer, self.test_payloads)
+    event.put()
+    payload = event.get_payload()
+    db.delete(list(main.EventPayload.all(keys_only=True)))
+
+    # Written to memcache when stored.
+    self.assertEquals(payload, db.get(event.key()).get_payload())
+
+    # Kept in memory once read.
+    memcache.flush_all()
+    self.assertEquals(payload, db.get(event.key()).get_payload())
+
+    main.EVENT_PAYLOAD_CACHE.clear()
+    self.assertEquals(None, db.get(event.key()).get_payload())
+
+  def testPayloadCache_chunks(self):
+    """Tests payloads split across several memcache values."""
+    old_chunk_bytes = main.EventPayload.CACHE_CHUNK_BYTES
+    main.EventPayload.CACHE_CHUNK_BYTES = 4
+    try:
+      main.EventPayload.cache('my_hash', 'abcdefghij')
+      self.assertEquals(['abcd', 'efgh', 'ij'], [
+          memcache.get('event_payload:my_hash')[1],
+          memcache.get('event_payload:my_hash:1'),
+          memcache.get('event_payload:my_hash:2')])
+      self.assertEquals('abcdefghij', main.EventPayload.load('my_hash'))
+
+      main.EVENT_PAYLOAD_CACHE.clear()
+      memcache.delete('event_payload:my_hash:2')
+      self.assertEquals(None, main.EventPayload.get_cached('my_hash'))
+      self.assertEquals(None, main.EventPayload.load('my_hash'))
+
+      main.EventPayload.cache('my_hash', '')
+      self.assertEquals('', main.EventPayload.get_cached('my_hash'))
+    finally:
+      main.EventPayload.CACHE_CHUNK_BYTES = old_chunk_bytes
+
+  def testPayloadEncoded(self):
+    """Tests that large payloads are stored compressed."""
+    event = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, 'application/atom+xml',
+        self.header_footer, self.test_payloads * 100)
+    event.put()
+    payload = event.get_payload()
+    stored = main.EventPayload.all().get()
+    self.assertTrue(len(stored.data) < len(payload) / 5)
+
+    main.EVENT_PAYLOAD_CACHE.clear()
+    self.assertEquals(payload, db.get(event.key()).get_payload())
+    memcache.flush_all()
+    main.EVENT_PAYLOAD_CACHE.clear()
+    self.assertEquals(payload, db.get(event.key()).get_payload())
+
+  def testInlinePayload(self):
+    """Tests reading events that store their payload inline."""
+    event = EventToDeliver(
+        topic=self.topic,
+        topic_hash=main.sha1_hash(self.topic),
+        payload=db.Blob('my inline payload'),
+        last_modified=datetime.datetime.utcnow())
+    event.put()
+    event = db.get(event.key())
+    self.assertEquals('my inline payload', event.get_payload())
+
   def testNormal_noFailures(self):
     """Tests that event delivery with no failures will delete the event."""
     event, work_key, sub_list, sub_keys = self.insert_subscriptions()
@@ -1016,6 +1522,42 @@ u"""<?xml version="1.0" encoding="utf-8"?>
     self.assertEquals([str(work_key)] * 2,
                       [t['params']['event_key'] for t in tasks])
 
+  def testGetNextSubscribers_roster(self):
+    """Tests paging through subscribers using the topic's roster."""
+    event, work_key, sub_list, sub_keys = self.insert_subscriptions()
+    db.put(main.SubscriberRoster.build(
+        main.sha1_hash(self.topic),
+        [(s.callback_hash, s.callback, s.secret, s.verify_token)
+         for s in sub_list]))
+
+    more, subs = event.get_next_subscribers(chunk_size=2)
+    self.assertTrue(more)
+    self.assertTrue(event.use_roster)
+    self.assertEquals([s.callback for s in sub_list[:2]],
+                      [s.callback for s in subs])
+    self.assertEquals(self.secret, subs[0].secret)
+    event.update(more, [subs[0]])
+    event = EventToDeliver.get(work_key)
+    self.assertEquals([sub_keys[0]], event.failed_callbacks)
+
+    # Falls back to querying when the roster goes away mid-delivery.
+    db.delete([main.SubscriberRoster.create_key(main.sha1_hash(self.topic), i)
+               for i in xrange(main.ROSTER_SHARD_COUNT)])
+    more, subs = event.get_next_subscribers(chunk_size=2)
+    self.assertFalse(more)
+    self.assertFalse(event.use_roster)
+    self.assertEquals(sub_keys[2:], [s.key() for s in subs])
+
+  def testGetNextSubscribers_rosterBuilding(self):
+    """Tests that rosters still being built are not used for delivery."""
+    event, work_key, sub_list, sub_keys = self.insert_subscriptions()
+    main.SubscriberRoster.start_build(main.sha1_hash(self.topic))
+
+    more, subs = event.get_next_subscribers(chunk_size=2)
+    self.assertTrue(more)
+    self.assertFalse(event.use_roster)
+    self.assertEquals(sub_keys[:2], [s.key() for s in subs])
+
   def testGetNextSubscribers_retriesFinallySuccessful(self):
     """Tests retries until all subscribers are successful."""
     event, work_key, sub_list, sub_keys = self.insert_subscriptions()
@@ -1147,6 +1689,32 @@ u"""<?xml version="1.0" encoding="utf-8"?>
     found_etas = [t['eta'] for t in tasks]
     self.assertEquals(etas, found_etas)
 
+  def testUpdate_refreshesPayload(self):
+    """Tests that events being retried keep their payload from cleanup."""
+    start = datetime.datetime(2010, 1, 1)
+    event = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, 'application/atom+xml',
+        self.header_footer, self.test_payloads, now=lambda: start)
+    event.put()
+    Subscription.insert(self.callback, self.topic, self.token, self.secret)
+    payload_key = db.Key.from_path(
+        main.EventPayload.kind(),
+        main.EventPayload.create_key_name(event.payload_hash))
+
+    # Retried within a day of the payload being stored.
+    more, subs = event.get_next_subscribers()
+    event.update(more, subs, retry_period=60,
+                 now=lambda: start + datetime.timedelta(hours=1))
+    self.assertEquals(start, db.get(payload_key).last_modified)
+
+    # Retried long after; the payload lasts until the next attempt.
+    later = start + datetime.timedelta(days=20)
+    more, subs = event.get_next_subscribers()
+    event.update(more, subs, retry_period=60, now=lambda: later)
+    self.assertEquals(later + datetime.timedelta(seconds=120),
+                      db.get(payload_key).last_modified)
+    self.assertEquals(event.last_modified, db.get(payload_key).last_modified)
+
   def testQueuePreserved(self):
     """Tests that enqueueing an EventToDeliver preserves the polling queue."""
     event, work_key, sub_list, sub_keys = self.insert_subscriptions()
@@ -1198,6 +1766,7 @@ class PublishHandlerTest(testutil.HandlerTestBase):
 
   def setUp(self):
     testutil.HandlerTestBase.setUp(self)
+    main.TOPIC_ALIAS_CACHE.clear()
     self.topic = 'http://example.com/first-url'
     self.topic2 = 'http://example.com/second-url'
     self.topic3 = 'http://example.com/third-url'
@@ -1254,6 +1823,23 @@ class PublishHandlerTest(testutil.HandlerTestBase):
     self.assertEquals(204, self.response_code())
     testutil.get_tasks(main.FEED_QUEUE, expected_count=0)
 
+  def testDeferFiltering(self):
+    """Tests that unknown feeds are enqueued when filtering is deferred."""
+    old_defer = main.DEFER_PUBLISH_FILTERING
+    main.DEFER_PUBLISH_FILTERING = True
+    try:
+      self.handle('post',
+                  ('hub.mode', 'PuBLisH'),
+                  ('hub.url', self.topic),
+                  ('hub.url', self.topic2))
+    finally:
+      main.DEFER_PUBLISH_FILTERING = old_defer
+    self.assertEquals(204, self.response_code())
+    feed_list = self.get_feeds_to_fetch()
+    self.assertEquals(set([self.topic, self.topic2]),
+                      set(f.topic for f in feed_list))
+    self.assertEquals([True, True], [f.needs_expansion for f in feed_list])
+
   def testDuplicateUrls(self):
     db.put([KnownFeed.create(self.topic),
             KnownFeed.create(self.topic2)])
@@ -1402,6 +1988,360 @@ class PublishHandlerThroughHubUrlTest(PublishHandlerTest):
 
 ################################################################################
 
+class EntityCacheTest(unittest.TestCase):
+  """Tests for the EntityCache class."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing()
+    self.cache = main.EntityCache('test', 60)
+    self.topic = 'http://example.com/my-topic'
+    self.key = main.KnownFeedStats.create_key(self.topic)
+
+  def put_stats(self, count):
+    """Writes a KnownFeedStats for the topic directly to the Datastore."""
+    stats = main.KnownFeedStats(key=self.key, subscriber_count=count)
+    stats.put()
+    return stats
+
+  def get_count(self):
+    """Returns the subscriber count read through the cache."""
+    return self.cache.get([self.key])[0].subscriber_count
+
+  def testGetNames(self):
+    """Tests the memcache keys of an entity."""
+    self.assertEquals(
+        ('test:%s/overall' % get_hash_key_name(self.topic),
+         'test_version:%s/overall' % get_hash_key_name(self.topic)),
+        self.cache.get_names(self.key))
+
+  def testReadThrough(self):
+    """Tests that entities are cached once read."""
+    self.put_stats(1)
+    # The first read only sets up the version.
+    self.assertEquals(1, self.get_count())
+    self.put_stats(2)
+    self.assertEquals(2, self.get_count())
+    self.put_stats(3)
+    self.assertEquals(2, self.get_count())
+    self.assertEquals(
+        [None], self.cache.get([main.KnownFeedStats.create_key('other')]))
+
+  def testWriteThrough(self):
+    """Tests that written entities replace cached ones."""
+    self.put_stats(1)
+    self.get_count()
+    self.get_count()
+    self.cache.put([self.put_stats(2)])
+    db.delete(self.key)
+    self.assertEquals(2, self.get_count())
+
+  def testInvalidate(self):
+    """Tests that invalidated entities are read again."""
+    self.put_stats(1)
+    self.get_count()
+    self.get_count()
+    self.put_stats(2)
+    self.assertEquals(1, self.get_count())
+    self.cache.invalidate([self.key])
+    self.assertEquals(2, self.get_count())
+
+  def testStaleRead(self):
+    """Tests that an entity read before a write can't be cached after it."""
+    self.put_stats(1)
+    self.get_count()
+    entity_name, version_name = self.cache.get_names(self.key)
+    old_version = memcache.get(version_name)
+    self.cache.put([self.put_stats(2)])
+    # A slow reader caches what it read before the write.
+    memcache.set(entity_name, self.cache.encode(
+        old_version, main.KnownFeedStats(key=self.key, subscriber_count=1)))
+    self.assertEquals(2, self.get_count())
+
+  def testAsync(self):
+    """Tests retrieving entities asynchronously."""
+    self.put_stats(1)
+    self.get_count()
+    self.get_count()
+    other_key = main.KnownFeedStats.create_key(self.topic + '/other')
+    results = []
+    def callback(model_list, exception):
+      results.append((model_list, exception))
+    async_proxy = async_apiproxy.AsyncAPIProxy()
+    self.assertTrue(self.cache.get([self.key, other_key],
+                                   async_proxy=async_proxy,
+                                   callback=callback) is None)
+    self.assertEquals([], results)
+    async_proxy.wait()
+    [(model_list, exception)] = results
+    self.assertTrue(exception is None)
+    self.assertEquals(1, model_list[0].subscriber_count)
+    self.assertTrue(model_list[1] is None)
+
+    # All cached, so the callback runs right away.
+    results = []
+    self.cache.get([self.key], async_proxy=async_proxy, callback=callback)
+    self.assertEquals(1, len(results))
+    self.assertEquals(1, results[0][0][0].subscriber_count)
+
+
+class SeenEntriesTest(unittest.TestCase):
+  """Tests for the SeenEntries digest and how it's kept on FeedRecord."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing()
+    self.topic = 'http://example.com/my-topic-here'
+
+  def testAddAndPack(self):
+    """Tests adding entries and round-tripping the packed digest."""
+    seen = main.SeenEntries()
+    seen.add(sha1_hash('id1'), sha1_hash('content1'))
+    seen.add(sha1_hash('id2'), sha1_hash('content2'))
+    packed = seen.pack()
+    self.assertEquals(1 + 2 * (2 * main.SEEN_ENTRY_DIGEST_BYTES + 2),
+                      len(packed))
+
+    seen = main.SeenEntries(packed)
+    self.assertEquals(2, len(seen))
+    self.assertTrue(seen.is_unchanged(sha1_hash('id1'), sha1_hash('content1')))
+    self.assertFalse(seen.is_unchanged(sha1_hash('id1'), sha1_hash('other')))
+    self.assertFalse(seen.is_unchanged(sha1_hash('id3'), sha1_hash('content1')))
+
+  def testForgetsOldest(self):
+    """Tests that the entries seen longest ago are dropped when full."""
+    old_max = main.MAX_SEEN_ENTRIES
+    main.MAX_SEEN_ENTRIES = 2
+    try:
+      seen = main.SeenEntries()
+      for entry_id in ('id1', 'id2', 'id3'):
+        seen.add(sha1_hash(entry_id), sha1_hash('content'))
+      # Seeing an entry again makes it the newest.
+      seen.add(sha1_hash('id1'), sha1_hash('content'))
+      seen = main.SeenEntries(seen.pack())
+    finally:
+      main.MAX_SEEN_ENTRIES = old_max
+    self.assertEquals(2, len(seen))
+    self.assertTrue(seen.is_unchanged(sha1_hash('id1'), sha1_hash('content')))
+    self.assertFalse(seen.is_unchanged(sha1_hash('id2'), sha1_hash('content')))
+    self.assertTrue(seen.is_unchanged(sha1_hash('id3'), sha1_hash('content')))
+
+  def testMigrateFromFeedEntryRecords(self):
+    """Tests building the digest from a topic's FeedEntryRecords."""
+    record = FeedRecord.get_or_create(self.topic)
+    self.assertEquals(0, len(record.get_seen_entries()))
+    db.put([FeedEntryRecord(
+                key=FeedEntryRecord.create_legacy_key(self.topic, entry_id),
+                entry_content_hash=sha1_hash('content'))
+            for entry_id in ('id1', 'id2')])
+
+    # Only the records of entries in the document being diffed are read.
+    seen = record.get_seen_entries()
+    self.assertEquals(0, len(seen))
+    seen.add_legacy_records(['id2', 'id3'])
+    self.assertEquals(1, len(seen))
+    self.assertTrue(seen.is_unchanged(sha1_hash('id2'), sha1_hash('content')))
+    self.assertFalse(seen.is_unchanged(sha1_hash('id1'), sha1_hash('content')))
+
+    # Once the digest has been saved the records are no longer read.
+    record.add_seen_entries(seen, [])
+    record.put()
+    db.delete(list(main.FeedEntryRecord.all()))
+    record = db.get(record.key())
+    seen = record.get_seen_entries()
+    seen.add_legacy_records(['id1'])
+    self.assertEquals(1, len(seen))
+
+  def testMerge(self):
+    """Tests merging in a digest saved by another parse."""
+    seen = main.SeenEntries()
+    seen.add(sha1_hash('id1'), sha1_hash('content1'))
+    seen = main.SeenEntries(seen.pack())
+    other = main.SeenEntries(seen.pack())
+    other.add(sha1_hash('id2'), sha1_hash('content2'))
+    other.add(sha1_hash('id3'), sha1_hash('content3'))
+
+    seen.add(sha1_hash('id1'), sha1_hash('new content1'))
+    seen.merge(other.pack())
+    self.assertEquals(3, len(seen))
+
+    # Entries seen here are kept as the newest ones.
+    orders = [seen.entries[seen.digest(sha1_hash(entry_id))][0]
+              for entry_id in ('id2', 'id3', 'id1')]
+    self.assertEquals(sorted(orders), orders)
+
+    seen = main.SeenEntries(seen.pack())
+    self.assertTrue(
+        seen.is_unchanged(sha1_hash('id1'), sha1_hash('new content1')))
+    self.assertTrue(seen.is_unchanged(sha1_hash('id2'), sha1_hash('content2')))
+    self.assertTrue(seen.is_unchanged(sha1_hash('id3'), sha1_hash('content3')))
+
+  def testKeepsEntriesSeenUnchanged(self):
+    """Tests that entries found unchanged are not forgotten first."""
+    old_max = main.MAX_SEEN_ENTRIES
+    main.MAX_SEEN_ENTRIES = 2
+    try:
+      seen = main.SeenEntries()
+      for entry_id in ('id1', 'id2'):
+        seen.add(sha1_hash(entry_id), sha1_hash('content'))
+      seen = main.SeenEntries(seen.pack())
+      self.assertTrue(
+          seen.is_unchanged(sha1_hash('id1'), sha1_hash('content')))
+      seen.add(sha1_hash('id3'), sha1_hash('content'))
+      seen = main.SeenEntries(seen.pack())
+    finally:
+      main.MAX_SEEN_ENTRIES = old_max
+    self.assertEquals(2, len(seen))
+    self.assertTrue(seen.is_unchanged(sha1_hash('id1'), sha1_hash('content')))
+    self.assertFalse(seen.is_unchanged(sha1_hash('id2'), sha1_hash('content')))
+
+  def testKeepsWholeDocument(self):
+    """Tests that documents with more entries than the maximum are kept."""
+    old_max = main.MAX_SEEN_ENTRIES
+    old_limit = main.SEEN_ENTRY_LIMIT
+    main.MAX_SEEN_ENTRIES = 2
+    main.SEEN_ENTRY_LIMIT = 4
+    try:
+      seen = main.SeenEntries()
+      for entry_id in ('id1', 'id2', 'id3'):
+        seen.add(sha1_hash(entry_id), sha1_hash('content'))
+      seen = main.SeenEntries(seen.pack())
+      self.assertEquals(3, len(seen))
+
+      # The digest does not shrink when fewer entries are seen.
+      seen.add(sha1_hash('id4'), sha1_hash('content'))
+      seen = main.SeenEntries(seen.pack())
+      self.assertEquals(3, len(seen))
+      self.assertFalse(
+          seen.is_unchanged(sha1_hash('id1'), sha1_hash('content')))
+
+      # But never grows past the limit.
+      for entry_id in ('id5', 'id6', 'id7', 'id8', 'id9'):
+        seen.add(sha1_hash(entry_id), sha1_hash('content'))
+      self.assertEquals(4, len(main.SeenEntries(seen.pack())))
+    finally:
+      main.MAX_SEEN_ENTRIES = old_max
+      main.SEEN_ENTRY_LIMIT = old_limit
+
+  def testUnsavedFeedRecord(self):
+    """Tests that new FeedRecords start with an empty digest."""
+    record = FeedRecord.get_or_create_all([self.topic])[0]
+    self.assertEquals(0, len(record.get_seen_entries()))
+
+  def testCanonicalContent(self):
+    """Tests entries diffed by the hash of their canonical content."""
+    seen = main.SeenEntries()
+    seen.add(sha1_hash('id1'), sha1_hash('canonical'), sha1_hash('raw1'))
+    seen = main.SeenEntries(seen.pack())
+
+    # Same raw content is not counted as suppressed.
+    self.assertTrue(seen.is_unchanged(
+        sha1_hash('id1'), sha1_hash('canonical'), sha1_hash('raw1')))
+    self.assertEquals(0, seen.suppressed)
+    self.assertTrue(seen.is_unchanged(
+        sha1_hash('id1'), sha1_hash('canonical'), sha1_hash('raw2')))
+    self.assertEquals(1, seen.suppressed)
+    self.assertFalse(seen.is_unchanged(
+        sha1_hash('id1'), sha1_hash('other'), sha1_hash('raw1')))
+
+    # The same masked change is only counted once, even after packing.
+    seen = main.SeenEntries(seen.pack())
+    self.assertTrue(seen.is_unchanged(
+        sha1_hash('id1'), sha1_hash('canonical'), sha1_hash('raw2')))
+    self.assertEquals(0, seen.suppressed)
+
+  def testCanonicalContent_SeenBeforeRules(self):
+    """Tests entries seen before rules applied are matched by raw content."""
+    seen = main.SeenEntries()
+    seen.add(sha1_hash('id1'), sha1_hash('raw'))
+    self.assertTrue(seen.is_unchanged(
+        sha1_hash('id1'), sha1_hash('canonical'), sha1_hash('raw')))
+    self.assertFalse(seen.is_unchanged(
+        sha1_hash('id1'), sha1_hash('canonical'), sha1_hash('raw2')))
+    self.assertEquals(0, seen.suppressed)
+
+  def testSuppressedEntries(self):
+    """Tests that suppressed entries are added up on the FeedRecord."""
+    record = FeedRecord.get_or_create(self.topic)
+    seen = record.get_seen_entries()
+    seen.add(sha1_hash('id1'), sha1_hash('canonical'), sha1_hash('raw1'))
+    seen.is_unchanged(
+        sha1_hash('id1'), sha1_hash('canonical'), sha1_hash('raw2'))
+    record.add_seen_entries(seen, [])
+    self.assertEquals(1, record.suppressed_entries)
+    self.assertEquals(0, seen.suppressed)
+    record.add_seen_entries(seen, [])
+    self.assertEquals(1, record.suppressed_entries)
+
+  def testLastSeen(self):
+    """Tests keeping the day each entry was last seen in the feed."""
+    then = datetime.datetime(2011, 3, 4, 5, 6)
+    seen = main.SeenEntries(now=lambda: then)
+    seen.add(sha1_hash('id1'), sha1_hash('content'))
+    seen.add(sha1_hash('id2'), sha1_hash('content'))
+    self.assertEquals(then.date(), seen.last_seen(sha1_hash('id1')))
+    self.assertTrue(seen.last_seen(sha1_hash('id3')) is None)
+
+    later = then + datetime.timedelta(days=3)
+    seen = main.SeenEntries(seen.pack(), now=lambda: later)
+    self.assertTrue(seen.is_unchanged(sha1_hash('id1'), sha1_hash('content')))
+    seen = main.SeenEntries(seen.pack())
+    self.assertEquals(later.date(), seen.last_seen(sha1_hash('id1')))
+    self.assertEquals(then.date(), seen.last_seen(sha1_hash('id2')))
+
+  def testLegacyPacking(self):
+    """Tests reading digests packed without the days entries were seen."""
+    size = main.SEEN_ENTRY_DIGEST_BYTES
+    packed = (sha1_hash('id1').decode('hex')[:size] +
+              sha1_hash('content').decode('hex')[:size])
+    today = datetime.datetime.utcnow()
+    seen = main.SeenEntries(packed, now=lambda: today)
+    self.assertEquals(1, len(seen))
+    self.assertTrue(seen.is_unchanged(sha1_hash('id1'), sha1_hash('content')))
+    self.assertEquals(today.date(), seen.last_seen(sha1_hash('id1')))
+
+
+class GetContentHashRulesTest(unittest.TestCase):
+  """Tests for the get_content_hash_rules function."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    self.old_rules = main.CONTENT_HASH_RULES
+
+  def tearDown(self):
+    """Tears down the test harness."""
+    main.CONTENT_HASH_RULES = self.old_rules
+
+  def testNoRules(self):
+    """Tests when no rules are configured."""
+    main.CONTENT_HASH_RULES = {}
+    self.assertTrue(
+        main.get_content_hash_rules('http://example.com/feed') is None)
+
+  def testLookup(self):
+    """Tests rules for topics, domains, parent domains, and the default."""
+    main.CONTENT_HASH_RULES = {
+      'http://example.com/special': 'topic',
+      'example.com': 'domain',
+      'www.example.com': 'subdomain',
+    }
+    self.assertEquals('topic', main.get_content_hash_rules(
+        'http://example.com/special'))
+    self.assertEquals('domain', main.get_content_hash_rules(
+        'http://example.com/feed'))
+    self.assertEquals('domain', main.get_content_hash_rules(
+        'http://blog.EXAMPLE.com:8080/feed'))
+    self.assertEquals('subdomain', main.get_content_hash_rules(
+        'http://www.example.com/feed'))
+    self.assertTrue(
+        main.get_content_hash_rules('http://example.org/feed') is None)
+
+    main.CONTENT_HASH_RULES[''] = 'default'
+    self.assertEquals('default', main.get_content_hash_rules(
+        'http://example.org/feed'))
+
+################################################################################
+
 class FindFeedUpdatesTest(unittest.TestCase):
 
   def setUp(self):
@@ -1501,6 +2441,218 @@ class FindFeedUpdatesTest(unittest.TestCase):
       main.MAX_FEED_ENTRY_RECORD_LOOKUPS = old_lookups
       main.FeedEntryRecord.get_entries_for_topic = old_get_feed_record
 
+  def testSeenEntries(self):
+    """Tests that the digest is used instead of FeedEntryRecords."""
+    FeedEntryRecord.create_entry_for_topic(
+        self.topic, 'id3', sha1_hash('content3')).put()
+    seen_entries = main.SeenEntries()
+    seen_entries.add(sha1_hash('id1'), sha1_hash('content1'))
+    seen_entries.add(sha1_hash('id2'), sha1_hash('oldcontent2'))
+
+    header_footer, entry_list, entry_payloads = main.find_feed_updates(
+        self.topic, main.ATOM, self.content, filter_feed=self.my_filter,
+        seen_entries=seen_entries)
+    self.assertEquals(set(sha1_hash(k) for k in ['id2', 'id3']),
+                      set(f.id_hash for f in entry_list))
+
+  def testLegacySaxHashes(self):
+    """Tests that hashes of entries rebuilt by the SAX parser still match."""
+    data = open(os.path.join(os.path.dirname(__file__), 'feed_diff_testdata',
+                             'parsing.xml')).read()
+    sax_entries = feed_diff.filter(data, main.ATOM)[1]
+    entries = feed_diff.zero_copy_filter(data, main.ATOM)[1]
+    seen_entries = main.SeenEntries()
+    for entry_id, content in sax_entries.iteritems():
+      seen_entries.add(sha1_hash(entry_id), sha1_hash(content))
+    changed_id = sax_entries.keys()[0]
+    seen_entries.add(sha1_hash(changed_id), sha1_hash('old content'))
+
+    entry_list, entry_payloads = main.find_feed_updates(
+        self.topic, main.ATOM, data, seen_entries=seen_entries,
+        stop_early=False)[1:]
+    self.assertEquals([sha1_hash(changed_id)],
+                      [e.id_hash for e in entry_list])
+    # The digest now has the hashes of the sliced entries.
+    del entries[changed_id]
+    for entry_id, content in entries.iteritems():
+      self.assertTrue(seen_entries.is_unchanged(
+          sha1_hash(entry_id), sha1_hash(content)))
+
+  def testContentHashRules(self):
+    """Tests that changes to masked parts of entries are ignored."""
+    old_rules = main.CONTENT_HASH_RULES
+    main.CONTENT_HASH_RULES = {
+      'example.com': feed_diff.CanonicalizationRules(
+          ignore_elements=['updated']),
+    }
+    try:
+      self.entries_map = {
+        'id1': '<entry><updated>1</updated>content1</entry>',
+        'id2': '<entry><updated>1</updated>content2</entry>',
+      }
+      seen_entries = main.SeenEntries()
+      entry_list, entry_payloads = main.find_feed_updates(
+          self.topic, main.ATOM, self.content, filter_feed=self.my_filter,
+          seen_entries=seen_entries)[1:]
+      self.assertEquals(2, len(entry_list))
+      entry = self.get_entry('id1', entry_list)
+      self.assertEquals(sha1_hash('<entry>content1</entry>'),
+                        entry.entry_content_hash)
+      self.assertEquals(sha1_hash(self.entries_map['id1']),
+                        entry.raw_content_hash)
+      FeedRecord.get_or_create(self.topic).add_seen_entries(
+          seen_entries, entry_list)
+
+      self.entries_map = {
+        'id1': '<entry><updated>2</updated>content1</entry>',
+        'id2': '<entry><updated>2</updated>newcontent2</entry>',
+      }
+      entry_list, entry_payloads = main.find_feed_updates(
+          self.topic, main.ATOM, self.content, filter_feed=self.my_filter,
+          seen_entries=seen_entries)[1:]
+      self.assertEquals([sha1_hash('id2')], [e.id_hash for e in entry_list])
+      self.assertEquals(1, seen_entries.suppressed)
+    finally:
+      main.CONTENT_HASH_RULES = old_rules
+
+  def testBudget(self):
+    """Tests that entries past the budget are dropped."""
+    budget = main.ParseBudget(len('content1') + len('content2'))
+    header_footer, entry_list, entry_payloads = main.find_feed_updates(
+        self.topic, main.ATOM, self.content, filter_feed=self.my_filter,
+        budget=budget)
+    self.assertTrue(budget.exceeded)
+    self.assertEquals(2, len(entry_list))
+    self.assertEquals(2, len(entry_payloads))
+
+
+class FindFeedUpdatesIncrementalTest(unittest.TestCase):
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing()
+    self.topic = 'http://example.com/my-topic-here'
+    self.old_run = main.MAX_SEEN_ENTRY_RUN
+    self.old_batch_size = main.INCREMENTAL_DIFF_BATCH_SIZE
+    main.MAX_SEEN_ENTRY_RUN = 2
+    main.INCREMENTAL_DIFF_BATCH_SIZE = 1
+
+  def tearDown(self):
+    """Tears down the test harness."""
+    main.MAX_SEEN_ENTRY_RUN = self.old_run
+    main.INCREMENTAL_DIFF_BATCH_SIZE = self.old_batch_size
+
+  @staticmethod
+  def make_feed(entry_ids):
+    """Makes an Atom feed with the given entry IDs in order."""
+    return ('<feed><title>my feed</title>%s</feed>' %
+            ''.join('<entry><id>%s</id></entry>' % i for i in entry_ids))
+
+  def save_entries(self, entry_ids):
+    """Saves FeedEntryRecords as if the given entries were already seen."""
+    db.put([FeedEntryRecord.create_entry_for_topic(
+                self.topic, i, sha1_hash(u'<entry><id>%s</id></entry>' % i))
+            for i in entry_ids])
+
+  def run_test(self, entry_ids):
+    """Runs a test and returns the IDs of new entries found."""
+    header_footer, entry_list, entry_payloads = main.find_feed_updates(
+        self.topic, main.ATOM, self.make_feed(entry_ids))
+    self.assertEquals(u'<feed><title>my feed</title>\n</feed>', header_footer)
+    return [p[len('<entry><id>'):-len('</id></entry>')]
+            for p in entry_payloads]
+
+  def testStopsAtSeenEntries(self):
+    """Tests that lookups stop after a run of unchanged entries."""
+    self.save_entries(['3', '4', '5', '6'])
+    calls = []
+    old_get_entries = main.FeedEntryRecord.get_entries_for_topic
+    @staticmethod
+    def fake_get_entries(topic, entry_id_list):
+      calls.append(list(entry_id_list))
+      return old_get_entries(topic, entry_id_list)
+    main.FeedEntryRecord.get_entries_for_topic = fake_get_entries
+    try:
+      self.assertEquals(['1', '2'],
+                        self.run_test(['1', '2', '3', '4', '5', '6']))
+    finally:
+      main.FeedEntryRecord.get_entries_for_topic = old_get_entries
+    self.assertEquals([['6'], ['1'], ['2'], ['3'], ['4']], calls)
+
+  def testStopMatchesFilterEnvelope(self):
+    """Tests that stopping early keeps the same header/footer as filter()."""
+    for path, format in (('rss2sample.xml', main.RSS),
+                         ('sampleRss091.xml', main.RSS),
+                         ('parsing.xml', main.ATOM)):
+      data = open(os.path.join(os.path.dirname(__file__),
+                               'feed_diff_testdata', path)).read()
+      seen_entries = main.SeenEntries()
+      for entry_id, content in feed_diff.filter(data, format)[1].iteritems():
+        seen_entries.add(sha1_hash(entry_id), sha1_hash(content))
+      calls = []
+      old_diff = main.diff_entries
+      def fake_diff(topic, entries, **kwargs):
+        calls.append(entries)
+        return old_diff(topic, entries, **kwargs)
+      main.diff_entries = fake_diff
+      try:
+        header_footer, entry_list, entry_payloads = main.find_feed_updates(
+            self.topic, format, data, seen_entries=seen_entries)
+      finally:
+        main.diff_entries = old_diff
+      self.assertEquals([], entry_payloads)
+      # The last entry, then two entries before the run of seen entries ends.
+      self.assertEquals(3, len(calls))
+      self.assertEquals(feed_diff.zero_copy_filter(data, format)[0],
+                        header_footer)
+      if format == main.RSS:
+        self.assertEquals(feed_diff.filter(data, format)[0], header_footer)
+
+  def testNewEntryAfterSeenRun(self):
+    """Tests that a single seen entry does not stop diffing."""
+    self.save_entries(['2', '4'])
+    self.assertEquals(['1', '3'], self.run_test(['1', '2', '3', '4']))
+
+  def testOldestFirst(self):
+    """Tests that feeds with new entries at the end are fully diffed."""
+    self.save_entries(['1', '2', '3', '4'])
+    self.assertEquals(['5'], self.run_test(['1', '2', '3', '4', '5']))
+
+  def testDisabled(self):
+    """Tests that the whole feed is diffed when stopping is disabled."""
+    main.MAX_SEEN_ENTRY_RUN = 0
+    self.save_entries(['2', '3', '4'])
+    self.assertEquals(['1', '5'],
+                      sorted(self.run_test(['1', '2', '3', '4', '5'])))
+
+  def testStopEarlyOff(self):
+    """Tests that the whole feed is diffed after a cut-short parse."""
+    self.save_entries(['1', '2', '3', '5'])
+    header_footer, entry_list, entry_payloads = main.find_feed_updates(
+        self.topic, main.ATOM, self.make_feed(['1', '2', '3', '4', '5']),
+        stop_early=False)
+    self.assertEquals([u'<entry><id>4</id></entry>'], entry_payloads)
+
+  def testBudget(self):
+    """Tests that parsing stops once the budget is used up."""
+    entry_size = len('<entry><id>1</id></entry>')
+    budget = main.ParseBudget(2 * entry_size)
+    header_footer, entry_list, entry_payloads = main.find_feed_updates(
+        self.topic, main.ATOM, self.make_feed(['1', '2', '3', '4', '5']),
+        budget=budget)
+    self.assertTrue(budget.exceeded)
+    self.assertEquals([u'<entry><id>1</id></entry>',
+                       u'<entry><id>2</id></entry>'], entry_payloads)
+    self.assertEquals(2, len(entry_list))
+
+  def testBudget_FirstEntryAlwaysFits(self):
+    """Tests that a single oversized entry is still kept."""
+    budget = main.ParseBudget(1)
+    header_footer, entry_list, entry_payloads = main.find_feed_updates(
+        self.topic, main.ATOM, self.make_feed(['1', '2']), budget=budget)
+    self.assertTrue(budget.exceeded)
+    self.assertEquals([u'<entry><id>1</id></entry>'], entry_payloads)
+
 ################################################################################
 
 FeedRecord = main.FeedRecord
@@ -1522,10 +2674,10 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     ]
     self.entry_list = [
         FeedEntryRecord.create_entry_for_topic(
-            self.topic, entry_id, 'content%s' % entry_id)
+            self.topic, entry_id, sha1_hash('content%s' % entry_id))
         for entry_id in self.all_ids
     ]
-    self.expected_response = 'the expected response data'
+    self.expected_response = '<feed>the expected response data</feed>'
     self.etag = 'something unique'
     self.last_modified = 'some time'
     self.headers = {
@@ -1534,16 +2686,28 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
       'Content-Type': 'application/atom+xml',
     }
     self.expected_exceptions = []
+    self.parsed_formats = []
+    self.stop_early_calls = []
+    self.over_budget = False
 
-    def my_find_updates(ignored_topic, ignored_format, content):
+    def my_find_updates(ignored_topic, format, content, seen_entries=None,
+                        budget=None, stop_early=True):
       self.assertEquals(self.expected_response, content)
+      self.assertTrue(seen_entries is not None)
+      self.parsed_formats.append(format)
+      self.stop_early_calls.append(stop_early)
       if self.expected_exceptions:
         raise self.expected_exceptions.pop(0)
+      budget.exceeded = self.over_budget
       return self.header_footer, self.entry_list, self.entry_payloads
 
     self.old_find_feed_updates = main.find_feed_updates
     main.find_feed_updates = my_find_updates
 
+    # Most tests check the per-entry records that are kept as a fallback.
+    self.old_save_feed_entry_records = main.SAVE_FEED_ENTRY_RECORDS
+    main.SAVE_FEED_ENTRY_RECORDS = True
+
     self.callback = 'http://example.com/my-subscriber'
     self.assertTrue(Subscription.insert(
         self.callback, self.topic, 'token', 'secret'))
@@ -1551,6 +2715,7 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
   def tearDown(self):
     """Tears down the test harness."""
     main.find_feed_updates = self.old_find_feed_updates
+    main.SAVE_FEED_ENTRY_RECORDS = self.old_save_feed_entry_records
     urlfetch_test_stub.instance.verify_and_reset()
 
   def run_fetch_task(self, index=0):
@@ -1562,8 +2727,150 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     finally:
       del os.environ['HTTP_X_APPENGINE_TASKNAME']
 
-  def testNoWork(self):
-    self.handle('post', ('topic', self.topic))
+  def get_continuation_tasks(self):
+    """Returns the enqueued tasks that continue parsing a feed document."""
+    return [t for t in testutil.get_tasks(main.FEED_QUEUE)
+            if t['url'] == '/work/continue_feeds']
+
+  def run_continuation(self):
+    """Runs the ContinueFeedHandler for the topic."""
+    self.handler_class = main.ContinueFeedHandler
+    try:
+      self.handle('post', ('topic', self.topic))
+    finally:
+      self.handler_class = main.PullFeedHandler
+
+  def save_entry_records(self):
+    """Runs the enqueued tasks that save FeedEntryRecords."""
+    self.handler_class = main.SaveFeedEntryRecordsHandler
+    try:
+      for task in testutil.get_tasks(main.ENTRY_RECORDS_QUEUE):
+        self.handle('post', *task['params'].items())
+    finally:
+      self.handler_class = main.PullFeedHandler
+
+  def testNoWork(self):
+    self.handle('post', ('topic', self.topic))
+
+  def testUnchangedContent(self):
+    """Tests that an identical document is not parsed again."""
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.run_fetch_task()
+    db.delete(list(EventToDeliver.all()))
+
+    def fail_find_updates(*args, **kwargs):
+      self.fail('Should not parse unchanged content')
+    main.find_feed_updates = fail_find_updates
+
+    for content in (self.expected_response,
+                    '  <feed>the expected\nresponse   data</feed>\n'):
+      FeedToFetch.insert([self.topic])
+      urlfetch_test_stub.instance.expect(
+          'get', self.topic, 200, content, response_headers=self.headers)
+      self.run_fetch_task()
+      testutil.get_tasks(main.FEED_RETRIES_QUEUE, expected_count=0)
+      self.assertEquals(None, EventToDeliver.all().get())
+      self.assertEquals(None, FeedToFetch.get_by_topic(self.topic))
+
+    # New response headers are still saved for the next fetch.
+    self.headers['ETag'] = 'something else'
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.run_fetch_task()
+    self.assertEquals(None, EventToDeliver.all().get())
+    record = FeedRecord.get_by_key_name(FeedRecord.create_key_name(self.topic))
+    self.assertEquals('something else', record.etag)
+    self.assertEquals(
+        'something else',
+        record.get_request_headers(0)['If-None-Match'])
+
+  def testUnchangedContent_WordsSplitDifferently(self):
+    """Tests that whitespace within words is not ignored."""
+    record = FeedRecord.get_or_create(self.topic)
+    record.update(self.headers, content='<feed>new york</feed>')
+    self.assertTrue(record.is_unchanged('<feed>\n  new\t york </feed>'))
+    self.assertFalse(record.is_unchanged('<feed>newyork</feed>'))
+    self.assertFalse(record.is_unchanged('<feed>new y ork</feed>'))
+
+  def testUnchangedContent_Arbitrary(self):
+    """Tests that arbitrary content is always delivered."""
+    record = FeedRecord.get_or_create(self.topic)
+    record.update(self.headers, format=main.ARBITRARY,
+                  content=self.expected_response)
+    self.assertFalse(record.is_unchanged(self.expected_response))
+    record.update(self.headers, format=main.ATOM)
+    self.assertTrue(record.is_unchanged(self.expected_response))
+    self.assertFalse(record.is_unchanged('different data'))
+
+  def testHeaderFooterEncoded(self):
+    """Tests that the header and footer are stored compressed."""
+    record = FeedRecord.get_or_create(self.topic)
+    header_footer = u'<feed><title>%s</title></feed>' % (u'\u2603' * 1000)
+    record.update(self.headers, header_footer, main.ATOM)
+    record.put()
+    record = db.get(record.key())
+    self.assertEquals(None, record.header_footer)
+    self.assertTrue(len(record.header_footer_data) < 1000)
+    self.assertEquals(header_footer, record.get_header_footer())
+
+    # Records saved before the header and footer were encoded.
+    record.header_footer_data = None
+    record.header_footer = u'<feed/>'
+    self.assertEquals(u'<feed/>', record.get_header_footer())
+
+  def testNewEntries_SeenEntriesOnly(self):
+    """Tests that only the digest is written when records aren't kept."""
+    main.SAVE_FEED_ENTRY_RECORDS = False
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.run_fetch_task()
+
+    self.assertEquals([], list(FeedEntryRecord.all()))
+    self.assertTrue(EventToDeliver.all().get() is not None)
+    seen_entries = FeedRecord.get_or_create(self.topic).get_seen_entries()
+    self.assertEquals(3, len(seen_entries))
+    for entry_id in self.all_ids:
+      self.assertTrue(seen_entries.is_unchanged(
+          sha1_hash(entry_id), sha1_hash('content%s' % entry_id)))
+
+  def testNewEntries_SaveRecordsInTask(self):
+    """Tests that FeedEntryRecords are saved by a task outside the FeedRecord's
+    entity group."""
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.run_fetch_task()
+
+    # The event and the digest are saved, and the records are left to a task.
+    self.assertEquals([], list(FeedEntryRecord.all()))
+    self.assertTrue(EventToDeliver.all().get() is not None)
+    testutil.get_tasks(main.EVENT_QUEUE, expected_count=1)
+    task = testutil.get_tasks(main.ENTRY_RECORDS_QUEUE,
+                              index=0, expected_count=1)
+    self.assertEquals(self.topic, task['params']['topic'])
+    self.assertEquals(
+        3, len(FeedRecord.get_or_create(self.topic).get_seen_entries()))
+
+    self.save_entry_records()
+    feed_entries = list(FeedEntryRecord.all())
+    self.assertEquals(3, len(feed_entries))
+    record_key = db.Key.from_path(FeedRecord.kind(),
+                                  FeedRecord.create_key_name(self.topic))
+    for entry in feed_entries:
+      self.assertTrue(entry.key().parent() is None)
+      self.assertEquals(record_key, entry.feed_record_key)
+
+    # Saving them again when the task is retried only overwrites them.
+    self.save_entry_records()
+    self.assertEquals(3, len(list(FeedEntryRecord.all())))
 
   def testNewEntries_Atom(self):
     """Tests when new entries are found."""
@@ -1573,8 +2880,9 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
         response_headers=self.headers)
     self.run_fetch_task()
 
-    # Verify that all feed entry records have been written along with the
-    # EventToDeliver and FeedRecord.
+    # Verify that all feed entry records are saved by the task enqueued along
+    # with the EventToDeliver and FeedRecord.
+    self.save_entry_records()
     feed_entries = FeedEntryRecord.get_entries_for_topic(
         self.topic, self.all_ids)
     self.assertEquals(
@@ -1584,11 +2892,11 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     work = EventToDeliver.all().get()
     event_key = work.key()
     self.assertEquals(self.topic, work.topic)
-    self.assertTrue('content1\ncontent2\ncontent3' in work.payload)
+    self.assertTrue('content1\ncontent2\ncontent3' in work.get_payload())
     work.delete()
 
     record = FeedRecord.get_or_create(self.topic)
-    self.assertEquals(self.header_footer, record.header_footer)
+    self.assertEquals(self.header_footer, record.get_header_footer())
     self.assertEquals(self.etag, record.etag)
     self.assertEquals(self.last_modified, record.last_modified)
     self.assertEquals('application/atom+xml', record.content_type)
@@ -1599,16 +2907,21 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     self.assertEquals([(1, 0)], main.FETCH_SCORER.get_scores([self.topic]))
 
   def testRssFailBack(self):
-    """Tests when parsing as Atom fails and it uses RSS instead."""
+    """Tests when parsing as cached Atom fails and the sniffed RSS is used."""
     self.expected_exceptions.append(feed_diff.Error('whoops'))
+    self.expected_response = '<rss><channel>the expected data</channel></rss>'
     self.header_footer = '<rss><channel>this is my test</channel></rss>'
     self.headers['Content-Type'] = 'application/xml'
+    info = FeedRecord.get_or_create(self.topic)
+    info.update(self.headers, format=main.ATOM)
+    info.put()
 
     FeedToFetch.insert([self.topic])
     urlfetch_test_stub.instance.expect(
         'get', self.topic, 200, self.expected_response,
         response_headers=self.headers)
     self.run_fetch_task()
+    self.save_entry_records()
 
     feed_entries = FeedEntryRecord.get_entries_for_topic(
         self.topic, self.all_ids)
@@ -1619,11 +2932,13 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     work = EventToDeliver.all().get()
     event_key = work.key()
     self.assertEquals(self.topic, work.topic)
-    self.assertTrue('content1\ncontent2\ncontent3' in work.payload)
+    self.assertTrue('content1\ncontent2\ncontent3' in work.get_payload())
     work.delete()
 
     record = FeedRecord.get_or_create(self.topic)
     self.assertEquals('application/xml', record.content_type)
+    self.assertEquals(main.RSS, record.format)
+    self.assertEquals([main.ATOM, main.RSS], self.parsed_formats)
 
     task = testutil.get_tasks(main.EVENT_QUEUE, index=0, expected_count=1)
     self.assertEquals(str(event_key), task['params']['event_key'])
@@ -1631,12 +2946,12 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     self.assertEquals([(1, 0)], main.FETCH_SCORER.get_scores([self.topic]))
 
   def testAtomFailBack(self):
-    """Tests when parsing as RSS fails and it uses Atom instead."""
+    """Tests when parsing as cached RSS fails and the sniffed Atom is used."""
     self.expected_exceptions.append(feed_diff.Error('whoops'))
     self.headers.clear()
     self.headers['Content-Type'] = 'application/rss+xml'
     info = FeedRecord.get_or_create(self.topic)
-    info.update(self.headers)
+    info.update(self.headers, format=main.RSS)
     info.put()
 
     FeedToFetch.insert([self.topic])
@@ -1644,6 +2959,7 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
         'get', self.topic, 200, self.expected_response,
         response_headers=self.headers)
     self.run_fetch_task()
+    self.save_entry_records()
 
     feed_entries = FeedEntryRecord.get_entries_for_topic(
         self.topic, self.all_ids)
@@ -1654,11 +2970,13 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     work = EventToDeliver.all().get()
     event_key = work.key()
     self.assertEquals(self.topic, work.topic)
-    self.assertTrue('content1\ncontent2\ncontent3' in work.payload)
+    self.assertTrue('content1\ncontent2\ncontent3' in work.get_payload())
     work.delete()
 
     record = FeedRecord.get_or_create(self.topic)
     self.assertEquals('application/rss+xml', record.content_type)
+    self.assertEquals(main.ATOM, record.format)
+    self.assertEquals([main.RSS, main.ATOM], self.parsed_formats)
 
     task = testutil.get_tasks(main.EVENT_QUEUE, index=0, expected_count=1)
     self.assertEquals(str(event_key), task['params']['event_key'])
@@ -1666,12 +2984,11 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     self.assertEquals([(1, 0)], main.FETCH_SCORER.get_scores([self.topic]))
 
   def testArbitraryContent(self):
-    """Tests when the feed cannot be parsed as Atom or RSS."""
+    """Tests when the feed is sniffed as not being Atom or RSS."""
     self.entry_list = []
     self.entry_payloads = []
+    self.expected_response = 'this is all of the content'
     self.header_footer = 'this is all of the content'
-    self.expected_exceptions.append(feed_diff.Error('whoops'))
-    self.expected_exceptions.append(feed_diff.Error('whoops'))
     FeedToFetch.insert([self.topic])
     self.headers['content-type'] = 'My Crazy Content Type'
     urlfetch_test_stub.instance.expect(
@@ -1686,15 +3003,16 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     work = EventToDeliver.all().get()
     event_key = work.key()
     self.assertEquals(self.topic, work.topic)
-    self.assertEquals('this is all of the content', work.payload)
+    self.assertEquals('this is all of the content', work.get_payload())
     work.delete()
 
     record = FeedRecord.get_or_create(self.topic)
     # header_footer not saved for arbitrary data
-    self.assertEquals(None, record.header_footer)
+    self.assertEquals(None, record.get_header_footer())
     self.assertEquals(self.etag, record.etag)
     self.assertEquals(self.last_modified, record.last_modified)
     self.assertEquals('my crazy content type', record.content_type)
+    self.assertEquals([main.ARBITRARY], self.parsed_formats)
 
     task = testutil.get_tasks(main.EVENT_QUEUE, index=0, expected_count=1)
     self.assertEquals(str(event_key), task['params']['event_key'])
@@ -1705,6 +3023,48 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
 
     self.assertEquals([(1, 0)], main.FETCH_SCORER.get_scores([self.topic]))
 
+  def testArbitraryContent_FailBack(self):
+    """Tests when a sniffed feed cannot be parsed as that format."""
+    self.entry_list = []
+    self.entry_payloads = []
+    self.expected_exceptions.append(feed_diff.Error('whoops'))
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.run_fetch_task()
+    self.assertEquals([main.ATOM, main.ARBITRARY], self.parsed_formats)
+    self.assertTrue(EventToDeliver.all().get() is not None)
+    self.assertEquals(main.ARBITRARY,
+                      FeedRecord.get_or_create(self.topic).format)
+
+  def testCachedArbitraryResniffed(self):
+    """Tests that a cached arbitrary format is not trusted."""
+    info = FeedRecord.get_or_create(self.topic)
+    info.update(self.headers, format=main.ARBITRARY)
+    info.put()
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.run_fetch_task()
+    self.assertEquals([main.ATOM], self.parsed_formats)
+    self.assertEquals(main.ATOM, FeedRecord.get_or_create(self.topic).format)
+
+  def testSniffingFails(self):
+    """Tests trying every format in turn when sniffing is inconclusive."""
+    self.expected_response = '<!-- this comment never ends'
+    self.expected_exceptions.append(feed_diff.Error('whoops'))
+    self.expected_exceptions.append(feed_diff.Error('whoops'))
+    self.headers['Content-Type'] = 'application/rss+xml'
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.run_fetch_task()
+    self.assertEquals([main.RSS, main.ATOM, main.ARBITRARY],
+                      self.parsed_formats)
+
   def testCacheHit(self):
     """Tests when the fetched feed matches the last cached version of it."""
     info = FeedRecord.get_or_create(self.topic)
@@ -1733,9 +3093,9 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     info.update(self.headers)
     info.put()
 
-    KnownFeedStats(
-      key=KnownFeedStats.create_key(self.topic),
-      subscriber_count=123).put()
+    main.SubscriberCountShard(
+      key=main.SubscriberCountShard.create_key(sha1_hash(self.topic), 0),
+      count=123).put()
 
     request_headers = {
       'User-Agent':
@@ -1753,7 +3113,7 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     testutil.get_tasks(main.EVENT_QUEUE, expected_count=0)
 
     record = FeedRecord.get_or_create(self.topic)
-    self.assertEquals(self.header_footer, record.header_footer)
+    self.assertEquals(self.header_footer, record.get_header_footer())
     self.assertEquals(self.etag, record.etag)
     self.assertEquals(self.last_modified, record.last_modified)
     self.assertEquals('application/atom+xml', record.content_type)
@@ -1772,7 +3132,7 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     testutil.get_tasks(main.EVENT_QUEUE, expected_count=0)
 
     record = FeedRecord.get_or_create(self.topic)
-    self.assertEquals(self.header_footer, record.header_footer)
+    self.assertEquals(self.header_footer, record.get_header_footer())
     self.assertEquals(self.etag, record.etag)
     self.assertEquals(self.last_modified, record.last_modified)
     self.assertEquals('application/atom+xml', record.content_type)
@@ -1873,6 +3233,108 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     # And no scoring.
     self.assertEquals([(0, 0)], main.FETCH_SCORER.get_scores([self.topic]))
 
+  def testNoSubscribers_Batch(self):
+    """Tests a batch where only some feeds have subscribers."""
+    other_topic = 'http://example.com/other-topic'
+    memcache.flush_all()
+    FeedToFetch.insert([self.topic, other_topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.run_fetch_task()
+
+    self.assertEquals([], list(FeedToFetch.all()))
+    self.assertEquals(1, len(list(EventToDeliver.all())))
+    self.assertEquals([(1, 0), (1, 0)],
+                      main.FETCH_SCORER.get_scores([self.topic, other_topic]))
+
+  def testNeedsExpansion(self):
+    """Tests expanding topics that were published without filtering."""
+    main.TOPIC_ALIAS_CACHE.clear()
+    alias = 'http://example.com/my-topic-alias'
+    unknown = 'http://example.com/unknown-topic'
+    feed_id = 'my feed id'
+    for topic in (self.topic, alias):
+      known_feed = KnownFeed.create(topic)
+      known_feed.feed_id = feed_id
+      known_feed.put()
+      KnownFeedIdentity.update(feed_id, topic)
+    self.assertTrue(
+        Subscription.insert(self.callback, alias, 'token', 'secret'))
+
+    self.entry_list = []
+    FeedToFetch.insert([self.topic, unknown], {'one': 'two'},
+                       needs_expansion=True)
+    for topic in (self.topic, alias):
+      urlfetch_test_stub.instance.expect(
+          'get', topic, 200, self.expected_response,
+          response_headers=self.headers)
+    self.run_fetch_task()
+
+    self.assertEquals([], list(FeedToFetch.all()))
+    self.assertEquals([main.ATOM, main.ATOM], self.parsed_formats)
+    self.assertEquals(
+        [(2, 0)] * 3,
+        main.FETCH_SCORER.get_scores([self.topic, alias, unknown]))
+
+  def testNeedsExpansion_UnknownTopic(self):
+    """Tests that unknown topics popped from memory are just dropped."""
+    main.TOPIC_ALIAS_CACHE.clear()
+    unknown = 'http://example.com/unknown-topic'
+    done_topics = []
+    old_done = FeedToFetch.done
+    def my_done(work):
+      done_topics.append(work.topic)
+      return old_done(work)
+    FeedToFetch.done = my_done
+    try:
+      FeedToFetch.insert([unknown], needs_expansion=True)
+      self.run_fetch_task()
+      self.assertEquals([], done_topics)
+
+      # Stored records are still finished.
+      FeedToFetch(key_name=get_hash_key_name(unknown), topic=unknown,
+                  needs_expansion=True).put()
+      self.handle('post', ('topic', unknown))
+      self.assertEquals([unknown], done_topics)
+    finally:
+      FeedToFetch.done = old_done
+    self.assertEquals([], list(FeedToFetch.all()))
+
+  def testNeedsExpansion_Retry(self):
+    """Tests that expanded topics are not expanded again on retries."""
+    main.TOPIC_ALIAS_CACHE.clear()
+    KnownFeed.create(self.topic).put()
+    FeedToFetch.insert([self.topic], needs_expansion=True)
+    urlfetch_test_stub.instance.expect('get', self.topic, 500, '')
+    self.run_fetch_task()
+    feed = FeedToFetch.get_by_topic(self.topic)
+    self.assertEquals(1, feed.fetching_failures)
+    self.assertFalse(feed.needs_expansion)
+
+  def testPrefetchFailure(self):
+    """Tests when the feed state can't be prefetched asynchronously."""
+    info = FeedRecord.get_or_create(self.topic)
+    info.update(self.headers)
+    info.put()
+
+    def fail_get(keys, async_proxy, callback):
+      callback(None, db.Timeout('Timed out'))
+    old_get = main.datastore_async.get
+    main.datastore_async.get = fail_get
+    try:
+      FeedToFetch.insert([self.topic])
+      urlfetch_test_stub.instance.expect(
+          'get', self.topic, 304, '',
+          request_headers={'If-None-Match': self.etag},
+          response_headers=self.headers)
+      self.run_fetch_task()
+    finally:
+      main.datastore_async.get = old_get
+
+    self.assertEquals([], list(FeedToFetch.all()))
+    self.assertEquals([(1, 0)], main.FETCH_SCORER.get_scores([self.topic]))
+
   def testRedirects(self):
     """Tests when redirects are encountered."""
     info = FeedRecord.get_or_create(self.topic)
@@ -1954,7 +3416,7 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     ]
     self.entry_list = [
         FeedEntryRecord.create_entry_for_topic(
-            self.topic, entry_id, 'content%s' % entry_id)
+            self.topic, entry_id, sha1_hash('content%s' % entry_id))
         for entry_id in self.all_ids
     ]
 
@@ -1970,8 +3432,9 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     finally:
       main.MAX_NEW_FEED_ENTRY_RECORDS = old_max_new
 
-    # Verify that all feed entry records have been written along with the
-    # EventToDeliver and FeedRecord.
+    # Verify that all feed entry records are saved by the task enqueued along
+    # with the EventToDeliver and FeedRecord.
+    self.save_entry_records()
     feed_entries = list(FeedEntryRecord.all())
     self.assertEquals(
         set(sha1_hash(k) for k in self.all_ids),
@@ -1980,11 +3443,11 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     work = EventToDeliver.all().get()
     event_key = work.key()
     self.assertEquals(self.topic, work.topic)
-    self.assertTrue('\n'.join(self.entry_payloads) in work.payload)
+    self.assertTrue('\n'.join(self.entry_payloads) in work.get_payload())
     work.delete()
 
     record = FeedRecord.get_or_create(self.topic)
-    self.assertEquals(self.header_footer, record.header_footer)
+    self.assertEquals(self.header_footer, record.get_header_footer())
     self.assertEquals(self.etag, record.etag)
     self.assertEquals(self.last_modified, record.last_modified)
     self.assertEquals('application/atom+xml', record.content_type)
@@ -2005,7 +3468,7 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     ]
     self.entry_list = [
         FeedEntryRecord.create_entry_for_topic(
-            self.topic, entry_id, 'content%s' % entry_id)
+            self.topic, entry_id, sha1_hash('content%s' % entry_id))
         for entry_id in self.all_ids
     ]
 
@@ -2016,15 +3479,18 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
 
     old_splitting_attempts = main.PUT_SPLITTING_ATTEMPTS
     old_max_saves = main.MAX_FEED_RECORD_SAVES
+    old_max_save_bytes = main.MAX_FEED_RECORD_SAVE_BYTES
     old_max_new = main.MAX_NEW_FEED_ENTRY_RECORDS
     main.PUT_SPLITTING_ATTEMPTS = 1
     main.MAX_FEED_RECORD_SAVES = len(self.entry_list) + 1
+    main.MAX_FEED_RECORD_SAVE_BYTES = 100 * 1024 * 1024
     main.MAX_NEW_FEED_ENTRY_RECORDS = main.MAX_FEED_RECORD_SAVES
     try:
       self.run_fetch_task()
     finally:
       main.PUT_SPLITTING_ATTEMPTS = old_splitting_attempts
       main.MAX_FEED_RECORD_SAVES = old_max_saves
+      main.MAX_FEED_RECORD_SAVE_BYTES = old_max_save_bytes
       main.MAX_NEW_FEED_ENTRY_RECORDS = old_max_new
 
     # Verify that *NO* FeedEntryRecords or EventToDeliver has been written,
@@ -2062,7 +3528,7 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     ]
     self.entry_list = [
         FeedEntryRecord.create_entry_for_topic(
-            self.topic, entry_id, 'content%s' % entry_id)
+            self.topic, entry_id, sha1_hash('content%s' % entry_id))
         for entry_id in self.all_ids
     ]
 
@@ -2073,6 +3539,8 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
 
     self.run_fetch_task()
 
+    self.save_entry_records()
+
     # Verify that a subset of the entry records are present and the payload
     # only has the first N entries.
     feed_entries = FeedEntryRecord.get_entries_for_topic(
@@ -2086,20 +3554,295 @@ class PullFeedHandlerTest(testutil.HandlerTestBase):
     event_key = work.key()
     self.assertEquals(self.topic, work.topic)
     expected_content = '\n'.join(self.entry_payloads[:expected_records])
-    self.assertTrue(expected_content in work.payload)
-    self.assertFalse('content%d' % expected_records in work.payload)
+    self.assertTrue(expected_content in work.get_payload())
+    self.assertFalse('content%d' % expected_records in work.get_payload())
     work.delete()
 
     record = FeedRecord.all().get()
     self.assertNotEquals(self.etag, record.etag)
+    self.assertTrue(record.over_budget)
 
+    # The rest of the entries are parsed from the saved document instead of
+    # fetching it again.
     task = testutil.get_tasks(main.EVENT_QUEUE, index=0, expected_count=1)
     self.assertEquals(str(event_key), task['params']['event_key'])
-    testutil.get_tasks(main.FEED_QUEUE, expected_count=1)
+    tasks = self.get_continuation_tasks()
+    self.assertEquals(1, len(tasks))
+    self.assertEquals(self.topic, tasks[0]['params']['topic'])
+    testutil.get_tasks(main.FEED_RETRIES_QUEUE, expected_count=0)
+    self.assertEquals([(1, 0)], main.FETCH_SCORER.get_scores([self.topic]))
+
+    # Continuing finds the entries that are not in the digest yet.
+    self.entry_list = self.entry_list[expected_records:]
+    self.entry_payloads = self.entry_payloads[expected_records:]
+    self.run_continuation()
+    work = EventToDeliver.all().get()
+    self.assertTrue(('content%d' % expected_records) in work.get_payload())
+    self.assertFalse('content0\n' in work.get_payload())
+    self.assertEquals(2 * expected_records,
+                      len(FeedRecord.all().get().get_seen_entries()))
+    self.assertEquals(2, len(self.get_continuation_tasks()))
+
+  def testOverParseBudget(self):
+    """Tests when a feed's new entries are over the parse budget."""
+    self.over_budget = True
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.run_fetch_task()
+
+    # The entries that fit are delivered and the parse is continued.
+    work = EventToDeliver.all().get()
+    self.assertTrue('\n'.join(self.entry_payloads) in work.get_payload())
+    record = FeedRecord.get_or_create(self.topic)
+    self.assertTrue(record.over_budget)
+    self.assertEquals(3, len(record.get_seen_entries()))
+    self.assertEquals(1, len(self.get_continuation_tasks()))
+    testutil.get_tasks(main.FEED_RETRIES_QUEUE, expected_count=0)
+    self.assertEquals([True], self.stop_early_calls)
+    continuation = main.FeedContinuation.get(
+        main.FeedContinuation.create_key(self.topic))
+    self.assertEquals(self.expected_response, continuation.get_content())
+    self.assertEquals(self.headers, continuation.get_headers())
+
+    # The continuation diffs the whole document, without fetching it.
+    self.over_budget = False
+    self.run_continuation()
+    self.assertEquals([True, False], self.stop_early_calls)
+    record = FeedRecord.get_or_create(self.topic)
+    self.assertFalse(record.over_budget)
+    self.assertEquals(self.etag, record.etag)
+    self.assertEquals(None, main.FeedContinuation.all().get())
+    self.assertEquals(1, len(self.get_continuation_tasks()))
+
+    # Continuing again does nothing.
+    self.run_continuation()
+    self.assertEquals([True, False], self.stop_early_calls)
+
+  def testFullDiffInterval(self):
+    """Tests that documents are diffed in full every few days."""
+    record = FeedRecord.get_or_create(self.topic)
+    seen_entries = main.SeenEntries()
+    seen_entries.add(sha1_hash('old entry'), sha1_hash('old content'))
+    record.seen_entries = seen_entries.pack()
+    now = datetime.datetime.utcnow()
+    record.last_full_diff = now - datetime.timedelta(
+        days=main.FULL_DIFF_INTERVAL_DAYS, seconds=1)
+    record.put()
+    self.assertFalse(record.can_stop_early(record.get_seen_entries()))
+
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    self.run_fetch_task()
+    self.assertEquals([False], self.stop_early_calls)
+
+    record = FeedRecord.get_or_create(self.topic)
+    self.assertTrue(record.last_full_diff >= now)
+    self.assertTrue(record.can_stop_early(record.get_seen_entries()))
+    later = now + datetime.timedelta(days=main.FULL_DIFF_INTERVAL_DAYS + 1)
+    self.assertFalse(record.can_stop_early(record.get_seen_entries(),
+                                           now=lambda: later))
+
+  def testParseMergesConcurrentDigest(self):
+    """Tests that a digest saved by a concurrent parse is not overwritten."""
+    feed_record = FeedRecord.get_or_create(self.topic)
+    seen_entries = main.SeenEntries()
+    feed_record.seen_entries = db.Blob(seen_entries.pack())
+    feed_record.put()
+
+    # Another parse saves its digest after this one read the FeedRecord.
+    other = FeedRecord.get_or_create(self.topic)
+    other_seen = main.SeenEntries(other.seen_entries)
+    other_seen.add(sha1_hash('other'), sha1_hash('other content'))
+    other.seen_entries = db.Blob(other_seen.pack())
+    other.put()
+
+    self.assertTrue(main.parse_feed(
+        feed_record, self.headers, self.expected_response,
+        seen_entries=seen_entries))
+    seen_entries = FeedRecord.get_or_create(self.topic).get_seen_entries()
+    self.assertEquals(4, len(seen_entries))
+    self.assertTrue(sha1_hash('other') in seen_entries)
+    for entry in self.entry_list:
+      self.assertTrue(entry.id_hash in seen_entries)
+
+  def testOverParseBudget_tooLargeToContinue(self):
+    """Tests that documents too large to keep are fetched again."""
+    self.over_budget = True
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    old_max_bytes = main.MAX_FEED_CONTINUATION_BYTES
+    main.MAX_FEED_CONTINUATION_BYTES = 10
+    try:
+      self.run_fetch_task()
+    finally:
+      main.MAX_FEED_CONTINUATION_BYTES = old_max_bytes
+
+    self.assertTrue(FeedRecord.get_or_create(self.topic).over_budget)
+    self.assertEquals(None, main.FeedContinuation.all().get())
+    self.assertEquals([], self.get_continuation_tasks())
     task = testutil.get_tasks(main.FEED_RETRIES_QUEUE,
                               index=0, expected_count=1)
     self.assertEquals(self.topic, task['params']['topic'])
-    self.assertEquals([(0, 1)], main.FETCH_SCORER.get_scores([self.topic]))
+
+  def testContinuationNoLongerNeeded(self):
+    """Tests continuing a document after a later pull parsed a whole one."""
+    FeedRecord.get_or_create(self.topic).put()
+    main.FeedContinuation.create(
+        self.topic, self.headers, self.expected_response).put()
+    self.run_continuation()
+    self.assertEquals(None, main.FeedContinuation.all().get())
+    self.assertEquals([], self.parsed_formats)
+
+  def testContinuationAlternateTopics(self):
+    """Tests continuing a document for the alternate topics it was parsed for,
+    with the FeedRecord read through its cache."""
+    alternate_topics = [u'http://example.com/other-topic']
+    record = FeedRecord.get_or_create(self.topic)
+    record.over_budget = True
+    main.FEED_RECORD_CACHE.put([record])
+    record.delete()
+    continuation = main.FeedContinuation.create(
+        self.topic, self.headers, self.expected_response, alternate_topics)
+    continuation.put()
+
+    parse_calls = []
+    def my_parse_feed(feed_record, headers, content, alternate_topics=None):
+      parse_calls.append((feed_record.over_budget, alternate_topics))
+      return True
+    old_parse_feed = main.parse_feed
+    main.parse_feed = my_parse_feed
+    try:
+      self.run_continuation()
+    finally:
+      main.parse_feed = old_parse_feed
+    self.assertEquals([(True, alternate_topics)], parse_calls)
+
+  def testOverBatchBudget(self):
+    """Tests that fetched feeds past the batch budget are kept for a task."""
+    topic2 = self.topic + '2'
+    FeedToFetch.insert([self.topic, topic2])
+    for topic in (self.topic, topic2):
+      self.assertTrue(Subscription.insert(
+          self.callback, topic, 'token', 'secret'))
+      urlfetch_test_stub.instance.expect(
+          'get', topic, 200, self.expected_response,
+          response_headers=self.headers)
+
+    old_batch_bytes = main.MAX_FETCH_BATCH_BYTES
+    main.MAX_FETCH_BATCH_BYTES = len(self.expected_response)
+    try:
+      self.run_fetch_task()
+    finally:
+      main.MAX_FETCH_BATCH_BYTES = old_batch_bytes
+
+    # Only one of the feeds was parsed; the other's document is kept for a
+    # task instead of being fetched again, and it was not marked as failing.
+    self.assertEquals(1, len(self.parsed_formats))
+    self.assertEquals(1, len(list(EventToDeliver.all())))
+    testutil.get_tasks(main.FEED_RETRIES_QUEUE, expected_count=0)
+    self.assertEquals(None, FeedToFetch.get_by_topic(self.topic))
+    self.assertEquals(None, FeedToFetch.get_by_topic(topic2))
+    continuation = main.FeedContinuation.all().get()
+    self.assertTrue(continuation.deferred)
+    self.assertEquals(self.expected_response, continuation.get_content())
+    task = self.get_continuation_tasks()[0]
+    self.assertEquals(continuation.topic, task['params']['topic'])
+    self.assertEquals([(2, 0), (2, 0)],  # 2 because of shared domain
+                      main.FETCH_SCORER.get_scores([self.topic, topic2]))
+
+    # The task parses the document even though no parse was cut short.
+    self.topic = continuation.topic
+    self.run_continuation()
+    self.assertEquals(2, len(self.parsed_formats))
+    self.assertEquals(2, len(list(EventToDeliver.all())))
+    self.assertEquals(None, main.FeedContinuation.all().get())
+
+  def testOverBatchBudget_BeforeFetch(self):
+    """Tests that feeds with no room in the batch budget aren't fetched."""
+    topic2 = self.topic + '2'
+    FeedToFetch.insert([self.topic, topic2])
+    for topic in (self.topic, topic2):
+      self.assertTrue(Subscription.insert(
+          self.callback, topic, 'token', 'secret'))
+      urlfetch_test_stub.instance.expect(
+          'get', topic, 200, self.expected_response,
+          response_headers=self.headers)
+      record = FeedRecord.get_or_create(topic)
+      record.update(self.headers, content='the last document')
+      self.assertEquals(len('the last document'), record.content_bytes)
+      record.put()
+
+    old_batch_bytes = main.MAX_FETCH_BATCH_BYTES
+    main.MAX_FETCH_BATCH_BYTES = len('the last document')
+    try:
+      self.run_fetch_task()
+    finally:
+      main.MAX_FETCH_BATCH_BYTES = old_batch_bytes
+
+    # Only one of the feeds was fetched; the other has a task of its own and
+    # was not marked as failing.
+    self.assertEquals(1, len(self.parsed_formats))
+    task = testutil.get_tasks(main.FEED_RETRIES_QUEUE,
+                              index=0, expected_count=1)
+    deferred = FeedToFetch.get_by_topic(task['params']['topic'])
+    self.assertEquals(0, deferred.fetching_failures)
+    self.assertFalse(deferred.totally_failed)
+    self.assertEquals(None, main.FeedContinuation.all().get())
+    urlfetch_test_stub.instance.clear()
+
+  def run_oversized_fetch(self):
+    """Fetches a document over MAX_FEED_DOCUMENT_BYTES and returns the
+    over_budget value it was reported with."""
+    FeedToFetch.insert([self.topic])
+    urlfetch_test_stub.instance.expect(
+        'get', self.topic, 200, self.expected_response,
+        response_headers=self.headers)
+    reports = []
+    old_report_fetch = main.report_fetch
+    def fake_report_fetch(reporter, url, success, latency, unchanged=False,
+                          over_budget=False):
+      reports.append(over_budget)
+      old_report_fetch(reporter, url, success, latency, unchanged=unchanged,
+                       over_budget=over_budget)
+    old_document_bytes = main.MAX_FEED_DOCUMENT_BYTES
+    old_continuation_bytes = main.MAX_FEED_CONTINUATION_BYTES
+    main.report_fetch = fake_report_fetch
+    main.MAX_FEED_DOCUMENT_BYTES = len(self.expected_response) - 1
+    main.MAX_FEED_CONTINUATION_BYTES = len(self.expected_response) - 1
+    try:
+      self.run_fetch_task()
+    finally:
+      main.report_fetch = old_report_fetch
+      main.MAX_FEED_DOCUMENT_BYTES = old_document_bytes
+      main.MAX_FEED_CONTINUATION_BYTES = old_continuation_bytes
+    self.assertEquals(1, len(reports))
+    return reports[0]
+
+  def testDocumentTooLarge(self):
+    """Tests that documents larger than the limit are still parsed."""
+    self.assertTrue(self.run_oversized_fetch())
+    self.assertEquals([main.ATOM], self.parsed_formats)
+    self.assertEquals(1, len(list(EventToDeliver.all())))
+    self.assertEquals(None, FeedToFetch.get_by_topic(self.topic))
+    testutil.get_tasks(main.FEED_RETRIES_QUEUE, expected_count=0)
+
+  def testDocumentTooLarge_OverParseBudget(self):
+    """Tests that the rest of a large document's entries are found by
+    retrying the fetch, since the document is too large to keep."""
+    self.over_budget = True
+    self.assertTrue(self.run_oversized_fetch())
+    self.assertEquals([main.ATOM], self.parsed_formats)
+    self.assertEquals(1, len(list(EventToDeliver.all())))
+    self.assertEquals(None, main.FeedContinuation.all().get())
+    self.assertEquals(1, FeedToFetch.get_by_topic(
+        self.topic).fetching_failures)
+    testutil.get_tasks(main.FEED_RETRIES_QUEUE, expected_count=1)
 
   def testNotAllowed(self):
     """Tests when the URL fetch is blocked due to URL scoring."""
@@ -2197,10 +3940,162 @@ class PullFeedHandlerTestWithParsing(testutil.HandlerTestBase):
     feed = FeedToFetch.get_by_key_name(get_hash_key_name(topic))
     self.assertTrue(feed is None)
     event = EventToDeliver.all().get()
-    self.assertEquals(data.replace('\n', ''), event.payload.replace('\n', ''))
+    self.assertEquals(data.replace('\n', ''),
+                      event.get_payload().replace('\n', ''))
     self.assertEquals('application/atom+xml', event.content_type)
     self.assertEquals('atom', FeedRecord.all().get().format)
 
+  def testPullMigratesFeedEntryRecords(self):
+    """Tests building the digest of a topic from its FeedEntryRecords."""
+    topic = 'http://example.com/my-topic'
+    callback = 'http://example.com/my-subscriber'
+    self.assertTrue(Subscription.insert(callback, topic, 'token', 'secret'))
+    template = ('<?xml version="1.0" encoding="utf-8"?>\n<feed>%s</feed>')
+    entry = '<entry><id>%s</id>wooh</entry>'
+    old_save = main.SAVE_FEED_ENTRY_RECORDS
+    main.SAVE_FEED_ENTRY_RECORDS = True
+    try:
+      FeedToFetch.insert([topic])
+      urlfetch_test_stub.instance.expect(
+          'get', topic, 200, template % (entry % '1'))
+      self.run_fetch_task()
+    finally:
+      main.SAVE_FEED_ENTRY_RECORDS = old_save
+    db.delete(list(EventToDeliver.all()))
+    self.handler_class = main.SaveFeedEntryRecordsHandler
+    try:
+      task = testutil.get_tasks(main.ENTRY_RECORDS_QUEUE,
+                                index=0, expected_count=1)
+      self.handle('post', *task['params'].items())
+    finally:
+      self.handler_class = main.PullFeedHandler
+
+    # Make the topic look like it was last pulled before digests existed,
+    # when records were children of the FeedRecord.
+    saved = FeedEntryRecord.all().get()
+    db.put(FeedEntryRecord(
+        key=FeedEntryRecord.create_legacy_key(topic, '1'),
+        entry_content_hash=saved.entry_content_hash))
+    db.delete(saved)
+    record = FeedRecord.all().get()
+    record.seen_entries = None
+    record.put()
+    main.FEED_RECORD_CACHE.invalidate([record.key()])
+
+    FeedToFetch.insert([topic])
+    urlfetch_test_stub.instance.expect(
+        'get', topic, 200, template % ((entry % '2') + (entry % '1')))
+    self.run_fetch_task()
+    payload = EventToDeliver.all().get().get_payload()
+    self.assertTrue('<id>2</id>' in payload)
+    self.assertFalse('<id>1</id>' in payload)
+    self.assertEquals(2, len(FeedRecord.all().get().get_seen_entries()))
+
+  def testPullRecordsFeedId(self):
+    """Tests that the feed ID is recorded from the pulled document."""
+    topic = 'http://example.com/my-topic'
+    callback = 'http://example.com/my-subscriber'
+    self.assertTrue(Subscription.insert(callback, topic, 'token', 'secret'))
+    for feed_id, entry_id in (('my-id', '1'), ('my-id', '2'),
+                              ('my-new-id', '3')):
+      data = ('<?xml version="1.0" encoding="utf-8"?>\n<feed><id>%s</id>'
+              '<entry><id>%s</id>wooh</entry></feed>' % (feed_id, entry_id))
+      FeedToFetch.insert([topic])
+      urlfetch_test_stub.instance.expect('get', topic, 200, data)
+      self.run_fetch_task()
+
+      self.assertEquals(feed_id, FeedRecord.all().get().feed_id)
+      self.assertEquals(feed_id, KnownFeed.get(
+          KnownFeed.create_key(topic)).feed_id)
+      identity = KnownFeedIdentity.get(KnownFeedIdentity.create_key(feed_id))
+      self.assertEquals([topic], identity.topics)
+
+    # The old mapping was removed when the ID changed.
+    self.assertEquals(None, KnownFeedIdentity.get(
+        KnownFeedIdentity.create_key('my-id')))
+
+  def testPullBackfillsFeedId(self):
+    """Tests that a known feed ID is copied to the FeedRecord as-is."""
+    topic = 'http://example.com/my-topic'
+    callback = 'http://example.com/my-subscriber'
+    self.assertTrue(Subscription.insert(callback, topic, 'token', 'secret'))
+    known_feed = KnownFeed.create(topic)
+    known_feed.feed_id = 'my-id'
+    known_feed.put()
+    KnownFeedIdentity.update('my-id', topic)
+
+    calls = []
+    old_update = KnownFeed.update_feed_id
+    def fake_update(known_feed, feed_id):
+      calls.append(feed_id)
+      return old_update(known_feed, feed_id)
+    KnownFeed.update_feed_id = fake_update
+    try:
+      FeedToFetch.insert([topic])
+      urlfetch_test_stub.instance.expect('get', topic, 200,
+          '<?xml version="1.0" encoding="utf-8"?>\n<feed><id>my-id</id>'
+          '<entry><id>1</id>wooh</entry></feed>')
+      self.run_fetch_task()
+    finally:
+      KnownFeed.update_feed_id = old_update
+    self.assertEquals([], calls)
+    self.assertEquals('my-id', FeedRecord.all().get().feed_id)
+
+  def testPullFailedSkipsFeedId(self):
+    """Tests that no feed ID is recorded when the parse does not commit."""
+    topic = 'http://example.com/my-topic'
+    callback = 'http://example.com/my-subscriber'
+    self.assertTrue(Subscription.insert(callback, topic, 'token', 'secret'))
+
+    old_enqueue = EventToDeliver.enqueue
+    def fail_enqueue(event):
+      raise db.TransactionFailedError('Contention')
+    EventToDeliver.enqueue = fail_enqueue
+    try:
+      FeedToFetch.insert([topic])
+      urlfetch_test_stub.instance.expect('get', topic, 200,
+          '<?xml version="1.0" encoding="utf-8"?>\n<feed><id>my-id</id>'
+          '<entry><id>1</id>wooh</entry></feed>')
+      self.run_fetch_task()
+    finally:
+      EventToDeliver.enqueue = old_enqueue
+    self.assertEquals(None, EventToDeliver.all().get())
+    feed_record = FeedRecord.all().get()
+    self.assertTrue(feed_record is None or feed_record.feed_id is None)
+    self.assertEquals(None, KnownFeedIdentity.get(
+        KnownFeedIdentity.create_key('my-id')))
+
+  def testParsePool(self):
+    """Tests that diffing in the parse pool matches diffing inline."""
+    data = ('<?xml version="1.0" encoding="utf-8"?>\n<feed><id>my-id</id>'
+            '<entry><id>1</id>wooh</entry><entry><id>2</id>yay</entry>'
+            '</feed>')
+    callback = 'http://example.com/my-subscriber'
+    inline_topic = 'http://example.com/inline-topic'
+    pool_topic = 'http://example.com/pool-topic'
+    results = []
+    old_pool_size = main.PARSE_POOL_SIZE
+    try:
+      for pool_size, topic in ((0, inline_topic), (2, pool_topic)):
+        main.PARSE_POOL_SIZE = pool_size
+        self.assertTrue(Subscription.insert(callback, topic, 'token', 'secret'))
+        FeedToFetch.insert([topic])
+        urlfetch_test_stub.instance.expect('get', topic, 200, data)
+        self.run_fetch_task()
+
+        record = FeedRecord.get_or_create(topic)
+        event = EventToDeliver.all().filter('topic =', topic).get()
+        results.append((record.format, record.get_header_footer(),
+                        record.seen_entries, record.feed_id,
+                        event.get_payload()))
+    finally:
+      main.PARSE_POOL_SIZE = old_pool_size
+      main.PARSE_POOL.close()
+
+    self.assertEquals(results[0], results[1])
+    self.assertEquals('my-id', results[1][3])
+    self.assertEquals([], list(FeedToFetch.all()))
+
   def testPullWithUnicodeEtag(self):
     """Tests when the ETag header has a unicode value.
 
@@ -2221,7 +4116,8 @@ class PullFeedHandlerTestWithParsing(testutil.HandlerTestBase):
     feed = FeedToFetch.get_by_key_name(get_hash_key_name(topic))
     self.assertTrue(feed is None)
     event = EventToDeliver.all().get()
-    self.assertEquals(data.replace('\n', ''), event.payload.replace('\n', ''))
+    self.assertEquals(data.replace('\n', ''),
+                      event.get_payload().replace('\n', ''))
     self.assertEquals('application/atom+xml', event.content_type)
     self.assertEquals(
         {'Accept': '*/*',
@@ -2244,7 +4140,8 @@ class PullFeedHandlerTestWithParsing(testutil.HandlerTestBase):
     feed = FeedToFetch.get_by_key_name(get_hash_key_name(topic))
     self.assertTrue(feed is None)
     event = EventToDeliver.all().get()
-    self.assertEquals(data.replace('\n', ''), event.payload.replace('\n', ''))
+    self.assertEquals(data.replace('\n', ''),
+                      event.get_payload().replace('\n', ''))
     self.assertEquals('application/rss+xml', event.content_type)
     self.assertEquals('rss', FeedRecord.all().get().format)
 
@@ -2264,7 +4161,8 @@ class PullFeedHandlerTestWithParsing(testutil.HandlerTestBase):
     feed = FeedToFetch.get_by_key_name(get_hash_key_name(topic))
     self.assertTrue(feed is None)
     event = EventToDeliver.all().get()
-    self.assertEquals(data.replace('\n', ''), event.payload.replace('\n', ''))
+    self.assertEquals(data.replace('\n', ''),
+                      event.get_payload().replace('\n', ''))
     self.assertEquals('application/rdf+xml', event.content_type)
     self.assertEquals('rss', FeedRecord.all().get().format)
 
@@ -2282,7 +4180,7 @@ class PullFeedHandlerTestWithParsing(testutil.HandlerTestBase):
     feed = FeedToFetch.get_by_key_name(get_hash_key_name(topic))
     self.assertTrue(feed is None)
     event = EventToDeliver.all().get()
-    self.assertEquals(data, event.payload)
+    self.assertEquals(data, event.get_payload())
     self.assertEquals('my crazy content type', event.content_type)
     self.assertEquals('arbitrary', FeedRecord.all().get().format)
 
@@ -2300,7 +4198,7 @@ class PullFeedHandlerTestWithParsing(testutil.HandlerTestBase):
     feed = FeedToFetch.get_by_key_name(get_hash_key_name(topic))
     self.assertTrue(feed is None)
     event = EventToDeliver.all().get()
-    self.assertEquals(data, event.payload)
+    self.assertEquals(data, event.get_payload())
     self.assertEquals('my crazy content type', event.content_type)
     self.assertEquals('arbitrary', FeedRecord.all().get().format)
 
@@ -2340,14 +4238,9 @@ class PullFeedHandlerTestWithParsing(testutil.HandlerTestBase):
     self.assertEquals(set(str(e.key()) for e in all_events),
                       set(task['params']['event_key'] for task in event_tasks))
 
-    # All feed records written.
-    all_records = list(FeedEntryRecord.all())
-    all_parents = set(db.Key.from_path(FeedRecord.kind(),
-                                       FeedRecord.create_key_name(topic))
-                      for topic in topic_list)
-    found_parents = set(r.parent().key() for r in all_records)
-    self.assertEquals(3, len(found_parents))
-    self.assertEquals(found_parents, all_parents)
+    # All feed records written with their seen entries.
+    for record in FeedRecord.get_or_create_all(topic_list):
+      self.assertEquals(1, len(record.get_seen_entries()))
 
 ################################################################################
 
@@ -2410,6 +4303,20 @@ class PushEventHandlerTest(testutil.HandlerTestBase):
   def testNoWork(self):
     self.handle('post', ('event_key', str(self.bad_key)))
 
+  def testMissingPayload(self):
+    """Tests that events whose payload is gone are dropped."""
+    self.assertTrue(Subscription.insert(
+        self.callback1, self.topic, 'token', 'secret'))
+    event = EventToDeliver.create_event_for_topic(
+        self.topic, main.ATOM, 'application/atom+xml',
+        self.header_footer, self.test_payloads)
+    event.put()
+    db.delete(list(main.EventPayload.all(keys_only=True)))
+    main.EVENT_PAYLOAD_CACHE.clear()
+    memcache.flush_all()
+    self.handle('post', ('event_key', str(event.key())))
+    self.assertEquals([], list(EventToDeliver.all()))
+
   def testNoExtraSubscribers(self):
     """Tests when a single chunk of delivery is enough."""
     self.assertTrue(Subscription.insert(
@@ -3746,6 +5653,83 @@ class SubscriptionReconfirmHandlerTest(testutil.HandlerTestBase):
     self.assertTrue(self.called)
 
 
+class BuildRostersHandlerTest(testutil.HandlerTestBase):
+  """Tests for the periodic subscriber roster rebuilding worker."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.HandlerTestBase.setUp(self)
+    self.now = time.time()
+    self.calls = []
+    def start_pipeline(*args):
+      self.calls.append(args)
+    def create_handler():
+      return main.BuildRostersHandler(
+          now=lambda: self.now,
+          start_pipeline=start_pipeline)
+    self.handler_class = create_handler
+    os.environ['HTTP_X_APPENGINE_QUEUENAME'] = main.POLLING_QUEUE
+
+  def tearDown(self):
+    """Tears down the test harness."""
+    del os.environ['HTTP_X_APPENGINE_QUEUENAME']
+    testutil.HandlerTestBase.tearDown(self)
+
+  def testFullFlow(self):
+    """Tests a full flow through the roster worker."""
+    self.handle('get')
+    task = testutil.get_tasks(main.POLLING_QUEUE, index=0, expected_count=1)
+    self.assertEquals('/work/build_rosters', task['url'])
+    self.assertTrue(task['name'].startswith('build-rosters-'))
+    self.handle('post')
+    self.assertEquals(
+        [('Build subscriber rosters',
+          'offline_jobs.roster_topic_for_subscription',
+          'offline_jobs.save_roster_for_topic',
+          'main.Subscription',
+          4)],
+        self.calls)
+
+  def testOncePerDay(self):
+    """Tests that the job is only enqueued once per day."""
+    self.handle('get')
+    self.handle('get')
+    testutil.get_tasks(main.POLLING_QUEUE, expected_count=1)
+    self.now += 24 * 60 * 60
+    self.handle('get')
+    testutil.get_tasks(main.POLLING_QUEUE, expected_count=2)
+
+
+class CountSubscriptionsHandlerTest(testutil.HandlerTestBase):
+  """Tests for the periodic subscriber count reconciling worker."""
+
+  def testFullFlow(self):
+    """Tests a full flow through the count worker."""
+    calls = []
+    def start_pipeline(*args):
+      calls.append(args)
+    def create_handler():
+      return main.CountSubscriptionsHandler(start_pipeline=start_pipeline)
+    self.handler_class = create_handler
+
+    os.environ['HTTP_X_APPENGINE_QUEUENAME'] = main.POLLING_QUEUE
+    try:
+      self.handle('get')
+      task = testutil.get_tasks(main.POLLING_QUEUE, index=0, expected_count=1)
+      self.assertEquals('/work/count_subscriptions', task['url'])
+      self.handle('post')
+    finally:
+      del os.environ['HTTP_X_APPENGINE_QUEUENAME']
+
+    self.assertEquals(
+        [('Count subscriptions',
+          'offline_jobs.count_subscriptions_for_topic',
+          'offline_jobs.save_subscription_counts_for_topic',
+          'main.Subscription',
+          4)],
+        calls)
+
+
 class SubscriptionCleanupHandlerTest(testutil.HandlerTestBase):
   """Tests fo the SubscriptionCleanupHandler."""
 
@@ -3766,9 +5750,12 @@ class SubscriptionCleanupHandlerTest(testutil.HandlerTestBase):
                       [s.subscription_state for s in Subscription.all()])
 
     Subscription.archive(callback % 1, topic)
+    self.assertTrue(Subscription.has_subscribers(topic))
     self.handle('get')
     self.assertEquals(2 * [Subscription.STATE_VERIFIED],
                       [s.subscription_state for s in Subscription.all()])
+    self.assertTrue(
+        memcache.get(Subscription.has_subscribers_key(topic)) is None)
 
 
 class CleanupMapperHandlerTest(testutil.HandlerTestBase):
@@ -3983,8 +5970,10 @@ class RecordFeedHandlerTest(testutil.HandlerTestBase):
     self.old_identify = main.feed_identifier.identify
     self.expected_calls = []
     self.expected_results = []
-    def new_identify(content, feed_type):
+    self.partial_calls = []
+    def new_identify(content, feed_type, partial=False):
       self.assertEquals(self.expected_calls.pop(0), (content, feed_type))
+      self.partial_calls.append(partial)
       result = self.expected_results.pop(0)
       if isinstance(result, Exception):
         raise result
@@ -4017,6 +6006,50 @@ class RecordFeedHandlerTest(testutil.HandlerTestBase):
     self.expected_results.append(self.feed_id)
     self.handle('post', ('topic', self.topic))
     self.verify_update()
+    self.assertEquals([False], self.partial_calls)
+
+  def testNewFeed_ClearsAliases(self):
+    """Tests that recording a feed clears its cached aliases."""
+    main.TOPIC_ALIAS_CACHE.clear()
+    self.assertEquals(
+        {}, KnownFeedIdentity.derive_additional_topics([self.topic]))
+    urlfetch_test_stub.instance.expect('GET', self.topic, 200, self.content)
+    self.expected_calls.append((self.content, 'atom'))
+    self.expected_results.append(self.feed_id)
+    self.handle('post', ('topic', self.topic))
+    self.assertEquals(
+        {self.topic: set([self.topic])},
+        KnownFeedIdentity.derive_additional_topics([self.topic]))
+
+  def testRangeRequest(self):
+    """Tests when only a prefix of the feed is returned."""
+    urlfetch_test_stub.instance.expect(
+        'GET', self.topic, 206, self.content,
+        request_headers={'Range': 'bytes=0-%d' % (
+            main.FEED_IDENTITY_PREFIX_BYTES - 1)})
+    self.expected_calls.append((self.content, 'atom'))
+    self.expected_results.append(self.feed_id)
+    self.handle('post', ('topic', self.topic))
+    self.verify_update()
+    self.assertEquals([True], self.partial_calls)
+
+  def testPulledFeed(self):
+    """Tests that feeds which have been pulled are not fetched again."""
+    feed_record = FeedRecord.get_or_create(self.topic)
+    feed_record.update({}, format=main.ATOM)
+    feed_record.feed_id = self.feed_id
+    feed_record.put()
+    self.handle('post', ('topic', self.topic))
+    self.verify_update()
+
+  def testPulledFeed_NoFeedId(self):
+    """Tests pulled feeds where no feed ID could be found."""
+    feed_record = FeedRecord.get_or_create(self.topic)
+    feed_record.update({}, format=main.ARBITRARY)
+    feed_record.put()
+    self.handle('post', ('topic', self.topic))
+    feed = KnownFeed.get(KnownFeed.create_key(self.topic))
+    self.assertTrue(feed.feed_id is None)
 
   def testNewFeedFetchFailure(self):
     """Tests when fetching a feed to record returns a non-200 response."""
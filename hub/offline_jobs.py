@@ -35,7 +35,11 @@ from mapreduce import util
 
 
 class CleanupOldEventToDeliver(object):
-  """Removes EventToDeliver instances older than a certain value."""
+  """Removes EventToDeliver instances older than a certain value.
+
+  Also used to remove old EventPayload instances, which have the same
+  last_modified property.
+  """
 
   @staticmethod
   def validate_params(params):
@@ -116,24 +120,103 @@ class SubscriptionReconfirmMapper(object):
                          sub.secret, auto_reconfirm=True)
 
 
+def build_seen_entries(feed_record):
+  """Builds a FeedRecord's digest of seen entries from its FeedEntryRecords.
+
+  Topics are otherwise migrated the next time they're pulled; this does it
+  ahead of time for those whose records all fit in a digest. Topics with more
+  records are left to be migrated from the entries in their feed documents.
+  """
+  if feed_record.seen_entries is not None:
+    return
+  query = main.FeedEntryRecord.all().ancestor(feed_record)
+  entry_list = query.fetch(main.MAX_SEEN_ENTRIES + 1)
+  if len(entry_list) > main.MAX_SEEN_ENTRIES:
+    yield op.counters.Increment('too many records')
+    return
+  seen_entries = main.SeenEntries()
+  for entry in entry_list:
+    seen_entries.add(entry.id_hash, entry.entry_content_hash,
+                     getattr(entry, 'raw_content_hash', None))
+
+  def txn():
+    current = db.get(feed_record.key())
+    if current is not None and current.seen_entries is None:
+      current.add_seen_entries(seen_entries, [])
+      current.put()
+  db.run_in_transaction(txn)
+  main.FEED_RECORD_CACHE.invalidate([feed_record.key()])
+  yield op.counters.Increment('migrated')
+
+
+class PruneFeedEntryRecords(object):
+  """Removes FeedEntryRecords of entries that have left their feed.
+
+  An entry's record is removed once its topic's digest of seen entries no
+  longer has the entry or last saw it in the feed more than age_days ago.
+  Records are only removed for topics that have a digest, so the digests
+  should be built first. Records are read in key order, so those of a topic
+  come together and only the digest of the current topic is kept.
+  """
+
+  @staticmethod
+  def validate_params(params):
+    assert 'age_days' in params
+    params['oldest_seen_time'] = (
+        time.time() - (86400 * int(params['age_days'])))
+
+  def __init__(self):
+    self.oldest_seen_date = None
+    self.topic_key = None
+    self.seen_entries = None
+
+  def run(self, entry):
+    if not self.oldest_seen_date:
+      params = context.get().mapreduce_spec.mapper.params
+      self.oldest_seen_date = datetime.datetime.utcfromtimestamp(
+          params['oldest_seen_time']).date()
+
+    feed_record_key = entry.feed_record_key
+    if feed_record_key != self.topic_key:
+      self.topic_key = feed_record_key
+      feed_record = db.get(feed_record_key)
+      if feed_record is None:
+        # Records of topics that no longer exist are removed as well.
+        self.seen_entries = main.SeenEntries()
+      else:
+        self.seen_entries = feed_record.get_seen_entries()
+    if self.seen_entries.legacy_topic is not None:
+      yield op.counters.Increment('skipped without digest')
+      return
+
+    last_seen = self.seen_entries.last_seen(entry.id_hash)
+    if last_seen is not None and last_seen >= self.oldest_seen_date:
+      return
+
+    yield op.db.Delete(entry)
+    yield op.counters.Increment('pruned')
+    yield op.counters.Increment(
+        'bytes reclaimed', len(db.model_to_protobuf(entry).Encode()))
+
+
 def count_subscriptions_for_topic(subscription):
   """Counts a Subscription instance if it's still active."""
-  print subscription.subscription_state
   if subscription.subscription_state == main.Subscription.STATE_VERIFIED:
     yield (subscription.topic_hash, '1')
 
 
 def save_subscription_counts_for_topic(topic_hash, counts):
-  """Sums subscriptions to a topic and saves a corresponding KnownFeedStat."""
-  total_count = len(counts)
-  entity = main.KnownFeedStats(
-      key=main.KnownFeedStats.create_key(topic_hash=topic_hash),
-      subscriber_count=total_count)
-  yield op.db.Put(entity)
+  """Reconciles a topic's subscriber count with its counted subscriptions."""
+  if main.SubscriberCountShard.reconcile(topic_hash, len(counts)):
+    yield op.counters.Increment('reconciled')
 
 
 def start_count_subscriptions():
-  """Kicks off the MapReduce for determining and saving subscription counts."""
+  """Kicks off the MapReduce for reconciling subscription counts.
+
+  Subscription changes keep counts up to date, so this only needs to run
+  occasionally to repair drift from failed or racing count updates.
+  """
   job = mapreduce_pipeline.MapreducePipeline(
       'Count subscriptions',
       'offline_jobs.count_subscriptions_for_topic',
@@ -145,3 +228,29 @@ def start_count_subscriptions():
   # a limitation in the mapper library.
   job.start()
   return job.pipeline_id
+
+
+def roster_topic_for_subscription(subscription):
+  """Emits the topic of a Subscription if it's still active."""
+  if subscription.subscription_state == main.Subscription.STATE_VERIFIED:
+    yield (main.utf8encoded(subscription.topic), '1')
+
+
+def save_roster_for_topic(topic, counts):
+  """Rebuilds the SubscriberRoster for a topic with enough subscribers.
+
+  Each shard is rebuilt from the topic's Subscriptions as they are when the
+  shard is saved, so changes made since they were counted are kept.
+  """
+  topic = topic.decode('utf-8')
+  topic_hash = main.sha1_hash(topic)
+  if len(counts) < main.ROSTER_MIN_SUBSCRIBERS:
+    if db.get(main.SubscriberRoster.create_key(topic_hash, 0)) is not None:
+      for shard in xrange(main.ROSTER_SHARD_COUNT):
+        yield op.db.Delete(main.SubscriberRoster.create_key(topic_hash, shard))
+    return
+
+  main.SubscriberRoster.start_build(topic_hash)
+  for shard in xrange(main.ROSTER_SHARD_COUNT):
+    if main.SubscriberRoster.refresh(topic, shard):
+      yield op.counters.Increment('shards updated')
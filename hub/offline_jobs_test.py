@@ -261,17 +261,22 @@ class SaveSubscriptionCountsTest(unittest.TestCase):
 
   def testReduce(self):
     """Tests the reducer function."""
-    self.assertEquals(0, len(list(main.KnownFeedStats.all())))
+    self.assertTrue(Subscription.insert(
+        self.callback, self.topic, self.token, self.secret))
     it = offline_jobs.save_subscription_counts_for_topic(
         '95ff66c343530c88a750cbc7fd1e0bbd8cc7bce2',
         ['1'] * 321)
-    op = it.next()
+    self.assertEquals('reconciled', it.next().counter_name)
+    self.assertRaises(StopIteration, it.next)
     self.assertEquals(
-        db.Key.from_path(
-            'KnownFeed', '95ff66c343530c88a750cbc7fd1e0bbd8cc7bce2',
-            'KnownFeedStats', 'overall'),
-        op.entity.key())
-    self.assertEquals(321, op.entity.subscriber_count)
+        321,
+        main.KnownFeedStats.get_or_create_all(
+            [self.topic])[0].subscriber_count)
+
+    # Already correct.
+    it = offline_jobs.save_subscription_counts_for_topic(
+        '95ff66c343530c88a750cbc7fd1e0bbd8cc7bce2',
+        ['1'] * 321)
     self.assertRaises(StopIteration, it.next)
 
   def testStart(self):
@@ -283,5 +288,227 @@ class SaveSubscriptionCountsTest(unittest.TestCase):
 
 ################################################################################
 
+class BuildSeenEntriesTest(unittest.TestCase):
+  """Tests for the mapper that builds digests of seen entries."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing()
+    self.topic = 'http://example.com/my-topic-url'
+    self.record = main.FeedRecord.get_or_create(self.topic)
+    db.put([main.FeedEntryRecord(
+                key=main.FeedEntryRecord.create_legacy_key(
+                    self.topic, entry_id),
+                entry_content_hash=main.sha1_hash('content'))
+            for entry_id in ('1', '2', '3')])
+
+  def testMigrate(self):
+    """Tests building the digest for a topic without one."""
+    op = offline_jobs.build_seen_entries(self.record).next()
+    self.assertEquals('migrated', op.counter_name)
+    record = db.get(self.record.key())
+    self.assertEquals(3, len(main.SeenEntries(record.seen_entries)))
+
+  def testAlreadyMigrated(self):
+    """Tests that topics with a digest are left alone."""
+    self.record.add_seen_entries(main.SeenEntries(), [])
+    self.record.put()
+    it = offline_jobs.build_seen_entries(self.record)
+    self.assertRaises(StopIteration, it.next)
+    record = db.get(self.record.key())
+    self.assertEquals(0, len(main.SeenEntries(record.seen_entries)))
+
+  def testTooManyRecords(self):
+    """Tests that topics with more records than a digest holds are skipped."""
+    old_max = main.MAX_SEEN_ENTRIES
+    main.MAX_SEEN_ENTRIES = 2
+    try:
+      op = offline_jobs.build_seen_entries(self.record).next()
+    finally:
+      main.MAX_SEEN_ENTRIES = old_max
+    self.assertEquals('too many records', op.counter_name)
+    self.assertEquals(None, db.get(self.record.key()).seen_entries)
+
+################################################################################
+
+class PruneFeedEntryRecordsTest(unittest.TestCase):
+  """Tests for the PruneFeedEntryRecords mapper."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing()
+    self.mapper = offline_jobs.PruneFeedEntryRecords()
+    self.topic = 'http://example.com/my-topic-url'
+    self.record = main.FeedRecord.get_or_create(self.topic)
+    self.record.add_seen_entries(main.SeenEntries(), [])
+    self.record.put()
+    self.entry = main.FeedEntryRecord.create_entry_for_topic(
+        self.topic, 'my-entry', main.sha1_hash('content'))
+    self.entry.put()
+    self.params = {'oldest_seen_time': time.time() - 1000}
+
+    params = self.params
+    class FakeMapper(object):
+      pass
+    FakeMapper.params = params
+    class FakeSpec(object):
+      mapreduce_id = '1234'
+      mapper = FakeMapper()
+    self.context = context.Context(FakeSpec(), None)
+    context.Context._set(self.context)
+
+  def testValidateParams(self):
+    """Tests the validate_params static method."""
+    self.assertRaises(
+        AssertionError,
+        offline_jobs.PruneFeedEntryRecords.validate_params,
+        {})
+    params = {'age_days': 30}
+    offline_jobs.PruneFeedEntryRecords.validate_params(params)
+    self.assertTrue(params['oldest_seen_time'] < time.time())
+
+  def save_seen(self, now=datetime.datetime.utcnow):
+    """Saves the entry in the topic's digest as last seen at a time."""
+    seen_entries = main.SeenEntries(now=now)
+    self.record.add_seen_entries(seen_entries, [self.entry])
+    self.record.put()
+
+  def testPrune(self):
+    """Tests pruning a record of an entry that is not in the digest."""
+    ops = list(self.mapper.run(self.entry))
+    self.assertEquals(3, len(ops))
+    self.assertEquals(self.entry, ops[0].entity)
+    self.assertEquals('pruned', ops[1].counter_name)
+    self.assertEquals('bytes reclaimed', ops[2].counter_name)
+    self.assertTrue(ops[2].delta > 0)
+
+  def testRecentlySeen(self):
+    """Tests that records of entries seen in the feed recently are kept."""
+    self.save_seen()
+    self.assertEquals([], list(self.mapper.run(self.entry)))
+
+  def testSeenLongAgo(self):
+    """Tests pruning a record of an entry last seen before the cutoff."""
+    self.save_seen(now=lambda: datetime.datetime.utcnow() -
+                                datetime.timedelta(days=2))
+    ops = list(self.mapper.run(self.entry))
+    self.assertEquals('pruned', ops[1].counter_name)
+
+  def testNoDigest(self):
+    """Tests that records of topics without a digest are kept."""
+    self.record.seen_entries = None
+    self.record.put()
+    ops = list(self.mapper.run(self.entry))
+    self.assertEquals(1, len(ops))
+    self.assertEquals('skipped without digest', ops[0].counter_name)
+
+  def testLegacyRecord(self):
+    """Tests pruning a record that is a child of its FeedRecord."""
+    entry = main.FeedEntryRecord(
+        key=main.FeedEntryRecord.create_legacy_key(self.topic, 'old-entry'),
+        entry_content_hash=main.sha1_hash('content'))
+    entry.put()
+    self.save_seen()
+    ops = list(self.mapper.run(entry))
+    self.assertEquals('pruned', ops[1].counter_name)
+    self.assertEquals([], list(self.mapper.run(self.entry)))
+
+  def testMissingFeedRecord(self):
+    """Tests that records of topics that no longer exist are pruned."""
+    self.record.delete()
+    ops = list(self.mapper.run(self.entry))
+    self.assertEquals('pruned', ops[1].counter_name)
+
+################################################################################
+
+class BuildRostersTest(unittest.TestCase):
+  """Tests for the MapReduce that rebuilds subscriber rosters."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    testutil.setup_for_testing()
+    self.callback = u'http://foo.callback-example.com/my-callback-url'
+    self.topic = 'http://example.com/my-topic-url'
+    self.topic_hash = main.sha1_hash(self.topic)
+    self.token = 'token'
+    self.secret = u'my secr\u00e4t'
+    self.old_min_subscribers = main.ROSTER_MIN_SUBSCRIBERS
+    main.ROSTER_MIN_SUBSCRIBERS = 2
+
+  def tearDown(self):
+    """Tears down the test harness."""
+    main.ROSTER_MIN_SUBSCRIBERS = self.old_min_subscribers
+
+  def get_counts(self, callback):
+    """Inserts a Subscription and returns the mapper's output for it."""
+    Subscription.insert(callback, self.topic, self.token, self.secret)
+    sub = Subscription.get_by_key_name(
+        Subscription.create_key_name(callback, self.topic))
+    return list(offline_jobs.roster_topic_for_subscription(sub))
+
+  def get_roster(self):
+    """Returns the callback hashes in the test topic's roster, or None."""
+    entry_list = main.SubscriberRoster.get_subscribers(self.topic, 10)
+    if entry_list is None:
+      return None
+    return [e.callback_hash for e in entry_list]
+
+  def testMap(self):
+    """Tests the mapper function."""
+    self.assertEquals([(self.topic, '1')], self.get_counts(self.callback))
+
+    Subscription.archive(self.callback, self.topic)
+    sub = Subscription.get_by_key_name(
+        Subscription.create_key_name(self.callback, self.topic))
+    it = offline_jobs.roster_topic_for_subscription(sub)
+    self.assertRaises(StopIteration, it.next)
+
+  def testReduce(self):
+    """Tests the reducer function builds every shard of the roster."""
+    counts = [self.get_counts(self.callback + str(i))[0][1]
+              for i in xrange(3)]
+    self.assertEquals(None, self.get_roster())
+    op_list = list(offline_jobs.save_roster_for_topic(self.topic, counts))
+    self.assertEquals(main.ROSTER_SHARD_COUNT, len(op_list))
+    self.assertEquals('shards updated', op_list[0].counter_name)
+
+    entry_list = main.SubscriberRoster.get_subscribers(self.topic, 10)
+    self.assertEquals(
+        sorted(main.sha1_hash(self.callback + str(i)) for i in xrange(3)),
+        [e.callback_hash for e in entry_list])
+    self.assertEquals([self.secret] * 3, [e.secret for e in entry_list])
+    self.assertEquals([self.token] * 3, [e.verify_token for e in entry_list])
+
+    # Nothing changes when run again.
+    self.assertEquals(
+        [], list(offline_jobs.save_roster_for_topic(self.topic, counts)))
+
+  def testReduce_keepsLiveChanges(self):
+    """Tests that changes made after subscribers were counted are kept."""
+    counts = [self.get_counts(self.callback + str(i))[0][1]
+              for i in xrange(3)]
+    db.put(main.SubscriberRoster.build(
+        self.topic_hash,
+        [(main.sha1_hash(self.callback + '4'), self.callback + '4', '', '')]))
+    Subscription.remove(self.callback + '0', self.topic)
+    Subscription.insert(self.callback + '3', self.topic, self.token,
+                        self.secret)
+    list(offline_jobs.save_roster_for_topic(self.topic, counts))
+    self.assertEquals(
+        sorted(main.sha1_hash(self.callback + str(i)) for i in (1, 2, 3)),
+        self.get_roster())
+
+  def testReduce_tooFewSubscribers(self):
+    """Tests that topics with too few subscribers have no roster."""
+    counts = [self.get_counts(self.callback)[0][1]]
+    it = offline_jobs.save_roster_for_topic(self.topic, counts)
+    self.assertRaises(StopIteration, it.next)
+
+    db.put(main.SubscriberRoster.build(self.topic_hash, []))
+    op_list = list(offline_jobs.save_roster_for_topic(self.topic, counts))
+    self.assertEquals(main.ROSTER_SHARD_COUNT, len(op_list))
+
+################################################################################
+
 if __name__ == '__main__':
   unittest.main()
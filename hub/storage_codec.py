@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Compression of blobs stored in the Datastore and memcache.
+
+Values are compressed with zlib when they are large enough to benefit.
+Compressed values begin with a marker byte that XML documents and encoded
+protocol buffers never begin with. Values without the marker are decoded
+as-is, so values stored before they were encoded remain readable.
+"""
+
+import zlib
+
+
+# First byte of every compressed value.
+MARKER = '\x00'
+
+# Values smaller than this are stored uncompressed.
+MIN_COMPRESS_BYTES = 1024
+
+# zlib compression level; higher levels cost more CPU for little gain on XML.
+COMPRESSION_LEVEL = 6
+
+
+def encode(value):
+  """Encodes a value for storage.
+
+  Args:
+    value: The byte string to encode.
+
+  Returns:
+    The encoded byte string.
+  """
+  # Values beginning with the marker are always compressed so they can't be
+  # mistaken for compressed data when decoded.
+  if value.startswith(MARKER):
+    return MARKER + zlib.compress(value, COMPRESSION_LEVEL)
+  if len(value) >= MIN_COMPRESS_BYTES:
+    compressed = MARKER + zlib.compress(value, COMPRESSION_LEVEL)
+    if len(compressed) < len(value):
+      return compressed
+  return value
+
+
+def decode(value):
+  """Decodes a stored value.
+
+  Args:
+    value: The byte string that was stored, either encoded by encode() or
+      stored without encoding.
+
+  Returns:
+    The original byte string.
+  """
+  if value.startswith(MARKER):
+    try:
+      return zlib.decompress(value[1:])
+    except zlib.error:
+      pass
+  return value
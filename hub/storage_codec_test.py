@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tests for the storage_codec module."""
+
+import random
+import unittest
+
+import storage_codec
+
+
+class StorageCodecTest(unittest.TestCase):
+  """Tests for encoding and decoding stored values."""
+
+  def setUp(self):
+    """Sets up the test harness."""
+    self.large = '<feed>%s</feed>' % ('<entry>data</entry>' * 500)
+
+  def testSmallValue(self):
+    """Tests that small values are stored as-is."""
+    self.assertEquals('<feed/>', storage_codec.encode('<feed/>'))
+    self.assertEquals('', storage_codec.encode(''))
+    self.assertEquals('', storage_codec.decode(''))
+
+  def testLargeValue(self):
+    """Tests that large values are compressed."""
+    encoded = storage_codec.encode(self.large)
+    self.assertEquals(storage_codec.MARKER, encoded[0])
+    self.assertTrue(len(encoded) < len(self.large) / 5)
+    self.assertEquals(self.large, storage_codec.decode(encoded))
+
+  def testIncompressible(self):
+    """Tests that values that do not shrink are stored as-is."""
+    rand = random.Random(0)
+    value = 'a' + ''.join(chr(rand.randint(0, 255)) for i in xrange(5000))
+    self.assertEquals(value, storage_codec.encode(value))
+
+  def testMarkerValue(self):
+    """Tests values that happen to begin with the marker byte."""
+    value = storage_codec.MARKER + 'small'
+    encoded = storage_codec.encode(value)
+    self.assertNotEquals(value, encoded)
+    self.assertEquals(value, storage_codec.decode(encoded))
+
+  def testLegacyValue(self):
+    """Tests that values stored without encoding are decoded as-is."""
+    self.assertEquals(self.large, storage_codec.decode(self.large))
+    self.assertEquals(storage_codec.MARKER + 'not zlib',
+                      storage_codec.decode(storage_codec.MARKER + 'not zlib'))
+
+
+if __name__ == '__main__':
+  unittest.main()
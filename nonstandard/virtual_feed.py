@@ -143,15 +143,18 @@ class CollateFeedHandler(webapp.RequestHandler):
     fragment = fragment_list[0]
     entry_payloads = [f.entries for f in fragment_list]
 
+    # The payload is stored when the event is created, outside the
+    # transaction, since it is in a separate entity group.
+    event_to_deliver = EventToDeliver.create_event_for_topic(
+        fragment.topic,
+        fragment.format,
+        self.request.headers.get('Content-Type', 'application/atom+xml'),
+        fragment.header_footer,
+        entry_payloads,
+        set_parent=False,
+        max_failures=1)
+
     def txn():
-      event_to_deliver = EventToDeliver.create_event_for_topic(
-          fragment.topic,
-          fragment.format,
-          self.request.headers.get('Content-Type', 'application/atom+xml'),
-          fragment.header_footer,
-          entry_payloads,
-          set_parent=False,
-          max_failures=1)
       db.put(event_to_deliver)
       event_to_deliver.enqueue()
 
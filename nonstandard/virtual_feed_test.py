@@ -157,7 +157,7 @@ class CollateFeedHandlerTest(testutil.HandlerTestBase):
       '<entry>second data</entry>\n'
       '<entry>first data</entry>\n'
       '</feed>',
-      event.payload)
+      event.get_payload())
     self.assertEquals('application/atom+xml', event.content_type)
     self.assertEquals(1, event.max_failures)
 
@@ -189,7 +189,7 @@ class CollateFeedHandlerTest(testutil.HandlerTestBase):
       '<entry>second data</entry>\n'
       '<entry>first data</entry>\n'
       '</feed>',
-      event.payload)
+      event.get_payload())
 
   def testMultipleQueues(self):
     """Tests multiple virtual feeds and queues."""